@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import asyncio
+import random
+import sys
+from time import monotonic
+from typing import List
+
+from benchmarks.stake_record_store import (
+    BLOCK_TIME,
+    NUM_BLOCKS,
+    RECORDS_PER_BLOCK,
+    START_TIMESTAMP,
+    make_stake_records,
+    populate,
+    stake_puzzle_hashes,
+)
+from benchmarks.utils import rand_g1, setup_db
+from greenbtc.consensus.coinbase import batch_create_puzzlehash_for_pk
+from greenbtc.full_node.stake_coefficient_engine import StakeCoefficientEngine
+from greenbtc.full_node.stake_record_store import StakeRecordStore
+from greenbtc.util.ints import uint32, uint64
+from greenbtc.util.lru_cache import LRUCache
+
+# to run this benchmark:
+# python -m benchmarks.stake_coefficient
+
+# Blockchain.get_stake_coefficients needs a chain of valid blocks to run, so
+# this benchmark times the parts it's made of: converting farmer keys, and
+# looking up the stake amounts of those keys through the coefficient engine or
+# the StakeRecordStore
+
+NUM_ITERS = 200
+
+# number of farmer keys asking for their coefficients on every signage point
+NUM_FARMER_KEYS = 500
+
+# we need seeded random, to have reproducible benchmark runs
+random.seed(987654321)
+
+
+async def run_stake_coefficient_benchmark(version: int) -> None:
+    verbose: bool = "--verbose" in sys.argv
+
+    # keep track of benchmark total time
+    all_test_time = 0.0
+
+    async with setup_db("stake-coefficient-benchmark.db", version) as db_wrapper:
+        store = await StakeRecordStore.create(db_wrapper)
+
+        print("Building database ", end="")
+        await populate(store, NUM_BLOCKS, verbose)
+        print("")
+
+        height = NUM_BLOCKS + 1
+        timestamp = START_TIMESTAMP + NUM_BLOCKS * BLOCK_TIME
+
+        farmer_keys = [bytes(rand_g1()) for _ in range(NUM_FARMER_KEYS)]
+        start = monotonic()
+        batch_create_puzzlehash_for_pk(farmer_keys)
+        total_time = monotonic() - start
+        print(f"{total_time:0.4f}s, FARMER KEYS TO PUZZLE HASHES {NUM_FARMER_KEYS} keys")
+        all_test_time += total_time
+
+        # farmer keys whose puzzle hashes have stake records
+        keys = random.sample(stake_puzzle_hashes, NUM_FARMER_KEYS)
+
+        engine = StakeCoefficientEngine(store)
+        start = monotonic()
+        await engine.set_peak(uint32(height - 1), uint64(timestamp - BLOCK_TIME))
+        total_time = monotonic() - start
+        print(f"{total_time:0.4f}s, ENGINE LOAD")
+        all_test_time += total_time
+
+        if verbose:
+            print("Profiling engine set_peak ", end="")
+        total_time = 0.0
+        for _ in range(NUM_ITERS):
+            records = make_stake_records(RECORDS_PER_BLOCK, uint32(height), uint64(timestamp))
+            await store.new_stake(uint32(height), records, [])
+            store.commit_totals()
+            start = monotonic()
+            engine.add_records(records)
+            await engine.set_peak(uint32(height), uint64(timestamp))
+            total_time += monotonic() - start
+            height += 1
+            timestamp += BLOCK_TIME
+            if verbose:
+                print(".", end="")
+                sys.stdout.flush()
+
+        if verbose:
+            print("")
+        print(f"{total_time:0.4f}s, ENGINE SET PEAK {NUM_ITERS} blocks")
+        all_test_time += total_time
+
+        peak_height = uint32(height - 1)
+        peak_timestamp = uint64(timestamp - BLOCK_TIME)
+
+        if verbose:
+            print("Profiling engine get_stake_amount ", end="")
+        total_time = 0.0
+        engine_amounts: List[int] = []
+        for _ in range(NUM_ITERS):
+            start = monotonic()
+            engine_amounts = [engine.get_stake_amount(key, peak_height, peak_timestamp) or 0 for key in keys]
+            total_time += monotonic() - start
+            if verbose:
+                print(".", end="")
+                sys.stdout.flush()
+
+        if verbose:
+            print("")
+        print(f"{total_time:0.4f}s, ENGINE GET STAKE AMOUNT {NUM_ITERS} signage points of {NUM_FARMER_KEYS} keys")
+        all_test_time += total_time
+
+        if verbose:
+            print("Profiling batched store lookups ", end="")
+        total_time = 0.0
+        for _ in range(NUM_ITERS // 10):
+            store.stake_farm_cache = LRUCache(store.stake_farm_cache.capacity)
+            start = monotonic()
+            await store.get_stake_farm_records_thin_by_puzzle_hashes(keys, peak_height, peak_timestamp)
+            total_time += monotonic() - start
+            if verbose:
+                print(".", end="")
+                sys.stdout.flush()
+
+        if verbose:
+            print("")
+        print(f"{total_time:0.4f}s, STORE BATCHED LOOKUP {NUM_ITERS // 10} signage points of {NUM_FARMER_KEYS} keys")
+        all_test_time += total_time
+
+        if verbose:
+            print("Profiling per key store lookups ", end="")
+        total_time = 0.0
+        for _ in range(NUM_ITERS // 10):
+            store.stake_farm_cache = LRUCache(store.stake_farm_cache.capacity)
+            start = monotonic()
+            for key in keys:
+                await store.get_stake_farm_records_thin(key, peak_height, peak_timestamp)
+            total_time += monotonic() - start
+            if verbose:
+                print(".", end="")
+                sys.stdout.flush()
+
+        if verbose:
+            print("")
+        print(f"{total_time:0.4f}s, STORE PER KEY LOOKUP {NUM_ITERS // 10} signage points of {NUM_FARMER_KEYS} keys")
+        all_test_time += total_time
+
+        print(f"stake amount of {sum(1 for amount in engine_amounts if amount > 0)} keys is non-zero")
+        print(f"all tests completed in {all_test_time:0.4f}s")
+
+
+if __name__ == "__main__":
+    print("version 2")
+    asyncio.run(run_stake_coefficient_benchmark(2))
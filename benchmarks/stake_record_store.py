@@ -0,0 +1,232 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import random
+import sys
+from pathlib import Path
+from time import monotonic
+from typing import List
+
+from benchmarks.utils import rand_hash, setup_db
+from greenbtc.full_node.stake_record_store import StakeRecordStore
+from greenbtc.types.blockchain_format.sized_bytes import bytes32
+from greenbtc.types.stake_record import StakeRecord
+from greenbtc.types.stake_value import STAKE_FARM_LIST, STAKE_LOCK_LIST, get_stake_value
+from greenbtc.util.ints import uint16, uint32, uint64
+from greenbtc.util.lru_cache import LRUCache
+
+# to run this benchmark:
+# python -m benchmarks.stake_record_store
+
+NUM_ITERS = 200
+
+# the database is populated with NUM_BLOCKS * RECORDS_PER_BLOCK stake records
+NUM_BLOCKS = 5000
+RECORDS_PER_BLOCK = 200
+NUM_STAKE_PUZZLE_HASHES = 10000
+NUM_RECIPIENT_PUZZLE_HASHES = 50000
+
+# fraction of the stake records that are farm records, the rest are locks
+FARM_RATIO = 0.5
+
+# 19 seconds per block
+BLOCK_TIME = 19
+START_TIMESTAMP = 1631794488
+
+# we need seeded random, to have reproducible benchmark runs
+random.seed(123456789)
+
+stake_puzzle_hashes: List[bytes32] = [rand_hash() for _ in range(NUM_STAKE_PUZZLE_HASHES)]
+recipient_puzzle_hashes: List[bytes32] = [rand_hash() for _ in range(NUM_RECIPIENT_PUZZLE_HASHES)]
+
+
+def make_stake_record(height: uint32, timestamp: uint64) -> StakeRecord:
+    is_stake_farm = random.random() < FARM_RATIO
+    stake_type = uint16(random.randrange(len(STAKE_FARM_LIST if is_stake_farm else STAKE_LOCK_LIST)))
+    stake_value = get_stake_value(stake_type, is_stake_farm)
+    return StakeRecord(
+        rand_hash(),
+        uint64(random.randint(100, 100000)),
+        height,
+        uint32(0),
+        random.choice(stake_puzzle_hashes),
+        random.choice(recipient_puzzle_hashes),
+        stake_type,
+        is_stake_farm,
+        stake_value.coefficient,
+        uint64(timestamp + stake_value.time_lock),
+    )
+
+
+def make_stake_records(num: int, height: uint32, timestamp: uint64) -> List[StakeRecord]:
+    return [make_stake_record(height, timestamp) for _ in range(num)]
+
+
+async def populate(store: StakeRecordStore, num_blocks: int, verbose: bool) -> List[bytes32]:
+    """
+    Adds num_blocks blocks worth of stake records and returns the names of all records added
+    """
+    names: List[bytes32] = []
+    timestamp = START_TIMESTAMP
+    for height in range(1, num_blocks + 1):
+        records = make_stake_records(RECORDS_PER_BLOCK, uint32(height), uint64(timestamp))
+        names += [record.name for record in records]
+        await store.new_stake(uint32(height), records, [])
+        store.commit_totals()
+        timestamp += BLOCK_TIME
+        if verbose and height % 100 == 0:
+            print(".", end="")
+            sys.stdout.flush()
+    return names
+
+
+async def run_stake_record_store_benchmark(version: int) -> None:
+    verbose: bool = "--verbose" in sys.argv
+
+    # keep track of benchmark total time
+    all_test_time = 0.0
+
+    async with setup_db("stake-record-store-benchmark.db", version) as db_wrapper:
+        store = await StakeRecordStore.create(db_wrapper)
+
+        print("Building database ", end="")
+        start = monotonic()
+        all_names = await populate(store, NUM_BLOCKS, verbose)
+        print("")
+        print(f"{monotonic() - start:0.4f}s, populated {len(all_names)} stake records")
+
+        block_height = NUM_BLOCKS + 1
+        timestamp = START_TIMESTAMP + NUM_BLOCKS * BLOCK_TIME
+
+        if verbose:
+            print("Profiling new_stake ", end="")
+        total_time = 0.0
+        total_add = 0
+        total_remove = 0
+        for height in range(block_height, block_height + NUM_ITERS):
+            records = make_stake_records(RECORDS_PER_BLOCK, uint32(height), uint64(timestamp))
+            removals = random.sample(all_names, 20)
+            all_names += [record.name for record in records]
+            total_add += len(records)
+            total_remove += len(removals)
+
+            start = monotonic()
+            await store.new_stake(uint32(height), records, removals)
+            store.commit_totals()
+            total_time += monotonic() - start
+
+            timestamp += BLOCK_TIME
+            if verbose:
+                print(".", end="")
+                sys.stdout.flush()
+        block_height += NUM_ITERS
+
+        if verbose:
+            print("")
+        print(f"{total_time:0.4f}s, NEW STAKE additions: {total_add} removals: {total_remove}")
+        all_test_time += total_time
+
+        if verbose:
+            print("Profiling get_stake_farm_records_thin ", end="")
+        total_time = 0.0
+        found_records = 0
+        for i in range(NUM_ITERS):
+            # the cache would hide the query, this benchmark is about the database
+            store.stake_farm_cache = LRUCache(store.stake_farm_cache.capacity)
+            height = random.randint(1, block_height - 1)
+            stake_puzzle_hash = random.choice(stake_puzzle_hashes)
+            start = monotonic()
+            records = await store.get_stake_farm_records_thin(
+                stake_puzzle_hash, uint32(height), uint64(START_TIMESTAMP + height * BLOCK_TIME)
+            )
+            total_time += monotonic() - start
+            found_records += len(records)
+            if verbose:
+                print(".", end="")
+                sys.stdout.flush()
+
+        if verbose:
+            print("")
+        print(
+            f"{total_time:0.4f}s, GET STAKE FARM RECORDS {NUM_ITERS} lookups found {found_records} records in total"
+        )
+        all_test_time += total_time
+
+        if verbose:
+            print("Profiling get_stake_lock_records_thin ", end="")
+        total_time = 0.0
+        found_records = 0
+        for i in range(NUM_ITERS):
+            store.stake_lock_cache = LRUCache(store.stake_lock_cache.capacity)
+            height = random.randint(2, block_height - 1)
+            start = monotonic()
+            records = await store.get_stake_lock_records_thin(
+                uint64(START_TIMESTAMP + (height - 1) * BLOCK_TIME), uint64(START_TIMESTAMP + height * BLOCK_TIME)
+            )
+            total_time += monotonic() - start
+            found_records += len(records)
+            if verbose:
+                print(".", end="")
+                sys.stdout.flush()
+
+        if verbose:
+            print("")
+        print(
+            f"{total_time:0.4f}s, GET STAKE LOCK RECORDS {NUM_ITERS} lookups found {found_records} records in total"
+        )
+        all_test_time += total_time
+
+        if verbose:
+            print("Profiling get_stake_amount_total ", end="")
+        total_time = 0.0
+        for i in range(NUM_ITERS):
+            start = monotonic()
+            await store.get_stake_amount_total(uint64(timestamp + i * BLOCK_TIME))
+            total_time += monotonic() - start
+            if verbose:
+                print(".", end="")
+                sys.stdout.flush()
+
+        if verbose:
+            print("")
+        print(f"{total_time:0.4f}s, GET STAKE AMOUNT TOTAL {NUM_ITERS} lookups")
+        all_test_time += total_time
+
+        if verbose:
+            print("Profiling rollback_to_block ", end="")
+        total_time = 0.0
+        total_blocks = 0
+        for i in range(NUM_ITERS // 10):
+            # roll back a few blocks and add them back, like a short reorg
+            depth = random.randint(1, 5)
+            fork_height = block_height - 1 - depth
+            start = monotonic()
+            await store.rollback_to_block(fork_height)
+            store.commit_totals()
+            total_time += monotonic() - start
+            total_blocks += depth
+            timestamp -= depth * BLOCK_TIME
+            for height in range(fork_height + 1, block_height):
+                await store.new_stake(
+                    uint32(height), make_stake_records(RECORDS_PER_BLOCK, uint32(height), uint64(timestamp)), []
+                )
+                store.commit_totals()
+                timestamp += BLOCK_TIME
+            if verbose:
+                print(".", end="")
+                sys.stdout.flush()
+
+        if verbose:
+            print("")
+        print(f"{total_time:0.4f}s, ROLLBACK {NUM_ITERS // 10} reorgs of {total_blocks} blocks in total")
+        all_test_time += total_time
+        print(f"all tests completed in {all_test_time:0.4f}s")
+
+    db_size = os.path.getsize(Path("stake-record-store-benchmark.db"))
+    print(f"database size: {db_size/1000000:.3f} MB")
+
+
+if __name__ == "__main__":
+    print("version 2")
+    asyncio.run(run_stake_record_store_benchmark(2))
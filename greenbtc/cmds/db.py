@@ -6,8 +6,17 @@ from typing import Optional
 import click
 
 from greenbtc.cmds.db_backup_func import db_backup_func
-from greenbtc.cmds.db_upgrade_func import db_upgrade_func
+from greenbtc.cmds.db_compress_func import db_compress_func
+from greenbtc.cmds.db_stats_func import DB_STATS_SORT_KEYS, db_stats_func
+from greenbtc.cmds.db_upgrade_func import (
+    balance_deltas_upgrade_func,
+    coin_indexes_upgrade_func,
+    compact_hints_func,
+    db_upgrade_func,
+    stake_indexes_upgrade_func,
+)
 from greenbtc.cmds.db_validate_func import db_validate_func
+from greenbtc.full_node.block_compression import DEFAULT_DICTIONARY_SIZE
 
 
 @click.group("db", help="Manage the blockchain database")
@@ -87,6 +96,109 @@ def db_upgrade_cmd(
     except RuntimeError as e:
         print(f"FAILED: {e}")
 
+
+@db_cmd.command("upgrade-stake-indexes", help="replace the stake record indexes of an older (v2) database")
+@click.option("--db", "in_db_path", default=None, type=click.Path(), help="Specifies which database file to upgrade")
+@click.pass_context
+def db_upgrade_stake_indexes_cmd(ctx: click.Context, in_db_path: Optional[str]) -> None:
+    try:
+        stake_indexes_upgrade_func(
+            Path(ctx.obj["root_path"]),
+            None if in_db_path is None else Path(in_db_path),
+        )
+    except RuntimeError as e:
+        print(f"FAILED: {e}")
+
+
+@db_cmd.command("upgrade-coin-indexes", help="add the coin record indexes of newer databases to an older (v2) one")
+@click.option("--db", "in_db_path", default=None, type=click.Path(), help="Specifies which database file to upgrade")
+@click.pass_context
+def db_upgrade_coin_indexes_cmd(ctx: click.Context, in_db_path: Optional[str]) -> None:
+    try:
+        coin_indexes_upgrade_func(
+            Path(ctx.obj["root_path"]),
+            None if in_db_path is None else Path(in_db_path),
+        )
+    except RuntimeError as e:
+        print(f"FAILED: {e}")
+
+
+@db_cmd.command(
+    "upgrade-balance-deltas", help="build the coin balance deltas of an older (v2) database, with the node stopped"
+)
+@click.option("--db", "in_db_path", default=None, type=click.Path(), help="Specifies which database file to upgrade")
+@click.pass_context
+def db_upgrade_balance_deltas_cmd(ctx: click.Context, in_db_path: Optional[str]) -> None:
+    try:
+        balance_deltas_upgrade_func(
+            Path(ctx.obj["root_path"]),
+            None if in_db_path is None else Path(in_db_path),
+        )
+    except RuntimeError as e:
+        print(f"FAILED: {e}")
+
+
+@db_cmd.command("compact-hints", help="convert the hints of a (v2) database to the smaller compact layout")
+@click.option("--db", "in_db_path", default=None, type=click.Path(), help="Specifies which database file to convert")
+@click.option("--no-vacuum", default=False, is_flag=True, help="don't VACUUM the database after converting")
+@click.pass_context
+def db_compact_hints_cmd(ctx: click.Context, in_db_path: Optional[str], no_vacuum: bool) -> None:
+    try:
+        compact_hints_func(
+            Path(ctx.obj["root_path"]),
+            None if in_db_path is None else Path(in_db_path),
+            vacuum=not no_vacuum,
+        )
+    except RuntimeError as e:
+        print(f"FAILED: {e}")
+
+
+@db_cmd.command(
+    "compress-blocks",
+    help="train a compression dictionary and re-compress the blocks of a (v2) database. Training requires the"
+    " optional zstandard package (pip install greenbtc-blockchain[compression]), and so does every node opening the"
+    " database once it holds a dictionary. Without it, only --no-train is available",
+)
+@click.option("--db", "in_db_path", default=None, type=click.Path(), help="Specifies which database file to compress")
+@click.option("--level", default=None, type=int, help="zstd level, defaults to full_node.block_compression_level")
+@click.option(
+    "--no-train",
+    default=False,
+    is_flag=True,
+    help="re-compress with the current dictionary, if any. Doesn't need zstandard if there is none",
+)
+@click.option("--samples", default=10000, type=int, help="number of random blocks to train the dictionary on")
+@click.option("--dict-size", default=DEFAULT_DICTIONARY_SIZE, type=int, help="size of the dictionary, in bytes")
+@click.option(
+    "--force",
+    default=False,
+    is_flag=True,
+    help="also re-compress blocks already using the current dictionary, to apply a new level",
+)
+@click.pass_context
+def db_compress_blocks_cmd(
+    ctx: click.Context,
+    in_db_path: Optional[str],
+    level: Optional[int],
+    no_train: bool,
+    samples: int,
+    dict_size: int,
+    force: bool,
+) -> None:
+    try:
+        db_compress_func(
+            Path(ctx.obj["root_path"]),
+            None if in_db_path is None else Path(in_db_path),
+            level=level,
+            train=not no_train,
+            samples=samples,
+            dict_size=dict_size,
+            force=force,
+        )
+    except RuntimeError as e:
+        print(f"FAILED: {e}")
+
+
 @db_cmd.command("validate", help="validate the (v2) blockchain database. Does not verify proofs")
 @click.option("--db", "in_db_path", default=None, type=click.Path(), help="Specifies which database file to validate")
 @click.option(
@@ -120,3 +232,22 @@ def db_backup_cmd(ctx: click.Context, db_backup_file: Optional[str], no_indexes:
         )
     except RuntimeError as e:
         print(f"FAILED: {e}")
+
+
+@db_cmd.command("stats", help="show the SQL statements of the running full node taking the most time")
+@click.option(
+    "-p",
+    "--rpc-port",
+    help=(
+        "Set the port where the Full Node is hosting the RPC interface. "
+        "See the rpc_port under full_node in config.yaml"
+    ),
+    type=int,
+    default=None,
+)
+@click.option("--sort", default="total", type=click.Choice(sorted(DB_STATS_SORT_KEYS)), help="what to sort by")
+@click.option("--limit", default=20, type=int, help="number of statements to show")
+@click.option("--reset", default=False, is_flag=True, help="reset the stats after showing them")
+@click.pass_context
+def db_stats_cmd(ctx: click.Context, rpc_port: Optional[int], sort: str, limit: int, reset: bool) -> None:
+    db_stats_func(Path(ctx.obj["root_path"]), rpc_port, sort=sort, limit=limit, reset=reset)
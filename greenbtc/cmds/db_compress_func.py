@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import asyncio
+import sys
+from pathlib import Path
+from time import time
+from typing import Any, Dict, Optional
+
+from greenbtc.full_node.block_compression import DEFAULT_DICTIONARY_SIZE, zstandard
+from greenbtc.util.config import load_config
+from greenbtc.util.path import path_from_root
+
+# number of blocks re-compressed per transaction, so a running node isn't held up for long
+RECOMPRESS_BATCH_SIZE = 200
+
+
+def db_compress_func(
+    root_path: Path,
+    in_db_path: Optional[Path] = None,
+    *,
+    level: Optional[int] = None,
+    train: bool = True,
+    samples: int = 10000,
+    dict_size: int = DEFAULT_DICTIONARY_SIZE,
+    force: bool = False,
+) -> None:
+    config: Dict[str, Any] = load_config(root_path, "config.yaml")["full_node"]
+    if in_db_path is None:
+        db_path_replaced = config["database_path"].replace("CHALLENGE", config["selected_network"])
+        in_db_path = path_from_root(root_path, db_path_replaced)
+
+    if not in_db_path.exists():
+        raise RuntimeError(f"database file doesn't exist. {in_db_path}")
+
+    # once a dictionary is in the database, the node can't read the blocks compressed with it without zstandard.
+    # Check before anything is written, not only where the dictionary is trained
+    if train and zstandard is None:
+        raise RuntimeError(
+            "training a block compression dictionary requires the zstandard package, and every node opening the"
+            " database afterwards needs it too. Install it with: pip install greenbtc-blockchain[compression]"
+            " or re-compress without a dictionary using --no-train"
+        )
+
+    if level is None:
+        level = config.get("block_compression_level", 3)
+
+    asyncio.run(compress_blocks(in_db_path, level, train, samples, dict_size, force))
+
+
+async def compress_blocks(db_path: Path, level: int, train: bool, samples: int, dict_size: int, force: bool) -> None:
+    from greenbtc.full_node.block_compression import train_dictionary
+    from greenbtc.full_node.block_store import BlockStore
+    from greenbtc.util.db_wrapper import DBWrapper2
+
+    print(f"compressing blocks of {db_path} at level {level}")
+    async with DBWrapper2.managed(db_path, db_version=2, reader_count=1) as db_wrapper:
+        block_store = await BlockStore.create(db_wrapper, use_cache=False, compression_level=level)
+
+        if train:
+            print(f"[1/2] training a {dict_size} byte dictionary on {samples} blocks")
+            start_time = time()
+            dictionary = train_dictionary(await block_store.get_compression_samples(samples), dict_size)
+            dictionary_id = await block_store.add_compression_dictionary(dictionary)
+            print(f"      dictionary {dictionary_id}, {time() - start_time:.2f} seconds")
+        else:
+            print("[1/2] skipping dictionary training")
+
+        # this can run next to the full node, which picks up the dictionary as soon as it reads a block compressed
+        # with it. If interrupted, run it again, blocks that have been re-compressed already are skipped
+        print("[2/2] re-compressing blocks")
+        start_time = time()
+        start = 1
+        rewritten = 0
+        while True:
+            start, count = await block_store.recompress_blocks(start, RECOMPRESS_BATCH_SIZE, force=force)
+            rewritten += count
+            print(f"\r      {rewritten} blocks", end="")
+            sys.stdout.flush()
+            if start == 0:
+                break
+        print(f"\n      {time() - start_time:.2f} seconds")
+        print("the file won't shrink until the database is vacuumed")
@@ -0,0 +1,45 @@
+from __future__ import annotations
+
+import asyncio
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from greenbtc.cmds.cmds_util import get_any_service_client
+from greenbtc.rpc.full_node_rpc_client import FullNodeRpcClient
+
+# the keys of the statement stats the output can be sorted by
+DB_STATS_SORT_KEYS = {"total": "total_ms", "count": "count", "mean": "mean_ms", "p99": "p99_ms", "rows": "rows"}
+
+
+def db_stats_func(
+    root_path: Path,
+    rpc_port: Optional[int] = None,
+    *,
+    sort: str = "total",
+    limit: int = 20,
+    reset: bool = False,
+) -> None:
+    asyncio.run(print_db_stats(root_path, rpc_port, sort, limit, reset))
+
+
+async def print_db_stats(root_path: Path, rpc_port: Optional[int], sort: str, limit: int, reset: bool) -> None:
+    async with get_any_service_client(FullNodeRpcClient, rpc_port, root_path) as (client, _):
+        statements: List[Dict[str, Any]] = await client.get_db_query_stats(reset=reset)
+
+    if len(statements) == 0:
+        print("no queries recorded")
+        return
+
+    key = DB_STATS_SORT_KEYS[sort]
+    statements.sort(key=lambda entry: -entry[key])
+    print(f"{'count':>10} {'total ms':>12} {'mean ms':>9} {'p99 ms':>9} {'max ms':>9} {'rows':>10}")
+    for entry in statements[:limit]:
+        print(
+            f"{entry['count']:>10} {entry['total_ms']:>12.1f} {entry['mean_ms']:>9.2f} {entry['p99_ms']:>9.2f} "
+            f"{entry['max_ms']:>9.1f} {entry['rows']:>10}"
+        )
+        origins = ", ".join(f"{origin} ({count})" for origin, count in list(entry["origins"].items())[:3])
+        print(f"    from: {origins}")
+        print(f"    {entry['statement']}")
+    if reset:
+        print("the stats have been reset")
@@ -7,8 +7,15 @@ import sys
 import textwrap
 from pathlib import Path
 from time import time
-from typing import Any, Dict, Optional
-
+from typing import Any, Dict, Optional, Tuple
+
+from greenbtc.full_node.coin_store import (
+    COIN_BALANCE_DELTA_INDEX,
+    COIN_BALANCE_DELTA_TABLE,
+    COIN_PUZZLE_HASH_HEIGHT_INDEX,
+)
+from greenbtc.full_node.hint_store import COIN_HINTS_TABLE, HINT_VALUES_TABLE
+from greenbtc.full_node.stake_record_store import LEGACY_STAKE_RECORD_INDEXES, STAKE_RECORD_INDEXES
 from greenbtc.types.blockchain_format.sized_bytes import bytes32
 from greenbtc.util.config import load_config, lock_and_load_config, save_config
 from greenbtc.util.ints import uint32
@@ -110,6 +117,196 @@ def db_upgrade_func(
     print(f"\n\nLEAVING PREVIOUS DB FILE UNTOUCHED {in_db_path}\n")
 
 
+# replaces the single column stake_record indexes of older versions with the
+# composite ones. The full node does the same on startup, this lets it be done
+# up front, with the node stopped
+def stake_indexes_upgrade_func(root_path: Path, db_path: Optional[Path] = None) -> None:
+    import sqlite3
+    from contextlib import closing
+
+    if db_path is None:
+        config = load_config(root_path, "config.yaml")["full_node"]
+        db_path_replaced = config["database_path"].replace("CHALLENGE", config["selected_network"])
+        db_path = path_from_root(root_path, db_path_replaced)
+
+    if not db_path.exists():
+        raise RuntimeError(f"database file doesn't exist. {db_path}")
+
+    print(f"upgrading stake record indexes of {db_path}")
+    with closing(sqlite3.connect(db_path)) as db:
+        db.execute("pragma journal_mode=wal")
+        db.execute("pragma synchronous=OFF")
+
+        table = db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='stake_record'").fetchone()
+        if table is None:
+            print("database has no stake records, nothing to do")
+            return
+
+        existing = {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+        for name, definition in STAKE_RECORD_INDEXES:
+            if name in existing:
+                continue
+            print(f"      creating {name}", end="")
+            sys.stdout.flush()
+            start_time = time()
+            db.execute(f"CREATE INDEX {name} on {definition}")
+            db.commit()
+            print(f" {time() - start_time:.2f} seconds")
+
+        # the node queries the legacy indexes until all the new ones exist, so they're only dropped after. If this
+        # is interrupted, run it again
+        for name in LEGACY_STAKE_RECORD_INDEXES:
+            if name in existing:
+                print(f"      dropping {name}")
+                db.execute(f"DROP INDEX {name}")
+                db.commit()
+
+
+def coin_indexes_upgrade_func(root_path: Path, db_path: Optional[Path] = None) -> None:
+    import sqlite3
+    from contextlib import closing
+
+    if db_path is None:
+        config = load_config(root_path, "config.yaml")["full_node"]
+        db_path_replaced = config["database_path"].replace("CHALLENGE", config["selected_network"])
+        db_path = path_from_root(root_path, db_path_replaced)
+
+    if not db_path.exists():
+        raise RuntimeError(f"database file doesn't exist. {db_path}")
+
+    print(f"upgrading coin record indexes of {db_path}")
+    with closing(sqlite3.connect(db_path)) as db:
+        db.execute("pragma journal_mode=wal")
+        db.execute("pragma synchronous=OFF")
+
+        table = db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='coin_record'").fetchone()
+        if table is None:
+            print("database has no coin records, nothing to do")
+            return
+
+        existing = {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+        name, definition = COIN_PUZZLE_HASH_HEIGHT_INDEX
+        if name not in existing:
+            print(f"      creating {name}", end="")
+            sys.stdout.flush()
+            start_time = time()
+            db.execute(f"CREATE INDEX {name} on {definition}")
+            db.commit()
+            print(f" {time() - start_time:.2f} seconds")
+
+
+# number of (puzzle hash, height) deltas balance_deltas_upgrade_func accumulates in memory before writing them
+BALANCE_DELTA_BATCH_SIZE = 100000
+
+
+def balance_deltas_upgrade_func(root_path: Path, db_path: Optional[Path] = None) -> None:
+    import sqlite3
+    from contextlib import closing
+
+    if db_path is None:
+        config = load_config(root_path, "config.yaml")["full_node"]
+        db_path_replaced = config["database_path"].replace("CHALLENGE", config["selected_network"])
+        db_path = path_from_root(root_path, db_path_replaced)
+
+    if not db_path.exists():
+        raise RuntimeError(f"database file doesn't exist. {db_path}")
+
+    print(f"building coin balance deltas of {db_path}")
+    with closing(sqlite3.connect(db_path)) as db:
+        db.execute("pragma journal_mode=wal")
+        db.execute("pragma synchronous=OFF")
+
+        table = db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='coin_record'").fetchone()
+        if table is None:
+            print("database has no coin records, nothing to do")
+            return
+        table = db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='coin_balance_delta'").fetchone()
+        if table is not None:
+            print("database already has coin balance deltas, nothing to do")
+            return
+
+        def add_deltas(deltas: Dict[Tuple[bytes32, int], int]) -> None:
+            db.executemany(
+                "INSERT INTO coin_balance_delta VALUES(?, ?, ?) "
+                "ON CONFLICT(puzzle_hash, height) DO UPDATE SET delta=delta+excluded.delta",
+                [(puzzle_hash, height, delta) for (puzzle_hash, height), delta in deltas.items() if delta != 0],
+            )
+
+        start_time = time()
+        # the table is only created along with its content, so an interrupted run leaves the database as it was
+        db.execute("BEGIN")
+        db.execute(COIN_BALANCE_DELTA_TABLE)
+        total = db.execute("SELECT MAX(rowid) FROM coin_record").fetchone()[0] or 0
+        deltas: Dict[Tuple[bytes32, int], int] = {}
+        count = 0
+        for confirmed_index, spent_index, puzzle_hash, amount in db.execute(
+            "SELECT confirmed_index, spent_index, puzzle_hash, amount FROM coin_record"
+        ):
+            amount = int.from_bytes(amount, "big")
+            deltas[(puzzle_hash, confirmed_index)] = deltas.get((puzzle_hash, confirmed_index), 0) + amount
+            if spent_index > 0:
+                deltas[(puzzle_hash, spent_index)] = deltas.get((puzzle_hash, spent_index), 0) - amount
+            if len(deltas) >= BALANCE_DELTA_BATCH_SIZE:
+                add_deltas(deltas)
+                deltas = {}
+            count += 1
+            if count % 1000000 == 0:
+                print(f"\r      {count} of about {total} coin records", end="")
+                sys.stdout.flush()
+        add_deltas(deltas)
+        print(f"\r      {count} coin records")
+        print("      creating coin_balance_delta_height", end="")
+        sys.stdout.flush()
+        db.execute(COIN_BALANCE_DELTA_INDEX)
+        db.commit()
+        print(f" {time() - start_time:.2f} seconds")
+
+
+def compact_hints_func(root_path: Path, db_path: Optional[Path] = None, *, vacuum: bool = True) -> None:
+    import sqlite3
+    from contextlib import closing
+
+    if db_path is None:
+        config = load_config(root_path, "config.yaml")["full_node"]
+        db_path_replaced = config["database_path"].replace("CHALLENGE", config["selected_network"])
+        db_path = path_from_root(root_path, db_path_replaced)
+
+    if not db_path.exists():
+        raise RuntimeError(f"database file doesn't exist. {db_path}")
+
+    print(f"compacting hints of {db_path}")
+    with closing(sqlite3.connect(db_path)) as db:
+        db.execute("pragma journal_mode=wal")
+        db.execute("pragma synchronous=OFF")
+
+        table = db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='hints'").fetchone()
+        if table is None:
+            print("database has no hints table, nothing to do")
+            return
+
+        start_time = time()
+        print("[1/3] collecting distinct hints")
+        db.execute(HINT_VALUES_TABLE)
+        db.execute("INSERT OR IGNORE INTO hint_values(hint) SELECT hint FROM hints ORDER BY hint")
+        print("[2/3] converting hints")
+        db.execute(COIN_HINTS_TABLE)
+        db.execute(
+            "INSERT OR IGNORE INTO coin_hints SELECT hint_values.id, hints.coin_id "
+            "FROM hints JOIN hint_values ON hints.hint=hint_values.hint"
+        )
+        db.execute("DROP TABLE hints")
+        db.commit()
+        print(f"      {time() - start_time:.2f} seconds")
+
+        if vacuum:
+            print("[3/3] vacuuming")
+            start_time = time()
+            db.execute("VACUUM")
+            print(f"      {time() - start_time:.2f} seconds")
+        else:
+            print("[3/3] skipping vacuum, the file won't shrink until it's vacuumed")
+
+
 BLOCK_COMMIT_RATE = 10000
 SES_COMMIT_RATE = 2000
 HINT_COMMIT_RATE = 2000
@@ -410,8 +410,10 @@ def greenbtc_init(
         db_path = path_from_root(root_path, db_path_replaced)
         db_path.parent.mkdir(parents=True, exist_ok=True)
         try:
-            # create new v2 db file
+            # create new v2 db file. Free pages can only be released while the
+            # node runs if auto_vacuum is set before the first table is created
             with sqlite3.connect(db_path) as connection:
+                connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
                 set_db_version(connection, 2)
         except sqlite3.OperationalError:
             # db already exists, so we're good
@@ -93,7 +93,9 @@ async def validate_block_body(
     npc_result: Optional[NPCResult],
     fork_info: ForkInfo,
     get_block_generator: Callable[[BlockInfo], Awaitable[Optional[BlockGenerator]]],
-    get_stake_farm_records: Callable[[bytes32, uint32, uint64], Awaitable[Dict[bytes32, int]]],
+    get_stake_farm_records: Callable[
+        [List[Tuple[bytes32, uint32]], uint64], Awaitable[Dict[Tuple[bytes32, uint32], Dict[bytes32, int]]]
+    ],
     get_stake_lock_records: Callable[[uint64, uint64], Awaitable[Dict[bytes32, int]]],
     *,
     validate_signature: bool = True,
@@ -183,16 +185,11 @@ async def validate_block_body(
         expected_reward_coins.add(pool_coin)
         expected_reward_coins.add(farmer_coin)
 
+        # (farm_puzzle_hash, height) of the blocks whose stake farm rewards are paid out by this block. They all
+        # use the timestamp of the previous transaction block, so they are looked up in one batch
+        stake_farms: List[Tuple[bytes32, uint32]] = []
         if prev_transaction_block_height > constants.HARD_FORK2_HEIGHT:
-            stake_records = await get_stake_farm_records(
-                prev_transaction_block.farm_puzzle_hash,
-                prev_transaction_block_height,
-                prev_transaction_block_timestamp,
-            )
-            if len(stake_records) > 0:
-                expected_reward_coins.update(
-                    create_stake_farm_rewards(constants, stake_records, prev_transaction_block_height)
-                )
+            stake_farms.append((prev_transaction_block.farm_puzzle_hash, prev_transaction_block_height))
 
         # For the second block in the chain, don't go back further
         if prev_transaction_block.height > 0:
@@ -217,15 +214,7 @@ async def validate_block_body(
                 )
 
                 if curr_b.height > constants.HARD_FORK2_HEIGHT:
-                    stake_records = await get_stake_farm_records(
-                        curr_b.farm_puzzle_hash,
-                        curr_b.height,
-                        prev_transaction_block_timestamp,
-                    )
-                    if len(stake_records) > 0:
-                        expected_reward_coins.update(
-                            create_stake_farm_rewards(constants, stake_records, curr_b.height)
-                        )
+                    stake_farms.append((curr_b.farm_puzzle_hash, curr_b.height))
 
                 curr_b = await blocks.get_block_record_from_db(curr_b.prev_hash)
                 assert curr_b is not None
@@ -240,6 +229,13 @@ async def validate_block_body(
                         create_stake_lock_rewards(constants, stake_records, prev_transaction_block_height)
                     )
 
+        if len(stake_farms) > 0:
+            stake_farm_records = await get_stake_farm_records(stake_farms, prev_transaction_block_timestamp)
+            for stake_farm in stake_farms:
+                stake_records = stake_farm_records[stake_farm]
+                if len(stake_records) > 0:
+                    expected_reward_coins.update(create_stake_farm_rewards(constants, stake_records, stake_farm[1]))
+
     if set(block.transactions_info.reward_claims_incorporated) != expected_reward_coins:
         return Err.INVALID_REWARD_COINS, None
 
@@ -12,7 +12,7 @@ from concurrent.futures.process import ProcessPoolExecutor
 from enum import Enum
 from multiprocessing.context import BaseContext
 from pathlib import Path
-from typing import Dict, List, Optional, Set, Tuple
+from typing import Dict, List, Optional, Set, Tuple, Union
 
 from chia_rs import G1Element
 
@@ -21,7 +21,7 @@ from greenbtc.consensus.block_header_validation import validate_unfinished_heade
 from greenbtc.consensus.block_record import BlockRecord
 from greenbtc.consensus.block_rewards import MOJO_PER_GBTC
 from greenbtc.consensus.blockchain_interface import BlockchainInterface
-from greenbtc.consensus.coinbase import create_puzzlehash_for_pk
+from greenbtc.consensus.coinbase import batch_create_puzzlehash_for_pk
 from greenbtc.consensus.constants import ConsensusConstants
 from greenbtc.consensus.cost_calculator import NPCResult
 from greenbtc.consensus.difficulty_adjustment import get_next_sub_slot_iters_and_difficulty
@@ -37,6 +37,7 @@ from greenbtc.full_node.block_height_map import BlockHeightMap
 from greenbtc.full_node.block_store import BlockStore
 from greenbtc.full_node.coin_store import CoinStore
 from greenbtc.full_node.mempool_check_conditions import get_name_puzzle_conditions, get_spends_for_block
+from greenbtc.full_node.stake_coefficient_engine import StakeCoefficientEngine
 from greenbtc.full_node.stake_record_store import StakeRecordStore
 from greenbtc.types.block_protocol import BlockInfo
 from greenbtc.types.blockchain_format.coin import Coin
@@ -52,21 +53,36 @@ from greenbtc.types.generator_types import BlockGenerator
 from greenbtc.types.header_block import HeaderBlock
 from greenbtc.types.stake_record import StakeRecord
 from greenbtc.types.stake_value import get_stake_value, STAKE_PER_COEFFICIENT, STAKE_FARM_MIN, STAKE_LOCK_MIN, \
-    ProofOfStake
+    ProofOfStake, stake_reward_amounts
 from greenbtc.types.unfinished_block import UnfinishedBlock
 from greenbtc.types.unfinished_header_block import UnfinishedHeaderBlock
 from greenbtc.types.weight_proof import SubEpochChallengeSegment
+from greenbtc.util.augmented_chain import AugmentedBlockchain
 from greenbtc.util.errors import ConsensusError, Err
 from greenbtc.util.generator_tools import get_block_header, tx_removals_and_additions
 from greenbtc.util.hash import std_hash
+from greenbtc.util.height_cache import HeightCache
 from greenbtc.util.inline_executor import InlineExecutor
 from greenbtc.util.ints import uint16, uint32, uint64, uint128
+from greenbtc.util.lru_cache import LRUCache
 from greenbtc.util.priority_mutex import PriorityMutex
 from greenbtc.util.setproctitle import getproctitle, setproctitle
 from greenbtc.wallet.puzzles.stake.drivers import match_stake_puzzle_by_coin_spend
 
 log = logging.getLogger(__name__)
 
+# stake coefficients and network space estimates are cached for the heights
+# within this distance of the peak
+STAKE_CACHE_HEIGHTS = 52
+# default number of (height, stake puzzle hash) coefficients to cache. Farmers
+# ask for all their keys on every signage point, so this should cover the
+# number of farmer keys served times the heights farmers ask about
+STAKE_CACHE_SIZE = 100000
+
+# farmer public keys converted per process pool task when a farmer asks for many
+# new keys at once
+STAKE_PUZZLE_HASH_BATCH_SIZE = 256
+
 
 class AddBlockResult(Enum):
     """
@@ -118,6 +134,8 @@ class Blockchain(BlockchainInterface):
     block_store: BlockStore
     # Stake Store
     stake_record_store: StakeRecordStore
+    # Stake farm amounts as of the peak
+    stake_coefficient_engine: StakeCoefficientEngine
     # Used to verify blocks in parallel
     pool: Executor
     # Set holding seen compact proofs, in order to avoid duplicates.
@@ -125,10 +143,16 @@ class Blockchain(BlockchainInterface):
 
     # Whether blockchain is shut down or not
     _shut_down: bool
+    # set when adding a block failed while the coin store had changes in
+    # memory. The coin store is replayed before the next block is added
+    _coin_store_dirty: bool
 
     # staking cache
-    __height_in_stake_coefficients: Dict[uint32, Dict[bytes32, uint64]]
-    __height_in_network_space: Dict[uint32, uint128]
+    __height_in_stake_coefficients: HeightCache[bytes32, uint64]
+    # keyed by the block range the space is estimated over
+    __height_in_network_space: HeightCache[int, uint128]
+    # serialized farmer public key -> stake puzzle hash
+    __stake_puzzle_hashes: LRUCache[bytes, bytes32]
 
     # Lock to prevent simultaneous reads and writes
     priority_mutex: PriorityMutex[BlockchainMutexPriority]
@@ -145,6 +169,7 @@ class Blockchain(BlockchainInterface):
             multiprocessing_context: Optional[BaseContext] = None,
             *,
             single_threaded: bool = False,
+            stake_cache_size: int = STAKE_CACHE_SIZE,
     ) -> Blockchain:
         """
         Initializes a blockchain with the BlockRecords from disk, assuming they have all been
@@ -175,7 +200,12 @@ class Blockchain(BlockchainInterface):
         self.coin_store = coin_store
         self.block_store = block_store
         self.stake_record_store = stake_record_store
+        self.__height_in_stake_coefficients = HeightCache(stake_cache_size)
+        self.__height_in_network_space = HeightCache(STAKE_CACHE_HEIGHTS * 2)
+        self.stake_coefficient_engine = StakeCoefficientEngine(stake_record_store)
+        self.__stake_puzzle_hashes = LRUCache(10000)
         self._shut_down = False
+        self._coin_store_dirty = False
         await self._load_chain_from_store(blockchain_dir)
         self._seen_compact_proofs = set()
         return self
@@ -183,6 +213,7 @@ class Blockchain(BlockchainInterface):
     def shut_down(self) -> None:
         self._shut_down = True
         self.pool.shutdown(wait=True)
+        self.__height_map.close()
 
     async def _load_chain_from_store(self, blockchain_dir: Path) -> None:
         """
@@ -191,8 +222,8 @@ class Blockchain(BlockchainInterface):
         self.__height_map = await BlockHeightMap.create(blockchain_dir, self.block_store.db_wrapper)
         self.__block_records = {}
         self.__heights_in_cache = {}
-        self.__height_in_stake_coefficients = {}
-        self.__height_in_network_space = {}
+        self.__height_in_stake_coefficients = HeightCache(self.__height_in_stake_coefficients.capacity)
+        self.__height_in_network_space = HeightCache(self.__height_in_network_space.capacity)
         block_records, peak = await self.block_store.get_block_records_close_to_peak(self.constants.BLOCKS_CACHE_SIZE)
         for block in block_records.values():
             self.add_block_record(block)
@@ -206,6 +237,44 @@ class Blockchain(BlockchainInterface):
         self._peak_height = self.block_record(peak).height
         assert self.__height_map.contains_height(self._peak_height)
         assert not self.__height_map.contains_height(uint32(self._peak_height + 1))
+        await self.replay_coin_store()
+        await self.update_stake_coefficient_engine()
+
+    async def replay_coin_store(self) -> None:
+        """
+        With write-behind enabled on the CoinStore, blocks are committed before their coin changes are written to
+        the database. After a crash, or a failed write transaction, this re-applies the coin changes of the blocks
+        above the coin store checkpoint, up to the peak.
+        """
+        if self.coin_store.overlay is None and not self.coin_store.checkpointed:
+            self._coin_store_dirty = False
+            return
+        checkpoint = await self.coin_store.discard_write_behind()
+        if checkpoint is None:
+            self._coin_store_dirty = False
+            return
+        peak_height = -1 if self._peak_height is None else self._peak_height
+        log.info(f"Replaying coin store from height {checkpoint + 1} to {peak_height}")
+        async with self.block_store.db_wrapper.writer():
+            for height in range(checkpoint + 1, peak_height + 1):
+                header_hash = self.height_to_hash(uint32(height))
+                assert header_hash is not None
+                block = await self.block_store.get_full_block(header_hash)
+                assert block is not None
+                if not block.is_transaction_block():
+                    continue
+                assert block.foliage_transaction_block is not None
+                tx_removals, tx_additions, _, _ = await self.get_tx_removals_and_additions(block)
+                await self.coin_store.new_block(
+                    block.height,
+                    block.foliage_transaction_block.timestamp,
+                    block.get_included_reward_coins(),
+                    tx_additions,
+                    tx_removals,
+                )
+            if self.coin_store.overlay is None:
+                await self.coin_store.stop_write_behind()
+        self._coin_store_dirty = False
 
     def get_peak(self) -> Optional[BlockRecord]:
         """
@@ -323,6 +392,9 @@ class Blockchain(BlockchainInterface):
         if block.height == 0 and block.prev_header_hash != self.constants.GENESIS_CHALLENGE:
             return AddBlockResult.INVALID_BLOCK, Err.INVALID_PREV_BLOCK_HASH, None
 
+        if self._coin_store_dirty:
+            await self.replay_coin_store()
+
         peak = self.get_peak()
         genesis: bool = block.height == 0
         extending_main_chain: bool = genesis or peak is None or (block.prev_header_hash == peak.header_hash)
@@ -438,8 +510,7 @@ class Blockchain(BlockchainInterface):
                 block.proof_of_stake,
                 block.reward_chain_block.proof_of_space.farmer_public_key,
         ):
-            if block.proof_of_stake.height in self.__height_in_stake_coefficients:
-                self.__height_in_stake_coefficients[block.proof_of_stake.height].clear()
+            self.__height_in_stake_coefficients.remove_height(block.proof_of_stake.height)
             log.error(f"validate block height {block.height} stake coefficient error")
             return AddBlockResult.INVALID_BLOCK, Err.INVALID_STAKE_COEFFICIENT, None
 
@@ -454,7 +525,7 @@ class Blockchain(BlockchainInterface):
             npc_result,
             fork_info,
             self.get_block_generator,
-            self.get_stake_farm_records,
+            self.get_stake_farm_records_batch,
             self.get_stake_lock_records,
             # If we did not already validate the signature, validate it now
             validate_signature=not pre_validation_result.validated_signature,
@@ -503,6 +574,8 @@ class Blockchain(BlockchainInterface):
             # there's a suspension point here, as we leave the async context
             # manager
 
+            self.stake_record_store.commit_totals()
+
             # make sure to update _peak_height after the transaction is committed,
             # otherwise other tasks may go look for this block before it's available
             if state_change_summary is not None:
@@ -520,7 +593,14 @@ class Blockchain(BlockchainInterface):
 
         except BaseException as e:
             self.block_store.rollback_cache_block(header_hash)
+            self.stake_coefficient_engine.reset()
+            self.stake_record_store.reset_caches()
             self._peak_height = previous_peak_height
+            # the replay writes many blocks, so it's left to the next
+            # add_block (or the next start), not done while handling this
+            # error, which may be a cancellation
+            self.coin_store.drop_overlay()
+            self._coin_store_dirty = True
             log.error(
                 f"Error while adding block {header_hash} height {block.height},"
                 f" rolling back: {traceback.format_exc()} {e}"
@@ -531,6 +611,7 @@ class Blockchain(BlockchainInterface):
         await self.__height_map.maybe_flush()
 
         if state_change_summary is not None:
+            await self.update_stake_coefficient_engine()
             # new coin records added
             return AddBlockResult.NEW_PEAK, None, state_change_summary
         else:
@@ -586,16 +667,12 @@ class Blockchain(BlockchainInterface):
             return [], None
 
         if block_record.prev_hash != peak.header_hash:
-            heights_to_delete = []
-            for space_height in self.__height_in_network_space.keys():
-                if space_height > fork_info.fork_height:
-                    heights_to_delete.append(space_height)
-            for height in heights_to_delete:
-                del self.__height_in_network_space[height]
-                self.__height_in_stake_coefficients[height].clear()
+            self.__height_in_network_space.rollback(fork_info.fork_height)
+            self.__height_in_stake_coefficients.rollback(fork_info.fork_height)
             for coin_record in await self.coin_store.rollback_to_block(fork_info.fork_height):
                 rolled_back_state[coin_record.name] = coin_record
             await self.stake_record_store.rollback_to_block(fork_info.fork_height)
+            self.stake_coefficient_engine.rollback(fork_info.fork_height)
 
         # Collects all blocks from fork point to new peak
         blocks_to_add: List[Tuple[FullBlock, BlockRecord]] = []
@@ -689,6 +766,7 @@ class Blockchain(BlockchainInterface):
                 tx_stake_additions,
                 tx_removals,
             )
+            self.stake_coefficient_engine.add_records(tx_stake_additions)
 
         # we made it to the end successfully
         # Rollback sub_epoch_summaries
@@ -907,7 +985,7 @@ class Blockchain(BlockchainInterface):
             npc_result,
             fork_info,
             self.get_block_generator,
-            self.get_stake_farm_records,
+            self.get_stake_farm_records_batch,
             self.get_stake_lock_records,
             validate_signature=False,  # Signature was already validated before calling this method, no need to validate
         )
@@ -925,15 +1003,19 @@ class Blockchain(BlockchainInterface):
             wp_summaries: Optional[List[SubEpochSummary]] = None,
             *,
             validate_signatures: bool,
+            augmented_chain: Optional[AugmentedBlockchain] = None,
     ) -> List[PreValidationResult]:
+        # the blocks are validated against augmented_chain, if their ancestors
+        # are pre-validated but not added yet
+        chain: Union[Blockchain, AugmentedBlockchain] = self if augmented_chain is None else augmented_chain
         return await pre_validate_blocks_multiprocessing(
             self.constants,
-            self,
+            chain,
             blocks,
             self.pool,
             True,
             npc_results,
-            self.get_block_generator,
+            chain.get_block_generator,
             batch_size,
             wp_summaries,
             validate_signatures=validate_signatures,
@@ -1042,14 +1124,8 @@ class Blockchain(BlockchainInterface):
         if self._peak_height - self.constants.BLOCKS_CACHE_SIZE < 0:
             return None
         self.clean_block_record(self._peak_height - self.constants.BLOCKS_CACHE_SIZE)
-        if len(self.__height_in_network_space) > 52:
-            heights_to_delete = []
-            for space_height in self.__height_in_network_space.keys():
-                if space_height < self._peak_height - 52:
-                    heights_to_delete.append(space_height)
-            for height in heights_to_delete:
-                del self.__height_in_network_space[height]
-                self.__height_in_stake_coefficients[height].clear()
+        self.__height_in_network_space.prune(self._peak_height - STAKE_CACHE_HEIGHTS)
+        self.__height_in_stake_coefficients.prune(self._peak_height - STAKE_CACHE_HEIGHTS)
 
     async def get_block_records_in_range(self, start: int, stop: int) -> Dict[bytes32, BlockRecord]:
         return await self.block_store.get_block_records_in_range(start, stop)
@@ -1307,7 +1383,7 @@ class Blockchain(BlockchainInterface):
             block_range: int,
             height: uint32,
     ) -> uint128:
-        network_space: Optional[uint128] = self.__height_in_network_space.get(height)
+        network_space: Optional[uint128] = self.__height_in_network_space.get(height, block_range)
         if network_space is None:
             if height is not None and height > 1:
                 # Average over the last day
@@ -1318,9 +1394,19 @@ class Blockchain(BlockchainInterface):
                 network_space = await self._get_network_space(0.762, newer_block_bytes, older_block_bytes)
             else:
                 network_space = uint128(0)
-            self.__height_in_network_space[height] = network_space
+            self.__height_in_network_space.put(height, block_range, network_space)
         return network_space
 
+    async def update_stake_coefficient_engine(self) -> None:
+        peak = self.get_peak()
+        if peak is None:
+            return
+        curr = peak
+        while not curr.is_transaction_block:
+            curr = self.block_record(curr.prev_hash)
+        assert curr.timestamp is not None
+        await self.stake_coefficient_engine.set_peak(curr.height, curr.timestamp)
+
     async def get_stake_coefficient_old(self, height: uint32, stake_puzzle_hash: bytes32) -> uint64:
         coefficient = 20
         if height > 2:
@@ -1343,52 +1429,120 @@ class Blockchain(BlockchainInterface):
         return uint64(int(coefficient * STAKE_PER_COEFFICIENT))
 
     async def get_stake_coefficient_new(self, height: uint32, stake_puzzle_hash: bytes32) -> uint64:
+        return (await self.get_stake_coefficients_new(height, [stake_puzzle_hash]))[stake_puzzle_hash]
+
+    async def get_stake_coefficients_new(
+            self, height: uint32, stake_puzzle_hashes: List[bytes32]
+    ) -> Dict[bytes32, uint64]:
         header_hash = self.height_to_hash(height)
         assert header_hash is not None
         curr = self.block_record(header_hash)
         while curr is not None and not curr.is_transaction_block:
             curr = self.block_record(curr.prev_hash)
         block_range = 4608 * 14
-        blocks = self.__height_map.get_height_farm_count(
-            height - block_range,
-            height,
-            stake_puzzle_hash,
-        )
-        stake_records = await self.stake_record_store.get_stake_farm_records_thin(
-            stake_puzzle_hash, curr.height, curr.timestamp
-        )
-
-        stake_amount = sum(
-            get_stake_value(stake.stake_type, stake.is_stake_farm).reward_amount(stake.amount)
-            for stake in stake_records
-        )
         network_space = await self.get_stake_height_network_space(4608, height)
 
-        space = int(network_space) * blocks / (block_range if height > block_range else height)
-        if network_space != 0 and stake_amount > 0:
-            if space == 0 or blocks == 0:
-                coefficient = 1
+        stake_amounts: Dict[bytes32, int] = {}
+        missing: List[bytes32] = []
+        for stake_puzzle_hash in stake_puzzle_hashes:
+            stake_amount = self.stake_coefficient_engine.get_stake_amount(
+                stake_puzzle_hash, curr.height, curr.timestamp
+            )
+            if stake_amount is None:
+                missing.append(stake_puzzle_hash)
+            else:
+                stake_amounts[stake_puzzle_hash] = stake_amount
+        if len(missing) > 0:
+            stake_records_dict = await self.stake_record_store.get_stake_farm_records_thin_by_puzzle_hashes(
+                missing, curr.height, curr.timestamp
+            )
+            for stake_puzzle_hash, stake_records in stake_records_dict.items():
+                stake_amounts[stake_puzzle_hash] = sum(
+                    stake_reward_amounts(
+                        [stake.amount for stake in stake_records], [stake.stake_type for stake in stake_records], True
+                    )
+                )
+
+        coefficients: Dict[bytes32, uint64] = {}
+        for stake_puzzle_hash in stake_puzzle_hashes:
+            blocks = self.__height_map.get_height_farm_count(
+                height - block_range,
+                height,
+                stake_puzzle_hash,
+            )
+            stake_amount = stake_amounts[stake_puzzle_hash]
+            space = int(network_space) * blocks / (block_range if height > block_range else height)
+            if network_space != 0 and stake_amount > 0:
+                if space == 0 or blocks == 0:
+                    coefficient = 1
+                else:
+                    coefficient = round(0.05 + 1 / (stake_amount / space / 10 + 0.05), 15)
             else:
-                coefficient = round(0.05 + 1 / (stake_amount / space / 10 + 0.05), 15)
+                coefficient = 20
+            coefficients[stake_puzzle_hash] = uint64(int(coefficient * STAKE_PER_COEFFICIENT))
+        return coefficients
+
+    async def get_stake_puzzle_hashes(self, farmer_public_keys: List[G1Element]) -> List[bytes32]:
+        """
+        Converts farmer public keys to stake puzzle hashes. Farmers ask for the same keys on every signage point,
+        so conversions are cached, and large batches of new keys are spread over the process pool.
+        """
+        pub_keys = [bytes(farmer_public_key) for farmer_public_key in farmer_public_keys]
+        missing = list({pub_key for pub_key in pub_keys if self.__stake_puzzle_hashes.get(pub_key) is None})
+        if len(missing) >= STAKE_PUZZLE_HASH_BATCH_SIZE * 2:
+            futures = [
+                asyncio.get_running_loop().run_in_executor(
+                    self.pool, batch_create_puzzlehash_for_pk, missing[i : i + STAKE_PUZZLE_HASH_BATCH_SIZE]
+                )
+                for i in range(0, len(missing), STAKE_PUZZLE_HASH_BATCH_SIZE)
+            ]
+            stake_puzzle_hashes = [ph for batch in await asyncio.gather(*futures) for ph in batch]
         else:
-            coefficient = 20
-        return uint64(int(coefficient * STAKE_PER_COEFFICIENT))
+            stake_puzzle_hashes = batch_create_puzzlehash_for_pk(missing)
+        for pub_key, stake_puzzle_hash in zip(missing, stake_puzzle_hashes):
+            self.__stake_puzzle_hashes.put(pub_key, stake_puzzle_hash)
+
+        result: List[bytes32] = []
+        for pub_key in pub_keys:
+            stake_puzzle_hash = self.__stake_puzzle_hashes.get(pub_key)
+            if stake_puzzle_hash is None:
+                # evicted by this very batch, when it is larger than the cache
+                stake_puzzle_hash = batch_create_puzzlehash_for_pk([pub_key])[0]
+            result.append(stake_puzzle_hash)
+        return result
 
     async def get_stake_coefficient(self, height: uint32, farmer_public_key: G1Element) -> uint64:
-        stake_puzzle_hash = create_puzzlehash_for_pk(farmer_public_key)
-        if height in self.__height_in_stake_coefficients and (
-            stake_puzzle_hash in self.__height_in_stake_coefficients[height]
-        ):
-            return self.__height_in_stake_coefficients[height][stake_puzzle_hash]
+        return (await self.get_stake_coefficients(height, [farmer_public_key]))[0]
+
+    async def get_stake_coefficients(self, height: uint32, farmer_public_keys: List[G1Element]) -> List[uint64]:
+        stake_puzzle_hashes = await self.get_stake_puzzle_hashes(farmer_public_keys)
+        height_coefficients: Dict[bytes32, uint64] = {}
+        missing: List[bytes32] = []
+        for stake_puzzle_hash in set(stake_puzzle_hashes):
+            coefficient = self.__height_in_stake_coefficients.get(height, stake_puzzle_hash)
+            if coefficient is None:
+                missing.append(stake_puzzle_hash)
+            else:
+                height_coefficients[stake_puzzle_hash] = coefficient
+        if len(missing) > 0:
+            if height > self.constants.HARD_FORK2_HEIGHT:
+                height_coefficients.update(await self.get_stake_coefficients_new(height, missing))
+            else:
+                for stake_puzzle_hash in missing:
+                    height_coefficients[stake_puzzle_hash] = await self.get_stake_coefficient_old(
+                        height, stake_puzzle_hash
+                    )
+            for stake_puzzle_hash in missing:
+                self.__height_in_stake_coefficients.put(
+                    height, stake_puzzle_hash, height_coefficients[stake_puzzle_hash]
+                )
+        return [height_coefficients[stake_puzzle_hash] for stake_puzzle_hash in stake_puzzle_hashes]
 
-        if height > self.constants.HARD_FORK2_HEIGHT:
-            stake_coefficient = await self.get_stake_coefficient_new(height, stake_puzzle_hash)
-        else:
-            stake_coefficient = await self.get_stake_coefficient_old(height, stake_puzzle_hash)
-        if height not in self.__height_in_stake_coefficients:
-            self.__height_in_stake_coefficients[height] = {}
-        self.__height_in_stake_coefficients[height][stake_puzzle_hash] = stake_coefficient
-        return stake_coefficient
+    def get_stake_cache_stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            "stake_coefficients": self.__height_in_stake_coefficients.stats(),
+            "network_space": self.__height_in_network_space.stats(),
+        }
 
     async def check_stake_coefficient(self, pos: ProofOfStake, farmer_public_key: G1Element) -> bool:
         coefficient = await self.get_stake_coefficient(pos.height, farmer_public_key)
@@ -1398,52 +1552,55 @@ class Blockchain(BlockchainInterface):
     async def get_stake_farm_records(
             self, stake_puzzle_hash: bytes32, height: uint32, timestamp: uint64
     ) -> Dict[bytes32, int]:
-        stake_records = await self.stake_record_store.get_stake_farm_records_thin(
-            stake_puzzle_hash, height, timestamp
-        )
-        stake_rewards: Dict[bytes32, int] = dict()
-        for stake in stake_records:
-            stake_rewards[stake.puzzle_hash] = stake_rewards.get(
-                stake.puzzle_hash, 0
-            ) + get_stake_value(stake.stake_type, stake.is_stake_farm).reward_amount(stake.amount)
-        return stake_rewards
+        return (await self.get_stake_farm_records_batch([(stake_puzzle_hash, height)], timestamp))[
+            (stake_puzzle_hash, height)
+        ]
+
+    async def get_stake_farm_records_batch(
+            self, farms: List[Tuple[bytes32, uint32]], timestamp: uint64
+    ) -> Dict[Tuple[bytes32, uint32], Dict[bytes32, int]]:
+        stake_records_dict = await self.stake_record_store.get_stake_farm_records_thin_by_heights(farms, timestamp)
+        stake_rewards_dict: Dict[Tuple[bytes32, uint32], Dict[bytes32, int]] = {}
+        for farm, stake_records in stake_records_dict.items():
+            amounts = stake_reward_amounts(
+                [stake.amount for stake in stake_records], [stake.stake_type for stake in stake_records], True
+            )
+            stake_rewards: Dict[bytes32, int] = dict()
+            for stake, amount in zip(stake_records, amounts):
+                stake_rewards[stake.puzzle_hash] = stake_rewards.get(stake.puzzle_hash, 0) + amount
+            stake_rewards_dict[farm] = stake_rewards
+        return stake_rewards_dict
 
     async def get_stake_farm_records_dict(
             self, transaction_block: BlockRecord
     ) -> Optional[Dict[bytes32, Dict[bytes32, int]]]:
-        stake_farm_records_dict: Dict[bytes32, Dict[bytes32, int]] = {}
         curr = transaction_block
         curr_timestamp = curr.timestamp
-        stake_farm_records_dict[curr.header_hash] = await self.get_stake_farm_records(
-            curr.farm_puzzle_hash,
-            curr.height,
-            curr_timestamp
-        )
+        assert curr_timestamp is not None
+        farms: Dict[bytes32, Tuple[bytes32, uint32]] = {curr.header_hash: (curr.farm_puzzle_hash, curr.height)}
         if curr.height > 0:
             curr = self.block_record(curr.prev_hash)
             # Prev block is not genesis
             while not curr.is_transaction_block:
-                stake_farm_records_dict[curr.header_hash] = await self.get_stake_farm_records(
-                    curr.farm_puzzle_hash,
-                    curr.height,
-                    curr_timestamp
-                )
+                farms[curr.header_hash] = (curr.farm_puzzle_hash, curr.height)
                 curr = self.block_record(curr.prev_hash)
-        return stake_farm_records_dict
+        stake_records = await self.get_stake_farm_records_batch(list(farms.values()), curr_timestamp)
+        return {header_hash: stake_records[farm] for header_hash, farm in farms.items()}
 
     async def get_stake_lock_records(
             self, start: uint64, end: uint64
     ) -> Optional[Dict[bytes32, int]]:
-        stake_records = await self.stake_record_store.get_stake_lock_records_thin(start, end)
+        stake_records = [
+            stake
+            for stake in await self.stake_record_store.get_stake_lock_records_thin(start, end)
+            if stake.expiration - get_stake_value(stake.stake_type, stake.is_stake_farm).time_lock not in (start, end)
+        ]
+        amounts = stake_reward_amounts(
+            [stake.amount for stake in stake_records], [stake.stake_type for stake in stake_records], False
+        )
         stake_rewards: Dict[bytes32, int] = dict()
-        for stake in stake_records:
-            value = get_stake_value(stake.stake_type, stake.is_stake_farm)
-            expiration = stake.expiration - value.time_lock
-            if start == expiration or end == expiration:
-                continue
-            stake_rewards[stake.stake_puzzle_hash] = stake_rewards.get(
-                stake.stake_puzzle_hash, 0
-            ) + value.reward_amount(stake.amount)
+        for stake, amount in zip(stake_records, amounts):
+            stake_rewards[stake.stake_puzzle_hash] = stake_rewards.get(stake.stake_puzzle_hash, 0) + amount
         return stake_rewards
 
     async def get_stake_farm_count(
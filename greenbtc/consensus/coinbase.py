@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+from typing import List
+
 from chia_rs import G1Element
 
 from greenbtc.types.blockchain_format.coin import Coin
@@ -12,6 +14,11 @@ def create_puzzlehash_for_pk(pub_key: G1Element) -> bytes32:
     return puzzle_hash_for_pk(pub_key)
 
 
+def batch_create_puzzlehash_for_pk(pub_keys: List[bytes]) -> List[bytes32]:
+    # takes serialized keys so batches can be sent to a process pool
+    return [puzzle_hash_for_pk(G1Element.from_bytes(pub_key)) for pub_key in pub_keys]
+
+
 def pool_parent_id(block_height: uint32, genesis_challenge: bytes32) -> bytes32:
     return bytes32(genesis_challenge[:16] + block_height.to_bytes(16, "big"))
 
@@ -2,9 +2,13 @@ from __future__ import annotations
 
 import asyncio
 import logging
+import os
+import shutil
 import traceback
 from concurrent.futures import Executor
+from concurrent.futures.process import ProcessPoolExecutor
 from dataclasses import dataclass
+from multiprocessing.shared_memory import SharedMemory
 from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
 
 from chia_rs import AugSchemeMPL, G1Element
@@ -37,6 +41,10 @@ from greenbtc.util.streamable import Streamable, streamable
 
 log = logging.getLogger(__name__)
 
+# blocks and block records to pre-validate are passed to the worker processes
+# in shared memory, rather than pickled, once there's at least this much of them
+SHARED_PAYLOAD_MIN_SIZE = 256 * 1024
+
 
 @streamable
 @dataclass(frozen=True)
@@ -62,6 +70,94 @@ def batch_pre_validate_blocks(
     blocks: Dict[bytes32, BlockRecord] = {}
     for k, v in blocks_pickled.items():
         blocks[bytes32(k)] = BlockRecord.from_bytes(v)
+    return _pre_validate_blocks(
+        constants,
+        blocks,
+        full_blocks_pickled,
+        header_blocks_pickled,
+        prev_transaction_generators,
+        npc_results,
+        check_filter,
+        expected_difficulty,
+        expected_sub_slot_iters,
+        validate_signatures,
+    )
+
+
+# the block records of the last shared memory segment a worker process read,
+# as (segment name, records). The chunks of a batch share the segment, so a
+# worker validating several of them parses the records once
+_shared_block_records: Optional[Tuple[str, Dict[bytes32, BlockRecord]]] = None
+
+
+def batch_pre_validate_blocks_shared(
+    constants: ConsensusConstants,
+    shared_memory_name: str,
+    block_record_spans: List[Tuple[int, int]],
+    full_block_spans: Optional[List[Tuple[int, int]]],
+    header_block_spans: Optional[List[Tuple[int, int]]],
+    prev_transaction_generator_spans: List[Optional[Tuple[int, int]]],
+    npc_results: Dict[uint32, bytes],
+    check_filter: bool,
+    expected_difficulty: List[uint64],
+    expected_sub_slot_iters: List[uint64],
+    validate_signatures: bool,
+) -> List[bytes]:
+    """
+    Like batch_pre_validate_blocks(), with the serialized blocks, block
+    records and generators read from the spans (start, end) of a shared
+    memory segment, instead of being pickled. Each span is still copied
+    once, into the bytes the streamable types are parsed from: parsing
+    goes through io.BytesIO, which copies a memoryview (but not bytes) it
+    is given, and no view into the segment may outlive segment.close()
+    """
+    global _shared_block_records
+    segment = SharedMemory(name=shared_memory_name)
+    try:
+        buf = segment.buf
+        records: Dict[bytes32, BlockRecord]
+        if _shared_block_records is not None and _shared_block_records[0] == shared_memory_name:
+            records = _shared_block_records[1]
+        else:
+            records = {}
+            for start, end in block_record_spans:
+                record = BlockRecord.from_bytes(bytes(buf[start:end]))
+                records[record.header_hash] = record
+            _shared_block_records = (shared_memory_name, records)
+        full_blocks = None if full_block_spans is None else [bytes(buf[s:e]) for s, e in full_block_spans]
+        header_blocks = None if header_block_spans is None else [bytes(buf[s:e]) for s, e in header_block_spans]
+        prev_generators = [
+            None if span is None else bytes(buf[span[0] : span[1]]) for span in prev_transaction_generator_spans
+        ]
+        del buf
+    finally:
+        segment.close()
+    return _pre_validate_blocks(
+        constants,
+        records,
+        full_blocks,
+        header_blocks,
+        prev_generators,
+        npc_results,
+        check_filter,
+        expected_difficulty,
+        expected_sub_slot_iters,
+        validate_signatures,
+    )
+
+
+def _pre_validate_blocks(
+    constants: ConsensusConstants,
+    blocks: Dict[bytes32, BlockRecord],
+    full_blocks_pickled: Optional[List[bytes]],
+    header_blocks_pickled: Optional[List[bytes]],
+    prev_transaction_generators: List[Optional[bytes]],
+    npc_results: Dict[uint32, bytes],
+    check_filter: bool,
+    expected_difficulty: List[uint64],
+    expected_sub_slot_iters: List[uint64],
+    validate_signatures: bool,
+) -> List[bytes]:
     results: List[PreValidationResult] = []
     if full_blocks_pickled is not None and header_blocks_pickled is not None:
         assert ValueError("Only one should be passed here")
@@ -316,9 +412,10 @@ async def pre_validate_blocks_multiprocessing(
     npc_results_pickled = {}
     for k, v in npc_results.items():
         npc_results_pickled[k] = bytes(v)
-    futures = []
     # Pool of workers to validate blocks concurrently
     recent_blocks_bytes = {bytes(k): bytes(v) for k, v in recent_blocks.items()}  # convert to bytes
+    # the blocks to validate in each worker, as (start index, end index, full blocks, header blocks, generators)
+    chunks: List[Tuple[int, int, Optional[List[bytes]], Optional[List[bytes]], List[Optional[bytes]]]] = []
     for i in range(0, len(blocks), batch_size):
         end_i = min(i + batch_size, len(blocks))
         blocks_to_validate = blocks[i:end_i]
@@ -358,29 +455,98 @@ async def pre_validate_blocks_multiprocessing(
                 if hb_pickled is None:
                     hb_pickled = []
                 hb_pickled.append(bytes(block))
+        chunks.append((i, end_i, b_pickled, hb_pickled, previous_generators))
+
+    # everything the workers need goes into one shared memory segment, in the order it's read back below
+    payload: List[bytes] = list(recent_blocks_bytes.values())
+    for _, _, b_pickled, hb_pickled, previous_generators in chunks:
+        payload.extend(b_pickled if b_pickled is not None else hb_pickled or [])
+        payload.extend(generator for generator in previous_generators if generator is not None)
+    shared = _create_shared_payload(pool, payload)
+
+    futures = []
+    try:
+        span_iter = iter([] if shared is None else shared[1])
+        record_spans = [next(span_iter) for _ in recent_blocks_bytes] if shared is not None else []
+        for i, end_i, b_pickled, hb_pickled, previous_generators in chunks:
+            expected_difficulty = [diff_ssis[j][0] for j in range(i, end_i)]
+            expected_sub_slot_iters = [diff_ssis[j][1] for j in range(i, end_i)]
+            if shared is None:
+                futures.append(
+                    asyncio.get_running_loop().run_in_executor(
+                        pool,
+                        batch_pre_validate_blocks,
+                        constants,
+                        recent_blocks_bytes,
+                        b_pickled,
+                        hb_pickled,
+                        previous_generators,
+                        npc_results_pickled,
+                        check_filter,
+                        expected_difficulty,
+                        expected_sub_slot_iters,
+                        validate_signatures,
+                    )
+                )
+            else:
+                block_spans = [next(span_iter) for _ in (b_pickled if b_pickled is not None else hb_pickled or [])]
+                generator_spans = [None if generator is None else next(span_iter) for generator in previous_generators]
+                futures.append(
+                    asyncio.get_running_loop().run_in_executor(
+                        pool,
+                        batch_pre_validate_blocks_shared,
+                        constants,
+                        shared[0].name,
+                        record_spans,
+                        block_spans if b_pickled is not None else None,
+                        block_spans if b_pickled is None and hb_pickled is not None else None,
+                        generator_spans,
+                        npc_results_pickled,
+                        check_filter,
+                        expected_difficulty,
+                        expected_sub_slot_iters,
+                        validate_signatures,
+                    )
+                )
+        batch_results = await asyncio.gather(*futures)
+    finally:
+        if shared is not None:
+            shared[0].close()
+            shared[0].unlink()
 
-        futures.append(
-            asyncio.get_running_loop().run_in_executor(
-                pool,
-                batch_pre_validate_blocks,
-                constants,
-                recent_blocks_bytes,
-                b_pickled,
-                hb_pickled,
-                previous_generators,
-                npc_results_pickled,
-                check_filter,
-                [diff_ssis[j][0] for j in range(i, end_i)],
-                [diff_ssis[j][1] for j in range(i, end_i)],
-                validate_signatures,
-            )
-        )
     # Collect all results into one flat list
-    return [
-        PreValidationResult.from_bytes(result)
-        for batch_result in (await asyncio.gather(*futures))
-        for result in batch_result
-    ]
+    return [PreValidationResult.from_bytes(result) for batch_result in batch_results for result in batch_result]
+
+
+def _create_shared_payload(
+    pool: Executor, payload: List[bytes]
+) -> Optional[Tuple[SharedMemory, List[Tuple[int, int]]]]:
+    """
+    Copies payload into a new shared memory segment, for the worker processes
+    of pool to read. Returns the segment and the span (start, end) of every
+    item, or None if the payload should be pickled instead
+    """
+    if not isinstance(pool, ProcessPoolExecutor):
+        return None
+    size = sum(len(item) for item in payload)
+    if size < SHARED_PAYLOAD_MIN_SIZE:
+        return None
+    # writing beyond the space left in /dev/shm kills the process with SIGBUS,
+    # instead of failing
+    if os.path.isdir("/dev/shm") and shutil.disk_usage("/dev/shm").free < 2 * size:
+        return None
+    try:
+        segment = SharedMemory(create=True, size=size)
+    except OSError as e:
+        log.warning(f"failed to create shared memory for block pre-validation: {e}")
+        return None
+    spans: List[Tuple[int, int]] = []
+    offset = 0
+    for item in payload:
+        segment.buf[offset : offset + len(item)] = item
+        spans.append((offset, offset + len(item)))
+        offset += len(item)
+    return segment, spans
 
 
 def _run_generator(
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import dataclasses
+import logging
+import sqlite3
+from typing import Any, Dict, List, Optional
+
+import zstd
+
+log = logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:
+    log.info(
+        "importing zstandard failed."
+        " This is not required to run greenbtc, it allows compressing blocks with a trained dictionary."
+    )
+    zstandard = None
+
+# the level the zstd package uses when none is given
+DEFAULT_BLOCK_COMPRESSION_LEVEL = 3
+
+# the zstd command line tool trains dictionaries of this size by default
+DEFAULT_DICTIONARY_SIZE = 112640
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def frame_dictionary_id(blob: bytes) -> int:
+    """
+    Returns the id of the dictionary the zstd frame in blob was compressed with, 0 if it was compressed without one
+    """
+    if len(blob) < 6 or blob[:4] != ZSTD_MAGIC:
+        return 0
+    descriptor = blob[4]
+    id_size = (0, 1, 2, 4)[descriptor & 3]
+    # the window descriptor is left out of single segment frames
+    start = 5 if descriptor & 0x20 else 6
+    return int.from_bytes(blob[start : start + id_size], "little")
+
+
+def train_dictionary(samples: List[bytes], dict_size: int = DEFAULT_DICTIONARY_SIZE) -> bytes:
+    if zstandard is None:
+        raise RuntimeError("training a block compression dictionary requires the zstandard package")
+    ret: bytes = zstandard.train_dictionary(dict_size, samples).as_bytes()
+    return ret
+
+
+@dataclasses.dataclass
+class BlockCompressor:
+    """
+    Compresses block blobs with zstd, using the most recently added dictionary if there is one. Blobs compressed
+    with any of the dictionaries, or with none, can be decompressed, since zstd frames record their dictionary id.
+    """
+
+    level: int = DEFAULT_BLOCK_COMPRESSION_LEVEL
+    # dictionary id -> decompressor
+    decompressors: Dict[int, Any] = dataclasses.field(default_factory=dict)
+    compressor: Optional[Any] = None
+    dictionary_id: int = 0
+
+    def add_dictionary(self, dictionary: bytes) -> int:
+        """
+        Makes dictionary the one new blobs are compressed with, and returns its id
+        """
+        if zstandard is None:
+            raise RuntimeError("the database has block compression dictionaries, which require the zstandard package")
+        compression_dict = zstandard.ZstdCompressionDict(dictionary)
+        dictionary_id: int = compression_dict.dict_id()
+        self.decompressors[dictionary_id] = zstandard.ZstdDecompressor(dict_data=compression_dict)
+        self.compressor = zstandard.ZstdCompressor(level=self.level, dict_data=compression_dict)
+        self.dictionary_id = dictionary_id
+        return dictionary_id
+
+    def has_dictionary(self, dictionary_id: int) -> bool:
+        return dictionary_id == 0 or dictionary_id in self.decompressors
+
+    def compress(self, block_bytes: bytes) -> bytes:
+        if self.compressor is None:
+            ret: bytes = zstd.compress(block_bytes, self.level)
+            return ret
+        ret = self.compressor.compress(block_bytes)
+        return ret
+
+    def decompress(self, blob: bytes) -> bytes:
+        dictionary_id = frame_dictionary_id(blob)
+        if dictionary_id == 0:
+            ret: bytes = zstd.decompress(blob)
+            return ret
+        decompressor = self.decompressors.get(dictionary_id)
+        if decompressor is None:
+            raise ValueError(f"block compressed with unknown dictionary {dictionary_id}")
+        ret = decompressor.decompress(blob)
+        return ret
+
+
+def block_compressor_for_db(db: sqlite3.Connection) -> BlockCompressor:
+    """
+    Returns a BlockCompressor with the dictionaries of the blockchain database db, for tools that read blocks
+    without a BlockStore
+    """
+    compressor = BlockCompressor()
+    table = db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='block_compression_dicts'")
+    if table.fetchone() is not None:
+        for row in db.execute("SELECT dictionary FROM block_compression_dicts ORDER BY id"):
+            compressor.add_dictionary(row[0])
+    return compressor
@@ -0,0 +1,261 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import heapq
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from greenbtc.full_node.full_node_api import FullNodeAPI
+from greenbtc.protocols.full_node_protocol import RequestBlocks, RespondBlocks
+from greenbtc.server.ws_connection import WSGreenBTCConnection
+from greenbtc.types.blockchain_format.sized_bytes import bytes32
+from greenbtc.types.full_block import FullBlock
+from greenbtc.util.ints import uint32
+
+log = logging.getLogger(__name__)
+
+# the number of block ranges requested or downloaded, but not yet passed on for
+# validation. This bounds the number of blocks held in memory
+DOWNLOAD_WINDOW = 32
+
+# the number of range requests outstanding with a single peer
+MAX_REQUESTS_PER_PEER = 4
+
+# the time a range request should take. The batch size of every peer is
+# adjusted to its throughput to match it
+TARGET_REQUEST_TIME = 5.0
+
+MIN_BATCH_SIZE = 4
+
+# a request is re-issued to a faster peer once it has taken this many times
+# as long as expected, and at least MIN_STRAGGLER_TIME seconds
+STRAGGLER_FACTOR = 3
+MIN_STRAGGLER_TIME = 5.0
+
+REQUEST_TIMEOUT = 30
+
+# weight of the most recent request in the throughput average of a peer
+THROUGHPUT_SMOOTHING = 0.3
+
+
+@dataclasses.dataclass
+class PeerDownloadStats:
+    batch_size: int
+    # None until the first request of the peer completes
+    blocks_per_second: Optional[float] = None
+    outstanding: int = 0
+
+    def expected_time(self, blocks: int) -> float:
+        if self.blocks_per_second is None:
+            return TARGET_REQUEST_TIME
+        return blocks / self.blocks_per_second
+
+    def record(self, blocks: int, seconds: float, max_batch_size: int) -> None:
+        rate = blocks / max(seconds, 0.001)
+        if self.blocks_per_second is None:
+            self.blocks_per_second = rate
+        else:
+            self.blocks_per_second += THROUGHPUT_SMOOTHING * (rate - self.blocks_per_second)
+        self.batch_size = max(MIN_BATCH_SIZE, min(max_batch_size, int(self.blocks_per_second * TARGET_REQUEST_TIME)))
+
+
+@dataclasses.dataclass
+class _Request:
+    start: int
+    end: int
+    peer: WSGreenBTCConnection
+    task: asyncio.Task[object]
+    started: float
+    # whether another peer was asked for the same range, since this one is slow
+    reissued: bool = False
+
+
+@dataclasses.dataclass
+class BlockDownloader:
+    """
+    Downloads the blocks start_height to end_height (inclusive) from all the
+    peers returned by get_peers(), keeping up to DOWNLOAD_WINDOW range requests
+    outstanding. The batches are passed on in height order, whichever order
+    they arrive in.
+    """
+
+    start_height: int
+    end_height: int
+    max_batch_size: int
+    get_peers: Callable[[], List[WSGreenBTCConnection]]
+    # set when the peers returned by get_peers() may have changed
+    peers_changed: asyncio.Event
+    window: int = DOWNLOAD_WINDOW
+    peers: Dict[bytes32, WSGreenBTCConnection] = dataclasses.field(default_factory=dict)
+    stats: Dict[bytes32, PeerDownloadStats] = dataclasses.field(default_factory=dict)
+    # peers that rejected a request, or sent an invalid response. They're not
+    # asked again in this download
+    failed_peers: Set[bytes32] = dataclasses.field(default_factory=set)
+    requests: List[_Request] = dataclasses.field(default_factory=list)
+    # ranges to request again, as (start, end)
+    retry: List[Tuple[int, int]] = dataclasses.field(default_factory=list)
+    # start height -> peer and blocks of the ranges downloaded, waiting for
+    # the ranges below them
+    ready: Dict[int, Tuple[WSGreenBTCConnection, List[FullBlock]]] = dataclasses.field(default_factory=dict)
+    # the lowest height not requested yet
+    next_request: int = 0
+    # the lowest height not passed on yet
+    next_output: int = 0
+
+    def __post_init__(self) -> None:
+        self.next_request = self.start_height
+        self.next_output = self.start_height
+        self._refresh_peers()
+
+    def _refresh_peers(self) -> None:
+        self.peers = {peer.peer_node_id: peer for peer in self.get_peers()}
+        for peer_id in self.peers:
+            if peer_id not in self.stats:
+                self.stats[peer_id] = PeerDownloadStats(self.max_batch_size)
+
+    def _usable(self, peer: WSGreenBTCConnection) -> bool:
+        return not peer.closed and peer.peer_node_id not in self.failed_peers
+
+    def _pick_peer(self, exclude: Optional[WSGreenBTCConnection] = None) -> Optional[WSGreenBTCConnection]:
+        # peers we have no measurement for yet go first, to measure them
+        candidates = [
+            peer
+            for peer in self.peers.values()
+            if self._usable(peer)
+            and peer is not exclude
+            and self.stats[peer.peer_node_id].outstanding < MAX_REQUESTS_PER_PEER
+        ]
+        if len(candidates) == 0:
+            return None
+        random.shuffle(candidates)
+        return max(candidates, key=lambda peer: self.stats[peer.peer_node_id].blocks_per_second or float("inf"))
+
+    def _ranges_in_window(self) -> int:
+        in_flight = {request.start for request in self.requests}
+        return len(in_flight) + len(self.retry) + len(self.ready)
+
+    def _request(self, peer: WSGreenBTCConnection, start: int, end: int) -> None:
+        message = RequestBlocks(uint32(start), uint32(end), True)
+        task: asyncio.Task[object] = asyncio.create_task(
+            peer.call_api(FullNodeAPI.request_blocks, message, timeout=REQUEST_TIMEOUT)
+        )
+        request = _Request(start, end, peer, task, time.monotonic())
+        self.requests.append(request)
+        self.stats[peer.peer_node_id].outstanding += 1
+
+    def _schedule(self) -> None:
+        while True:
+            if len(self.retry) == 0 and (
+                self.next_request > self.end_height or self._ranges_in_window() >= self.window
+            ):
+                return
+            peer = self._pick_peer()
+            if peer is None:
+                return
+            if len(self.retry) > 0:
+                start, end = heapq.heappop(self.retry)
+            else:
+                start = self.next_request
+                end = min(self.end_height, start + self.stats[peer.peer_node_id].batch_size - 1)
+                self.next_request = end + 1
+            self._request(peer, start, end)
+
+    def _reissue_stragglers(self) -> None:
+        now = time.monotonic()
+        for request in sorted(self.requests, key=lambda r: r.start):
+            if request.reissued or sum(1 for r in self.requests if r.start == request.start) > 1:
+                continue
+            stats = self.stats[request.peer.peer_node_id]
+            blocks = request.end - request.start + 1
+            elapsed = now - request.started
+            if elapsed < max(MIN_STRAGGLER_TIME, STRAGGLER_FACTOR * stats.expected_time(blocks)):
+                continue
+            peer = self._pick_peer(exclude=request.peer)
+            if peer is None:
+                return
+            # only ask a peer expected to be faster than this request is going
+            peer_rate = self.stats[peer.peer_node_id].blocks_per_second
+            if peer_rate is not None and peer_rate <= blocks / elapsed:
+                continue
+            log.debug(
+                f"re-requesting blocks {request.start} to {request.end} from {peer.get_peer_logging()}, "
+                f"{request.peer.get_peer_logging()} is slow"
+            )
+            request.reissued = True
+            self._request(peer, request.start, request.end)
+
+    async def _finish(self, request: _Request) -> None:
+        self.requests.remove(request)
+        peer_id = request.peer.peer_node_id
+        self.stats[peer_id].outstanding -= 1
+        if request.start < self.next_output or request.start in self.ready:
+            # another peer was faster
+            return
+
+        response: object = None
+        if not request.task.cancelled() and request.task.exception() is None:
+            response = request.task.result()
+        blocks: List[FullBlock] = []
+        if isinstance(response, RespondBlocks):
+            blocks = response.blocks
+        expected = request.end - request.start + 1
+        if len(blocks) == expected and blocks[0].height == request.start and blocks[-1].height == request.end:
+            self.stats[peer_id].record(expected, time.monotonic() - request.started, self.max_batch_size)
+            self.ready[request.start] = (request.peer, blocks)
+            # cancel the other requests for this range
+            for other in [r for r in self.requests if r.start == request.start]:
+                other.task.cancel()
+                self.requests.remove(other)
+                self.stats[other.peer.peer_node_id].outstanding -= 1
+            return
+
+        if response is None:
+            # timed out, or the connection failed
+            log.info(f"failed fetching blocks {request.start} to {request.end} from {request.peer.get_peer_logging()}")
+            await request.peer.close()
+        else:
+            log.info(f"peer {request.peer.get_peer_logging()} didn't send blocks {request.start} to {request.end}")
+            self.failed_peers.add(peer_id)
+        if not any(r.start == request.start for r in self.requests):
+            heapq.heappush(self.retry, (request.start, request.end))
+
+    async def run(self, output: Callable[[WSGreenBTCConnection, List[FullBlock]], Awaitable[None]]) -> bool:
+        """
+        Downloads the blocks, calling output() for every batch, in height
+        order. Returns False if there are no peers left to download from
+        """
+        try:
+            while self.next_output <= self.end_height:
+                if self.peers_changed.is_set():
+                    self.peers_changed.clear()
+                    self._refresh_peers()
+                self._schedule()
+                if len(self.requests) == 0 and self.next_output not in self.ready:
+                    log.error(f"failed fetching blocks {self.next_output} to {self.end_height} from peers")
+                    return False
+
+                if len(self.requests) > 0:
+                    # wake up once in a while to look for slow requests
+                    done, _ = await asyncio.wait(
+                        {request.task for request in self.requests},
+                        timeout=1,
+                        return_when=asyncio.FIRST_COMPLETED,
+                    )
+                    for request in [r for r in self.requests if r.task in done]:
+                        # the request may have been removed already, if it was
+                        # for the same range as one finished before it
+                        if request in self.requests:
+                            await self._finish(request)
+                    self._reissue_stragglers()
+
+                while self.next_output in self.ready:
+                    peer, blocks = self.ready.pop(self.next_output)
+                    self.next_output = blocks[-1].height + 1
+                    await output(peer, blocks)
+            return True
+        finally:
+            for request in self.requests:
+                request.task.cancel()
@@ -1,6 +1,9 @@
 from __future__ import annotations
 
 import logging
+import mmap
+import os
+from bisect import bisect_right, insort
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple
@@ -16,6 +19,71 @@ from greenbtc.util.streamable import Streamable, streamable
 
 log = logging.getLogger(__name__)
 
+ZERO_FARM = bytes(32)
+
+# the height map files grow by this many entries at a time
+HEIGHT_MAP_GROWTH = 65536
+
+
+class HeightMapFile:
+    """
+    A file of 32 byte entries, one per height, mapped into memory. The file is grown in HEIGHT_MAP_GROWTH steps, so
+    it's usually larger than the number of heights in use. Entries past that number are ignored, and overwritten as
+    the chain grows.
+    """
+
+    __fd: int
+    __map: mmap.mmap
+    # the number of heights in use
+    __length: int
+
+    def __init__(self, filename: Path) -> None:
+        self.__fd = os.open(filename, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+        size = os.fstat(self.__fd).st_size
+        # a file with a partial entry at the end has been truncated by something else. Ignore the partial entry
+        self.__length = size // 32
+        self.__map_file(max(size, 32 * HEIGHT_MAP_GROWTH))
+
+    def __map_file(self, size: int) -> None:
+        size = (size + 32 * HEIGHT_MAP_GROWTH - 1) // (32 * HEIGHT_MAP_GROWTH) * (32 * HEIGHT_MAP_GROWTH)
+        if os.fstat(self.__fd).st_size < size:
+            os.ftruncate(self.__fd, size)
+        self.__map = mmap.mmap(self.__fd, size)
+
+    def __len__(self) -> int:
+        return self.__length
+
+    def resize(self, length: int) -> None:
+        if length * 32 > len(self.__map):
+            # mmap.resize() isn't available everywhere, map the grown file again instead
+            self.__map.close()
+            self.__map_file(length * 32)
+        self.__length = length
+
+    def get(self, height: int) -> bytes:
+        idx = height * 32
+        return self.__map[idx : idx + 32]
+
+    def get_range(self, start: int, end: int) -> bytes:
+        return self.__map[start * 32 : end * 32]
+
+    def set(self, height: int, value: bytes) -> None:
+        idx = height * 32
+        self.__map[idx : idx + 32] = value
+
+    def flush(self, first_dirty: int) -> None:
+        """
+        Writes the pages from first_dirty up to the last height in use to disk
+        """
+        offset = first_dirty * 32 // mmap.ALLOCATIONGRANULARITY * mmap.ALLOCATIONGRANULARITY
+        end = self.__length * 32
+        if end > offset:
+            self.__map.flush(offset, end - offset)
+
+    def close(self) -> None:
+        self.__map.close()
+        os.close(self.__fd)
+
 
 @streamable
 @dataclass(frozen=True)
@@ -36,11 +104,20 @@ class BlockHeightMap:
     # and back in time on startup.
 
     # Defines the path from genesis to the peak, no orphan blocks
-    # this buffer contains all block hashes that are part of the current peak
+    # this file contains all block hashes that are part of the current peak
     # ordered by height. i.e. __height_to_hash[0..32] is the genesis hash
-    # __height_to_hash[32..64] is the hash for height 1 and so on
-    __height_to_hash: bytearray
-    __height_to_farm: bytearray
+    # __height_to_hash[32..64] is the hash for height 1 and so on. Both files
+    # are memory mapped, so only the pages in use are read, and the OS writes
+    # back the pages that changed
+    __height_to_hash: HeightMapFile
+    __height_to_farm: HeightMapFile
+
+    # index over __height_to_farm: maps each farm puzzle hash to the sorted
+    # list of heights (on the current peak path) it farmed. This lets us count
+    # the blocks farmed in a height range with two bisects instead of scanning
+    # the whole window. It's built on first use, to not read the whole farm
+    # file on startup
+    __farm_heights: Optional[Dict[bytes32, List[int]]]
 
     # All sub-epoch summaries that have been included in the blockchain from the beginning until and including the peak
     # (height_included, SubEpochSummary). Note: ONLY for the blocks in the path to the peak
@@ -55,11 +132,6 @@ class BlockHeightMap:
     # to disk. When it's time to write to disk, we can start flushing from this
     # offset
     __first_dirty: int
-    __first_dirty_farm: int
-
-    # the file we're saving the height-to-hash cache to
-    __height_to_hash_filename: Path
-    __height_to_farm_filename: Path
 
     # the file we're saving the sub epoch summary cache to
     __ses_filename: Path
@@ -73,17 +145,18 @@ class BlockHeightMap:
 
         self.__counter = 0
         self.__first_dirty = 0
-        self.__height_to_hash = bytearray()
-        self.__height_to_farm = bytearray()
+        self.__height_to_hash = HeightMapFile(blockchain_dir / "height-to-hash")
+        self.__height_to_farm = HeightMapFile(blockchain_dir / "height-to-farm")
+        self.__farm_heights = None
         self.__sub_epoch_summaries = {}
-        self.__height_to_hash_filename = blockchain_dir / "height-to-hash"
-        self.__height_to_farm_filename = blockchain_dir / "height-to-farm"
         self.__ses_filename = blockchain_dir / "sub-epoch-summaries"
 
         async with self.db.reader_no_transaction() as conn:
             async with conn.execute("SELECT hash FROM current_peak WHERE key = 0") as cursor:
                 peak_row = await cursor.fetchone()
                 if peak_row is None:
+                    self.__height_to_hash.resize(0)
+                    self.__height_to_farm.resize(0)
                     return self
 
             async with conn.execute(
@@ -93,22 +166,10 @@ class BlockHeightMap:
             ) as cursor:
                 row = await cursor.fetchone()
                 if row is None:
+                    self.__height_to_hash.resize(0)
+                    self.__height_to_farm.resize(0)
                     return self
 
-        try:
-            async with aiofiles.open(self.__height_to_hash_filename, "rb") as f:
-                self.__height_to_hash = bytearray(await f.read())
-        except Exception:
-            # it's OK if this file doesn't exist, we can rebuild it
-            pass
-
-        try:
-            async with aiofiles.open(self.__height_to_farm_filename, "rb") as f:
-                self.__height_to_farm = bytearray(await f.read())
-        except Exception:
-            # it's OK if this file doesn't exist, we can rebuild it
-            pass
-
         try:
             async with aiofiles.open(self.__ses_filename, "rb") as f:
                 self.__sub_epoch_summaries = {k: v for (k, v) in SesCache.from_bytes(await f.read()).content}
@@ -121,20 +182,11 @@ class BlockHeightMap:
         height = row[2]
         farm_puzzle_hash = row[4]
 
-        # allocate memory for height to hash map
-        # this may also truncate it, if thie file on disk had an invalid size
-        new_size = (height + 1) * 32
-        size = len(self.__height_to_hash)
-        if size > new_size:
-            del self.__height_to_hash[new_size:]
-        else:
-            self.__height_to_hash += bytearray([0] * (new_size - size))
-
-        size = len(self.__height_to_farm)
-        if size > new_size:
-            del self.__height_to_farm[new_size:]
-        else:
-            self.__height_to_farm += bytearray([0] * (new_size - size))
+        # size the height maps to the peak. This may also shrink them, if the
+        # files are ahead of the database. Missing or outdated entries are
+        # filled in from the database below
+        self.__height_to_hash.resize(height + 1)
+        self.__height_to_farm.resize(height + 1)
 
         self.__first_dirty = height + 1
 
@@ -158,8 +210,8 @@ class BlockHeightMap:
     ) -> None:
         # we're only updating the last hash. If we've reorged, we already rolled
         # back, making this the new peak
-        assert height * 32 <= len(self.__height_to_hash)
-        assert height * 32 <= len(self.__height_to_farm)
+        assert height <= len(self.__height_to_hash)
+        assert height <= len(self.__height_to_farm)
         self.__set_hash(height, header_hash, farm_puzzle_hash)
         if ses is not None:
             self.__sub_epoch_summaries[height] = bytes(ses)
@@ -168,40 +220,28 @@ class BlockHeightMap:
         if self.__counter < 1000:
             return
 
-        assert (len(self.__height_to_hash) % 32) == 0
-        assert (len(self.__height_to_farm) % 32) == 0
-        offset = self.__first_dirty * 32
-
         ses_buf = bytes(SesCache([(k, v) for (k, v) in self.__sub_epoch_summaries.items()]))
 
         self.__counter = 0
 
-        try:
-            async with aiofiles.open(self.__height_to_hash_filename, "r+b") as f:
-                map_buf = self.__height_to_hash[offset:].copy()
-                await f.seek(offset)
-                await f.write(map_buf)
-        except Exception:
-            # if the file doesn't exist, write the whole buffer
-            async with aiofiles.open(self.__height_to_hash_filename, "wb") as f:
-                map_buf = self.__height_to_hash.copy()
-                await f.write(map_buf)
+        # only the pages from the first changed height on are written
+        self.__height_to_hash.flush(self.__first_dirty)
+        self.__height_to_farm.flush(self.__first_dirty)
 
-        try:
-            async with aiofiles.open(self.__height_to_farm_filename, "r+b") as f:
-                farm_buf = self.__height_to_farm[offset:].copy()
-                await f.seek(offset)
-                await f.write(farm_buf)
-        except Exception:
-            # if the file doesn't exist, write the whole buffer
-            async with aiofiles.open(self.__height_to_farm_filename, "wb") as f:
-                farm_buf = self.__height_to_farm.copy()
-                await f.write(farm_buf)
-
-        self.__first_dirty = len(self.__height_to_hash) // 32
-        assert self.__first_dirty == len(self.__height_to_farm) // 32
+        self.__first_dirty = len(self.__height_to_hash)
+        assert self.__first_dirty == len(self.__height_to_farm)
         await write_file_async(self.__ses_filename, ses_buf)
 
+    def close(self) -> None:
+        """
+        Writes the changed pages of the height map files to disk and closes them. The sub epoch summary cache is
+        written by maybe_flush only, it's rebuilt from the database on startup if it's behind
+        """
+        self.__height_to_hash.flush(self.__first_dirty)
+        self.__height_to_farm.flush(self.__first_dirty)
+        self.__height_to_hash.close()
+        self.__height_to_farm.close()
+
     # load height-to-hash map entries from the DB starting at height back in
     # time until we hit a match in the existing map, at which point we can
     # assume all previous blocks have already been populated
@@ -260,31 +300,85 @@ class BlockHeightMap:
                 self.__set_hash(height, prev_hash, farm_puzzle_hash)
                 prev_hash = entry[1]
 
+    def __build_farm_index(self) -> Dict[bytes32, List[int]]:
+        farm_heights: Dict[bytes32, List[int]] = {}
+        # read the file a chunk at a time, it may be much larger than we want to copy at once
+        for start in range(0, len(self.__height_to_farm), HEIGHT_MAP_GROWTH):
+            end = min(start + HEIGHT_MAP_GROWTH, len(self.__height_to_farm))
+            farms = self.__height_to_farm.get_range(start, end)
+            for height in range(start, end):
+                idx = (height - start) * 32
+                farm = farms[idx : idx + 32]
+                if farm == ZERO_FARM:
+                    continue
+                heights = farm_heights.get(farm)
+                if heights is None:
+                    farm_heights[bytes32(farm)] = [height]
+                else:
+                    heights.append(height)
+        self.__farm_heights = farm_heights
+        return farm_heights
+
     def __set_hash(self, height: int, block_hash: bytes32, farm_puzzle_hash: bytes32) -> None:
-        idx = height * 32
-        self.__height_to_hash[idx : idx + 32] = block_hash
-        self.__height_to_farm[idx : idx + 32] = farm_puzzle_hash
+        if height == len(self.__height_to_hash):
+            self.__height_to_hash.resize(height + 1)
+            self.__height_to_farm.resize(height + 1)
+            # the files may hold an entry for this height from before a rollback
+            old_farm = ZERO_FARM
+        else:
+            old_farm = self.__height_to_farm.get(height)
+        self.__height_to_hash.set(height, block_hash)
+        if old_farm != farm_puzzle_hash and self.__farm_heights is not None:
+            if old_farm in self.__farm_heights:
+                old_heights = self.__farm_heights[bytes32(old_farm)]
+                pos = bisect_right(old_heights, height) - 1
+                if pos >= 0 and old_heights[pos] == height:
+                    del old_heights[pos]
+                if len(old_heights) == 0:
+                    del self.__farm_heights[bytes32(old_farm)]
+            if farm_puzzle_hash != ZERO_FARM:
+                insort(self.__farm_heights.setdefault(bytes32(farm_puzzle_hash), []), height)
+        self.__height_to_farm.set(height, farm_puzzle_hash)
         self.__counter += 1
         self.__first_dirty = min(self.__first_dirty, height)
 
     def get_hash(self, height: uint32) -> bytes32:
-        idx = height * 32
-        assert idx + 32 <= len(self.__height_to_hash)
-        return bytes32(self.__height_to_hash[idx : idx + 32])
+        assert height < len(self.__height_to_hash)
+        return bytes32(self.__height_to_hash.get(height))
 
     def contains_height(self, height: uint32) -> bool:
-        return height * 32 < len(self.__height_to_hash)
+        return height < len(self.__height_to_hash)
 
     def get_farm(self, height: uint32) -> bytes32:
-        idx = height * 32
-        assert idx + 32 <= len(self.__height_to_farm)
-        return bytes32(self.__height_to_farm[idx : idx + 32])
-
-    def get_height_farm_count(self, begin_height: uint32, height: uint32, farm_puzzle_hash: bytes32) -> int:
-        return self.__height_to_farm.count(farm_puzzle_hash, begin_height * 32 + 32, height * 32 + 32)
+        assert height < len(self.__height_to_farm)
+        return bytes32(self.__height_to_farm.get(height))
+
+    def get_height_farm_count(self, begin_height: int, height: int, farm_puzzle_hash: bytes32) -> int:
+        """
+        Returns the number of blocks farmed by farm_puzzle_hash in (begin_height, height]. This used to count the
+        farms in a slice of one bytearray, and the stake coefficient depends on it, so a begin_height or height below
+        -1 still counts back from the last height, the way the slice start did.
+        """
+        length = len(self.__height_to_farm)
+        if begin_height < -1:
+            begin_height = length + begin_height
+        if height < -1:
+            height = length + height
+        if farm_puzzle_hash == ZERO_FARM:
+            # heights without a farm aren't indexed
+            start = max(begin_height + 1, 0)
+            end = min(height + 1, length)
+            return self.__height_to_farm.get_range(start, end).count(ZERO_FARM) if start < end else 0
+        farm_heights = self.__farm_heights
+        if farm_heights is None:
+            farm_heights = self.__build_farm_index()
+        heights = farm_heights.get(farm_puzzle_hash)
+        if heights is None:
+            return 0
+        return max(0, bisect_right(heights, height) - bisect_right(heights, begin_height))
 
     def contains_height_farm(self, height: uint32) -> bool:
-        return height * 32 < len(self.__height_to_farm)
+        return height < len(self.__height_to_farm)
 
     def rollback(self, fork_height: int) -> None:
         # fork height may be -1, in which case all blocks are different and we
@@ -296,8 +390,20 @@ class BlockHeightMap:
         for height in heights_to_delete:
             del self.__sub_epoch_summaries[height]
 
-        del self.__height_to_hash[(fork_height + 1) * 32 :]
-        del self.__height_to_farm[(fork_height + 1) * 32 :]
+        if self.__farm_heights is not None:
+            removed_farms = self.__height_to_farm.get_range(fork_height + 1, len(self.__height_to_farm))
+            for farm in {removed_farms[i : i + 32] for i in range(0, len(removed_farms), 32)}:
+                heights = self.__farm_heights.get(bytes32(farm))
+                if heights is None:
+                    continue
+                del heights[bisect_right(heights, fork_height) :]
+                if len(heights) == 0:
+                    del self.__farm_heights[bytes32(farm)]
+
+        # the entries above the fork stay in the files, but are ignored and
+        # overwritten as the new chain is added
+        self.__height_to_hash.resize(min(len(self.__height_to_hash), fork_height + 1))
+        self.__height_to_farm.resize(min(len(self.__height_to_farm), fork_height + 1))
         self.__first_dirty = min(self.__first_dirty, fork_height + 1)
 
     def get_ses(self, height: uint32) -> SubEpochSummary:
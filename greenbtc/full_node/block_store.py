@@ -2,23 +2,26 @@ from __future__ import annotations
 
 import dataclasses
 import logging
+import random
 import sqlite3
-from typing import Dict, List, Optional, Tuple
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
 import typing_extensions
 import zstd
 
 from greenbtc.consensus.block_record import BlockRecord
 from greenbtc.consensus.coinbase import create_puzzlehash_for_pk
+from greenbtc.full_node.block_compression import DEFAULT_BLOCK_COMPRESSION_LEVEL, BlockCompressor, frame_dictionary_id
 from greenbtc.types.blockchain_format.serialized_program import SerializedProgram
 from greenbtc.types.blockchain_format.sized_bytes import bytes32
 from greenbtc.types.full_block import FullBlock
 from greenbtc.types.weight_proof import SubEpochChallengeSegment, SubEpochSegments
-from greenbtc.util.db_wrapper import DBWrapper2, execute_fetchone
+from greenbtc.util.db_wrapper import SQLITE_MAX_VARIABLE_NUMBER, DBWrapper2, execute_fetchone
 from greenbtc.util.errors import Err
 from greenbtc.util.full_block_utils import GeneratorBlockInfo, block_info_from_block, generator_from_block
 from greenbtc.util.ints import uint32
 from greenbtc.util.lru_cache import LRUCache
+from greenbtc.util.misc import to_batches
 
 log = logging.getLogger(__name__)
 
@@ -43,16 +46,24 @@ class BlockStore:
     block_cache: LRUCache[bytes32, FullBlock]
     db_wrapper: DBWrapper2
     ses_challenge_cache: LRUCache[bytes32, List[SubEpochChallengeSegment]]
+    compressor: BlockCompressor = dataclasses.field(default_factory=BlockCompressor)
 
     @classmethod
-    async def create(cls, db_wrapper: DBWrapper2, *, use_cache: bool = True) -> BlockStore:
+    async def create(
+        cls,
+        db_wrapper: DBWrapper2,
+        *,
+        use_cache: bool = True,
+        compression_level: int = DEFAULT_BLOCK_COMPRESSION_LEVEL,
+    ) -> BlockStore:
         if db_wrapper.db_version != 2:
             raise RuntimeError(f"BlockStore does not support database schema v{db_wrapper.db_version}")
 
+        compressor = BlockCompressor(compression_level)
         if use_cache:
-            self = cls(LRUCache(1000), db_wrapper, LRUCache(50))
+            self = cls(LRUCache(1000), db_wrapper, LRUCache(50), compressor)
         else:
-            self = cls(LRUCache(0), db_wrapper, LRUCache(0))
+            self = cls(LRUCache(0), db_wrapper, LRUCache(0), compressor)
 
         async with self.db_wrapper.writer_maybe_transaction() as conn:
             log.info("DB: Creating block store tables and indexes.")
@@ -113,8 +124,84 @@ class BlockStore:
                 "CREATE INDEX IF NOT EXISTS main_chain ON full_blocks(height, in_main_chain) WHERE in_main_chain=1"
             )
 
+            # zstd dictionaries trained on blocks of this chain. New blocks are compressed with the last one, see
+            # "db compress-blocks"
+            await conn.execute(
+                "CREATE TABLE IF NOT EXISTS block_compression_dicts("
+                "id INTEGER PRIMARY KEY,"
+                "dict_id bigint UNIQUE,"
+                "dictionary blob)"
+            )
+
+            await self._load_dictionaries()
+
         return self
 
+    async def _load_dictionaries(self) -> None:
+        async with self.db_wrapper.reader_no_transaction() as conn:
+            async with conn.execute("SELECT dictionary FROM block_compression_dicts ORDER BY id") as cursor:
+                for row in await cursor.fetchall():
+                    self.compressor.add_dictionary(row[0])
+
+    async def _decompress(self, block_bytes: bytes) -> bytes:
+        if not self.compressor.has_dictionary(frame_dictionary_id(block_bytes)):
+            # the dictionary was added by "db compress-blocks" while we were running
+            await self._load_dictionaries()
+        return self.compressor.decompress(block_bytes)
+
+    async def add_compression_dictionary(self, dictionary: bytes) -> int:
+        """
+        Stores dictionary and compresses new blocks with it from now on. Returns the dictionary id
+        """
+        dictionary_id = self.compressor.add_dictionary(dictionary)
+        async with self.db_wrapper.writer_maybe_transaction() as conn:
+            await conn.execute(
+                "INSERT OR IGNORE INTO block_compression_dicts(dict_id, dictionary) VALUES(?, ?)",
+                (dictionary_id, dictionary),
+            )
+        return dictionary_id
+
+    async def get_compression_samples(self, count: int) -> List[bytes]:
+        """
+        Returns up to count uncompressed blocks from random heights of the main chain, to train a dictionary on
+        """
+        peak = await self.get_peak()
+        if peak is None:
+            return []
+        heights = random.sample(range(peak[1] + 1), min(count, peak[1] + 1))
+        samples: List[bytes] = []
+        async with self.db_wrapper.reader_no_transaction() as conn:
+            for batch in to_batches(heights, SQLITE_MAX_VARIABLE_NUMBER):
+                async with conn.execute(
+                    f"SELECT block FROM full_blocks INDEXED BY main_chain "
+                    f'WHERE height in ({"?," * (len(batch.entries) - 1)}?) AND in_main_chain=1',
+                    batch.entries,
+                ) as cursor:
+                    for row in await cursor.fetchall():
+                        samples.append(await self._decompress(row[0]))
+        return samples
+
+    async def recompress_blocks(self, start: int, count: int, *, force: bool = False) -> Tuple[int, int]:
+        """
+        Re-compresses up to count blocks, starting at rowid start, with the current dictionary and compression level.
+        Blocks already compressed with the current dictionary are skipped, unless force is set.
+        Returns the rowid to continue at, 0 once every block has been visited, and the number of blocks rewritten.
+        """
+        async with self.db_wrapper.writer() as conn:
+            async with conn.execute(
+                "SELECT rowid, block FROM full_blocks WHERE rowid>=? ORDER BY rowid LIMIT ?", (start, count)
+            ) as cursor:
+                rows = list(await cursor.fetchall())
+            updates: List[Tuple[bytes, int]] = []
+            for row in rows:
+                if not force and frame_dictionary_id(row[1]) == self.compressor.dictionary_id:
+                    continue
+                updates.append((self.compressor.compress(await self._decompress(row[1])), row[0]))
+            await conn.executemany("UPDATE full_blocks SET block=? WHERE rowid=?", updates)
+        if len(rows) < count:
+            return 0, len(updates)
+        return rows[-1][0] + 1, len(updates)
+
     async def rollback(self, height: int) -> None:
         async with self.db_wrapper.writer_maybe_transaction() as conn:
             await conn.execute("UPDATE full_blocks SET in_main_chain=0 WHERE height>? AND in_main_chain=1", (height,))
@@ -130,7 +217,7 @@ class BlockStore:
     async def replace_proof(self, header_hash: bytes32, block: FullBlock) -> None:
         assert header_hash == block.header_hash
 
-        block_bytes: bytes = compress(block)
+        block_bytes: bytes = self.compressor.compress(bytes(block))
 
         self.block_cache.put(header_hash, block)
 
@@ -171,7 +258,7 @@ class BlockStore:
                     ses,
                     int(block.is_fully_compactified()),
                     False,  # in_main_chain
-                    compress(block),
+                    self.compressor.compress(bytes(block)),
                     bytes(block_record),
                     bytes(block_record.farm_puzzle_hash),
                 ),
@@ -223,7 +310,7 @@ class BlockStore:
             async with conn.execute("SELECT block from full_blocks WHERE header_hash=?", (header_hash,)) as cursor:
                 row = await cursor.fetchone()
         if row is not None:
-            block = decompress(row[0])
+            block = FullBlock.from_bytes(await self._decompress(row[0]))
             self.block_cache.put(header_hash, block)
             return block
         return None
@@ -236,8 +323,7 @@ class BlockStore:
             async with conn.execute("SELECT block from full_blocks WHERE header_hash=?", (header_hash,)) as cursor:
                 row = await cursor.fetchone()
         if row is not None:
-            ret: bytes = zstd.decompress(row[0])
-            return ret
+            return await self._decompress(row[0])
 
         return None
 
@@ -250,7 +336,7 @@ class BlockStore:
             async with conn.execute(formatted_str, heights) as cursor:
                 ret: List[FullBlock] = []
                 for row in await cursor.fetchall():
-                    ret.append(decompress(row[0]))
+                    ret.append(FullBlock.from_bytes(await self._decompress(row[0])))
                 return ret
 
     async def get_block_info(self, header_hash: bytes32) -> Optional[GeneratorBlockInfo]:
@@ -265,7 +351,7 @@ class BlockStore:
             row = await execute_fetchone(conn, formatted_str, (header_hash,))
             if row is None:
                 return None
-            block_bytes = zstd.decompress(row[0])
+            block_bytes = await self._decompress(row[0])
 
             try:
                 return block_info_from_block(block_bytes)
@@ -289,7 +375,7 @@ class BlockStore:
             row = await execute_fetchone(conn, formatted_str, (header_hash,))
             if row is None:
                 return None
-            block_bytes = zstd.decompress(row[0])
+            block_bytes = await self._decompress(row[0])
 
             try:
                 return generator_from_block(block_bytes)
@@ -313,7 +399,7 @@ class BlockStore:
         async with self.db_wrapper.reader_no_transaction() as conn:
             async with conn.execute(formatted_str, heights) as cursor:
                 async for row in cursor:
-                    block_bytes = zstd.decompress(row[0])
+                    block_bytes = await self._decompress(row[0])
 
                     try:
                         gen = generator_from_block(block_bytes)
@@ -394,7 +480,7 @@ class BlockStore:
             async with conn.execute(formatted_str, header_hashes) as cursor:
                 for row in await cursor.fetchall():
                     header_hash = bytes32(row[0])
-                    all_blocks[header_hash] = decompress_blob(row[1])
+                    all_blocks[header_hash] = await self._decompress(row[1])
 
         ret: List[bytes] = []
         for hh in header_hashes:
@@ -422,7 +508,7 @@ class BlockStore:
             async with conn.execute(formatted_str, header_hashes) as cursor:
                 for row in await cursor.fetchall():
                     header_hash = bytes32(row[0])
-                    full_block: FullBlock = decompress(row[1])
+                    full_block: FullBlock = FullBlock.from_bytes(await self._decompress(row[1]))
                     all_blocks[header_hash] = full_block
                     self.block_cache.put(header_hash, full_block)
         ret: List[FullBlock] = []
@@ -487,7 +573,22 @@ class BlockStore:
                 rows: List[sqlite3.Row] = list(await cursor.fetchall())
                 if len(rows) != (stop - start) + 1:
                     raise ValueError(f"Some blocks in range {start}-{stop} were not found.")
-                return [decompress_blob(row[0]) for row in rows]
+                return [await self._decompress(row[0]) for row in rows]
+
+    async def stream_block_bytes_in_range(self, start: int, stop: int) -> AsyncIterator[Tuple[bytes32, bytes]]:
+        """
+        Yields the header hash and serialized block of every main chain block between start and stop, inclusive, in
+        height order. Unlike get_block_bytes_in_range, only one compressed block is held at a time. The caller is
+        responsible for checking that no height is missing.
+        """
+        async with self.db_wrapper.reader_no_transaction() as conn:
+            async with conn.execute(
+                "SELECT header_hash, block FROM full_blocks INDEXED BY main_chain "
+                "WHERE height >= ? AND height <= ? AND in_main_chain=1 ORDER BY height",
+                (start, stop),
+            ) as cursor:
+                async for row in cursor:
+                    yield bytes32(row[0]), await self._decompress(row[1])
 
     async def get_peak(self) -> Optional[Tuple[bytes32, uint32]]:
         async with self.db_wrapper.reader_no_transaction() as conn:
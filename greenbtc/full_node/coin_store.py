@@ -1,15 +1,17 @@
 from __future__ import annotations
 
 import dataclasses
+import heapq
 import logging
 import sqlite3
 import time
-from typing import Any, Collection, Dict, List, Optional, Set, Tuple
+from typing import Any, AsyncIterator, Collection, Dict, List, Optional, Set, Tuple
 
 import typing_extensions
 from aiosqlite import Cursor
 
-from greenbtc.protocols.wallet_protocol import CoinState
+from greenbtc.full_node.coin_store_overlay import CoinStoreOverlay
+from greenbtc.protocols.wallet_protocol import CoinState, CoinStateCursor
 from greenbtc.types.blockchain_format.coin import Coin
 from greenbtc.types.blockchain_format.sized_bytes import bytes32, bytes48
 from greenbtc.types.coin_record import CoinRecord
@@ -20,6 +22,37 @@ from greenbtc.util.misc import to_batches
 
 log = logging.getLogger(__name__)
 
+# number of coin states stream_coin_states_by_puzzle_hashes reads from the database at a time
+COIN_STATE_PAGE_SIZE = 1000
+
+# the change of the unspent balance of each puzzle hash at each height. Coins count at their confirmed height and are
+# subtracted again at their spent height, so the balance before a height is the sum of the deltas below it. See
+# get_unspent_coins_before_height. It's created with new databases, older ones get it from
+# "greenbtc db upgrade-balance-deltas", see balance_deltas_upgrade_func
+COIN_BALANCE_DELTA_TABLE = (
+    "CREATE TABLE IF NOT EXISTS coin_balance_delta("
+    "puzzle_hash blob,"
+    " height bigint,"
+    " delta bigint,"
+    " PRIMARY KEY(puzzle_hash, height)) WITHOUT ROWID"
+)
+COIN_BALANCE_DELTA_INDEX = "CREATE INDEX IF NOT EXISTS coin_balance_delta_height on coin_balance_delta(height)"
+
+# lets get_coin_states_page seek to the cursor of each puzzle hash, in page order. It's created with new databases,
+# older ones get it from "greenbtc db upgrade-coin-indexes", see coin_indexes_upgrade_func
+COIN_PUZZLE_HASH_HEIGHT_INDEX = (
+    "coin_puzzle_hash_height",
+    "coin_record(puzzle_hash, MAX(confirmed_index, spent_index), coin_name)",
+)
+
+
+def coin_state_cursor(state: CoinState) -> CoinStateCursor:
+    """
+    The position of state in the order of CoinStore.get_coin_states_page
+    """
+    height = state.created_height if state.spent_height is None else state.spent_height
+    return CoinStateCursor(uint32(0 if height is None else height), state.coin.name())
+
 
 @typing_extensions.final
 @dataclasses.dataclass
@@ -31,6 +64,14 @@ class CoinStore:
     db_wrapper: DBWrapper2
     coins_added_at_height_cache: LRUCache[uint32, List[CoinRecord]]
     staking_height_cache: LRUCache[bytes48, uint128]
+    # changes not written to the database yet, while write-behind is enabled. See start_write_behind
+    overlay: Optional[CoinStoreOverlay] = None
+    # whether the coin_store_checkpoint table currently holds a row
+    checkpointed: bool = False
+    # whether the database has COIN_PUZZLE_HASH_HEIGHT_INDEX
+    has_page_index: bool = False
+    # whether the database has the coin_balance_delta table, see COIN_BALANCE_DELTA_TABLE
+    has_balance_deltas: bool = False
 
     @classmethod
     async def create(cls, db_wrapper: DBWrapper2) -> CoinStore:
@@ -67,8 +108,58 @@ class CoinStore:
             log.info("DB: Creating index coin_parent_index")
             await conn.execute("CREATE INDEX IF NOT EXISTS coin_parent_index on coin_record(coin_parent)")
 
+            # building the page index and the balance deltas reads the whole coin_record table, so they're only
+            # created here for new databases
+            async with conn.execute("SELECT 1 FROM coin_record LIMIT 1") as cursor:
+                new_database = await cursor.fetchone() is None
+
+            name, definition = COIN_PUZZLE_HASH_HEIGHT_INDEX
+            if new_database:
+                log.info(f"DB: Creating index {name}")
+                await conn.execute(f"CREATE INDEX IF NOT EXISTS {name} on {definition}")
+            async with conn.execute("SELECT name FROM sqlite_master WHERE type='index' AND name=?", (name,)) as cursor:
+                self.has_page_index = await cursor.fetchone() is not None
+            if not self.has_page_index:
+                log.warning(
+                    f"DB: the coin store has no {name} index, paging coin states will be slow. "
+                    "Stop the node and run \"greenbtc db upgrade-coin-indexes\" to create it"
+                )
+
+            async with conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name='coin_balance_delta'"
+            ) as cursor:
+                self.has_balance_deltas = await cursor.fetchone() is not None
+            if new_database or self.has_balance_deltas:
+                log.info("DB: Creating table coin_balance_delta")
+                await conn.execute(COIN_BALANCE_DELTA_TABLE)
+                await conn.execute(COIN_BALANCE_DELTA_INDEX)
+                self.has_balance_deltas = True
+            else:
+                log.warning(
+                    "DB: the coin store has no balance deltas, stake farm amounts are computed from all coins of a "
+                    "puzzle hash. Stop the node and run \"greenbtc db upgrade-balance-deltas\" to build them"
+                )
+
+            # while write-behind is enabled, the height up to which all blocks have been written to coin_record.
+            # Blocks above it were committed without their coin changes and need to be replayed after a crash
+            await conn.execute("CREATE TABLE IF NOT EXISTS coin_store_checkpoint(key int PRIMARY KEY, height bigint)")
+
+        self.checkpointed = await self.get_write_behind_checkpoint() is not None
         return self
 
+    async def _add_balance_deltas(self, deltas: Dict[Tuple[bytes32, int], int]) -> None:
+        if not self.has_balance_deltas:
+            return
+        values = [(puzzle_hash, height, delta) for (puzzle_hash, height), delta in deltas.items() if delta != 0]
+        if len(values) == 0:
+            return
+        async with self.db_wrapper.writer_maybe_transaction() as conn:
+            await conn.executemany(
+                "INSERT INTO coin_balance_delta VALUES(?, ?, ?) "
+                "ON CONFLICT(puzzle_hash, height) DO UPDATE SET delta=delta+excluded.delta",
+                values,
+            )
+
     async def num_unspent(self) -> int:
         async with self.db_wrapper.reader_no_transaction() as conn:
             async with conn.execute("SELECT COUNT(*) FROM coin_record WHERE spent_index=0") as cursor:
@@ -120,8 +211,11 @@ class CoinStore:
             )
             additions.append(reward_coin_r)
 
-        await self._add_coin_records(additions)
-        await self._set_spent(tx_removals, height)
+        if self.overlay is not None:
+            await self._add_block_to_overlay(self.overlay, height, additions, tx_removals)
+        else:
+            await self._add_coin_records(additions)
+            await self._set_spent(tx_removals, height)
 
         end = time.monotonic()
         log.log(
@@ -135,6 +229,8 @@ class CoinStore:
 
     # Checks DB and DiffStores for CoinRecord with coin_name and returns it
     async def get_coin_record(self, coin_name: bytes32) -> Optional[CoinRecord]:
+        if self.overlay is not None and coin_name in self.overlay.records:
+            return self.overlay.records[coin_name]
         async with self.db_wrapper.reader_no_transaction() as conn:
             async with conn.execute(
                 "SELECT confirmed_index, spent_index, coinbase, puzzle_hash, "
@@ -152,6 +248,10 @@ class CoinStore:
             return []
 
         coins: List[CoinRecord] = []
+        if self.overlay is not None:
+            overlay_records = self.overlay.records
+            coins = [overlay_records[name] for name in names if name in overlay_records]
+            names = [name for name in names if name not in overlay_records]
 
         async with self.db_wrapper.reader_no_transaction() as conn:
             cursors: List[Cursor] = []
@@ -190,8 +290,12 @@ class CoinStore:
                 for row in rows:
                     coin = self.row_to_coin(row)
                     coins.append(CoinRecord(coin, row[0], row[1], row[2], row[6]))
-                self.coins_added_at_height_cache.put(height, coins)
-                return coins
+        if self.overlay is not None:
+            overlay_records = self.overlay.records
+            coins = [overlay_records.get(record.name, record) for record in coins]
+            return coins + self.overlay.get_coins_added_at_height(height)
+        self.coins_added_at_height_cache.put(height, coins)
+        return coins
 
     async def get_coins_removed_at_height(self, height: uint32) -> List[CoinRecord]:
         # Special case to avoid querying all unspent coins (spent_index=0)
@@ -209,12 +313,14 @@ class CoinStore:
                         coin = self.row_to_coin(row)
                         coin_record = CoinRecord(coin, row[0], row[1], row[2], row[6])
                         coins.append(coin_record)
-                return coins
+        if self.overlay is not None:
+            coins += self.overlay.get_coins_removed_at_height(height)
+        return coins
 
     async def get_all_coins(self, include_spent_coins: bool) -> List[CoinRecord]:
         # WARNING: this should only be used for testing or in a simulation,
         # running it on a synced testnet or mainnet node will most likely result in an OOM error.
-        coins = set()
+        coins: List[CoinRecord] = []
 
         async with self.db_wrapper.reader_no_transaction() as conn:
             async with conn.execute(
@@ -223,10 +329,11 @@ class CoinStore:
                 f"{'' if include_spent_coins else 'INDEXED BY coin_spent_index WHERE spent_index=0'}"
                 f" ORDER BY confirmed_index"
             ) as cursor:
-                for row in await cursor.fetchall():
+                # coin_name is unique, so the rows need no deduplication
+                async for row in cursor:
                     coin = self.row_to_coin(row)
-                    coins.add(CoinRecord(coin, row[0], row[1], row[2], row[6]))
-                return list(coins)
+                    coins.append(CoinRecord(coin, row[0], row[1], row[2], row[6]))
+                return coins
 
     # Checks DB and DiffStores for CoinRecords with puzzle_hash and returns them
     async def get_coin_records_by_puzzle_hash(
@@ -236,7 +343,7 @@ class CoinStore:
         start_height: uint32 = uint32(0),
         end_height: uint32 = uint32((2**32) - 1),
     ) -> List[CoinRecord]:
-        coins = set()
+        coins: List[CoinRecord] = []
 
         async with self.db_wrapper.reader_no_transaction() as conn:
             async with conn.execute(
@@ -246,10 +353,11 @@ class CoinStore:
                 f"{'' if include_spent_coins else 'AND spent_index=0'}",
                 (puzzle_hash, start_height, end_height),
             ) as cursor:
-                for row in await cursor.fetchall():
+                # coin_name is unique, so the rows need no deduplication
+                async for row in cursor:
                     coin = self.row_to_coin(row)
-                    coins.add(CoinRecord(coin, row[0], row[1], row[2], row[6]))
-                return list(coins)
+                    coins.append(CoinRecord(coin, row[0], row[1], row[2], row[6]))
+                return coins
 
     async def get_coin_records_by_puzzle_hashes(
         self,
@@ -261,7 +369,7 @@ class CoinStore:
         if len(puzzle_hashes) == 0:
             return []
 
-        coins = set()
+        coins: List[CoinRecord] = []
         puzzle_hashes_db: Tuple[Any, ...]
         puzzle_hashes_db = tuple(puzzle_hashes)
 
@@ -274,10 +382,11 @@ class CoinStore:
                 f"{'' if include_spent_coins else 'AND spent_index=0'}",
                 puzzle_hashes_db + (start_height, end_height),
             ) as cursor:
-                for row in await cursor.fetchall():
+                # coin_name is unique, so the rows need no deduplication
+                async for row in cursor:
                     coin = self.row_to_coin(row)
-                    coins.add(CoinRecord(coin, row[0], row[1], row[2], row[6]))
-                return list(coins)
+                    coins.append(CoinRecord(coin, row[0], row[1], row[2], row[6]))
+                return coins
 
     async def get_coin_records_by_names(
         self,
@@ -286,10 +395,21 @@ class CoinStore:
         start_height: uint32 = uint32(0),
         end_height: uint32 = uint32((2**32) - 1),
     ) -> List[CoinRecord]:
-        if len(names) == 0:
-            return []
-
         coins = set()
+        if self.overlay is not None:
+            overlay_records = self.overlay.records
+            for name in names:
+                record = overlay_records.get(name)
+                if (
+                    record is not None
+                    and start_height <= record.confirmed_block_index < end_height
+                    and (include_spent_coins or not record.spent)
+                ):
+                    coins.add(record)
+            names = [name for name in names if name not in overlay_records]
+
+        if len(names) == 0:
+            return list(coins)
 
         async with self.db_wrapper.reader_no_transaction() as conn:
             async with conn.execute(
@@ -349,6 +469,103 @@ class CoinStore:
 
         return coins
 
+    async def get_coin_states_page(
+        self,
+        include_spent_coins: bool,
+        puzzle_hashes: Collection[bytes32],
+        min_height: uint32 = uint32(0),
+        *,
+        cursor: Optional[CoinStateCursor] = None,
+        max_items: int = COIN_STATE_PAGE_SIZE,
+    ) -> Tuple[List[CoinState], Optional[CoinStateCursor]]:
+        """
+        Returns up to max_items coin states of puzzle_hashes, ordered by (height, coin id), where the height is the
+        spent height of spent coins and the confirmed height otherwise. Only coin states after cursor are returned.
+        The second element is the cursor to pass in to get the next page, or None if this was the last one.
+        Like the other puzzle hash queries, this does not see coins buffered by write-behind.
+        """
+        if len(puzzle_hashes) == 0 or max_items <= 0:
+            return [], None
+
+        spent_sql = "" if include_spent_coins else "AND spent_index=0 "
+        # each puzzle hash (or batch of them) is read in order, up to one row more than a page, and the results are
+        # merged. Rows beyond max_items mean there's another page
+        rows: List[Tuple[int, bytes, sqlite3.Row]] = []
+        more = False
+        async with self.db_wrapper.reader_no_transaction() as conn:
+            if self.has_page_index:
+                # a seek per puzzle hash, so a page reads at most max_items + 1 rows of each, however many coins
+                # they have
+                cursor_sql = ""
+                cursor_db: Tuple[Any, ...] = ()
+                start_height = int(min_height)
+                if cursor is not None:
+                    # the height bound is what SQLite seeks to, so it starts at the cursor
+                    cursor_sql = "AND (MAX(confirmed_index, spent_index), coin_name)>(?, ?) "
+                    cursor_db = (cursor.height, cursor.coin_id)
+                    start_height = max(start_height, cursor.height)
+                for puzzle_hash in set(puzzle_hashes):
+                    async with conn.execute(
+                        f"SELECT confirmed_index, spent_index, coinbase, puzzle_hash, coin_parent, amount, timestamp, "
+                        f"coin_name, MAX(confirmed_index, spent_index) FROM coin_record "
+                        f"INDEXED BY {COIN_PUZZLE_HASH_HEIGHT_INDEX[0]} "
+                        f"WHERE puzzle_hash=? AND MAX(confirmed_index, spent_index)>=? {cursor_sql}{spent_sql}"
+                        f"ORDER BY MAX(confirmed_index, spent_index), coin_name LIMIT ?",
+                        (puzzle_hash, start_height) + cursor_db + (max_items + 1,),
+                    ) as cursor_rows:
+                        rows += [(row[8], row[7], row) for row in await cursor_rows.fetchall()]
+                    more = more or len(rows) > max_items
+                    rows = heapq.nsmallest(max_items, rows, key=lambda r: (r[0], r[1]))
+            else:
+                # without the index every page reads all coins of the puzzle hashes
+                cursor_sql = ""
+                cursor_db = ()
+                if cursor is not None:
+                    cursor_sql = "AND (height, coin_name)>(?, ?) "
+                    cursor_db = (cursor.height, cursor.coin_id)
+                for batch in to_batches(puzzle_hashes, SQLITE_MAX_VARIABLE_NUMBER):
+                    puzzle_hashes_db: Tuple[Any, ...] = tuple(batch.entries)
+                    async with conn.execute(
+                        f"SELECT confirmed_index, spent_index, coinbase, puzzle_hash, coin_parent, amount, timestamp, "
+                        f"coin_name, MAX(confirmed_index, spent_index) AS height FROM coin_record "
+                        f"INDEXED BY coin_puzzle_hash "
+                        f'WHERE puzzle_hash in ({"?," * (len(batch.entries) - 1)}?) '
+                        f"AND height>=? {cursor_sql}{spent_sql}"
+                        f"ORDER BY height, coin_name LIMIT ?",
+                        puzzle_hashes_db + (min_height,) + cursor_db + (max_items + 1,),
+                    ) as cursor_rows:
+                        rows += [(row[8], row[7], row) for row in await cursor_rows.fetchall()]
+                    more = more or len(rows) > max_items
+                    rows = heapq.nsmallest(max_items, rows, key=lambda r: (r[0], r[1]))
+
+        states = [self.row_to_coin_state(row) for _, _, row in rows]
+        if not more or len(rows) == 0:
+            return states, None
+        return states, CoinStateCursor(uint32(rows[-1][0]), bytes32(rows[-1][1]))
+
+    async def stream_coin_states_by_puzzle_hashes(
+        self,
+        include_spent_coins: bool,
+        puzzle_hashes: Collection[bytes32],
+        min_height: uint32 = uint32(0),
+        *,
+        cursor: Optional[CoinStateCursor] = None,
+        page_size: int = COIN_STATE_PAGE_SIZE,
+    ) -> AsyncIterator[CoinState]:
+        """
+        Yields every coin state of puzzle_hashes in the order of get_coin_states_page, reading page_size of them at
+        a time. The database connection is released between pages, so a slow consumer doesn't hold up other readers.
+        To resume an interrupted stream, pass in the coin_state_cursor of the last coin state processed
+        """
+        while True:
+            states, cursor = await self.get_coin_states_page(
+                include_spent_coins, puzzle_hashes, min_height, cursor=cursor, max_items=page_size
+            )
+            for state in states:
+                yield state
+            if cursor is None:
+                return
+
     async def get_coin_records_by_parent_ids(
         self,
         include_spent_coins: bool,
@@ -389,8 +606,26 @@ class CoinStore:
             return []
 
         coins: List[CoinState] = []
+        if self.overlay is not None:
+            overlay_records = self.overlay.records
+            for coin_id in coin_ids:
+                record = overlay_records.get(coin_id)
+                if (
+                    record is not None
+                    and (record.confirmed_block_index >= min_height or record.spent_block_index >= min_height)
+                    and record.confirmed_block_index <= max_height
+                    and record.spent_block_index <= max_height
+                    and (include_spent_coins or not record.spent)
+                ):
+                    coins.append(record.coin_state)
+            coins = coins[:max_items]
+            coin_ids = {coin_id for coin_id in coin_ids if coin_id not in overlay_records}
+
         async with self.db_wrapper.reader_no_transaction() as conn:
             for batch in to_batches(coin_ids, SQLITE_MAX_VARIABLE_NUMBER):
+                if len(coins) >= max_items:
+                    break
+
                 coin_ids_db: Tuple[Any, ...] = tuple(batch.entries)
 
                 max_height_sql = ""
@@ -400,7 +635,7 @@ class CoinStore:
                 async with conn.execute(
                     f"SELECT confirmed_index, spent_index, coinbase, puzzle_hash, coin_parent, amount, timestamp "
                     f'FROM coin_record WHERE coin_name in ({"?," * (len(batch.entries) - 1)}?) '
-                    f"AND (confirmed_index>=? OR spent_index>=?) {max_height_sql}"
+                    f"AND (confirmed_index>=? OR spent_index>=?) {max_height_sql} "
                     f"{'' if include_spent_coins else 'AND spent_index=0'}"
                     " LIMIT ?",
                     coin_ids_db + (min_height, min_height, max_items - len(coins)),
@@ -421,6 +656,12 @@ class CoinStore:
         coin_changes: Dict[bytes32, CoinRecord] = {}
         # Add coins that are confirmed in the reverted blocks to the list of updated coins.
         async with self.db_wrapper.writer_maybe_transaction() as conn:
+            # reorgs are rare, even while syncing. Write everything out and roll back the database
+            await self.flush()
+            if self.checkpointed:
+                await conn.execute(
+                    "UPDATE coin_store_checkpoint SET height=? WHERE height>?", (block_index, block_index)
+                )
             async with conn.execute(
                 "SELECT confirmed_index, spent_index, coinbase, puzzle_hash, "
                 "coin_parent, amount, timestamp FROM coin_record WHERE confirmed_index>?",
@@ -447,13 +688,22 @@ class CoinStore:
                         coin_changes[record.name] = record
 
             await conn.execute("UPDATE coin_record SET spent_index=0 WHERE spent_index>?", (block_index,))
+            if self.has_balance_deltas:
+                await conn.execute("DELETE FROM coin_balance_delta WHERE height>?", (block_index,))
         self.coins_added_at_height_cache = LRUCache(self.coins_added_at_height_cache.capacity)
+        self.staking_height_cache = LRUCache(self.staking_height_cache.capacity)
         return list(coin_changes.values())
 
     # Store CoinRecord in DB
     async def _add_coin_records(self, records: List[CoinRecord]) -> None:
         values2 = []
+        deltas: Dict[Tuple[bytes32, int], int] = {}
         for record in records:
+            key = (record.coin.puzzle_hash, int(record.confirmed_block_index))
+            deltas[key] = deltas.get(key, 0) + record.coin.amount
+            if record.spent_block_index > 0:
+                key = (record.coin.puzzle_hash, int(record.spent_block_index))
+                deltas[key] = deltas.get(key, 0) - record.coin.amount
             values2.append(
                 (
                     record.coin.name(),
@@ -472,6 +722,7 @@ class CoinStore:
                     "INSERT INTO coin_record VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
                     values2,
                 )
+                await self._add_balance_deltas(deltas)
 
     # Update coin_record to be spent in DB
     async def _set_spent(self, coin_names: List[bytes32], index: uint32) -> None:
@@ -482,8 +733,19 @@ class CoinStore:
 
         async with self.db_wrapper.writer_maybe_transaction() as conn:
             rows_updated: int = 0
+            deltas: Dict[Tuple[bytes32, int], int] = {}
             for batch in to_batches(coin_names, SQLITE_MAX_VARIABLE_NUMBER):
                 name_params = ",".join(["?"] * len(batch.entries))
+                if self.has_balance_deltas:
+                    async with conn.execute(
+                        f"SELECT puzzle_hash, amount FROM coin_record INDEXED BY sqlite_autoindex_coin_record_1 "
+                        f"WHERE spent_index=0 "
+                        f"AND coin_name IN ({name_params})",
+                        batch.entries,
+                    ) as cursor:
+                        for row in await cursor.fetchall():
+                            key = (bytes32(row[0]), int(index))
+                            deltas[key] = deltas.get(key, 0) - int.from_bytes(row[1], "big")
                 ret: Cursor = await conn.execute(
                     f"UPDATE coin_record INDEXED BY sqlite_autoindex_coin_record_1 "
                     f"SET spent_index={index} "
@@ -496,23 +758,172 @@ class CoinStore:
                 raise ValueError(
                     f"Invalid operation to set spent, total updates {rows_updated} expected {len(coin_names)}"
                 )
+            await self._add_balance_deltas(deltas)
+
+    async def _add_block_to_overlay(
+        self, overlay: CoinStoreOverlay, height: uint32, additions: List[CoinRecord], removals: List[bytes32]
+    ) -> None:
+        if not self.checkpointed:
+            # everything below this block is in the database
+            async with self.db_wrapper.writer_maybe_transaction() as conn:
+                await conn.execute("INSERT OR REPLACE INTO coin_store_checkpoint VALUES(0, ?)", (height - 1,))
+            self.checkpointed = True
+
+        for record in additions:
+            overlay.records[record.name] = record
+            overlay.added.add(record.name)
+            overlay.add_delta(record.coin.puzzle_hash, height, record.coin.amount)
+
+        assert len(removals) == 0 or height > 0
+        spent: List[CoinRecord] = []
+        missing: List[bytes32] = []
+        for name in removals:
+            record = overlay.records.get(name)
+            if record is None:
+                missing.append(name)
+            elif not record.spent:
+                spent.append(record)
+        if len(missing) > 0:
+            async with self.db_wrapper.reader_no_transaction() as conn:
+                for batch in to_batches(missing, SQLITE_MAX_VARIABLE_NUMBER):
+                    async with conn.execute(
+                        f"SELECT confirmed_index, spent_index, coinbase, puzzle_hash, "
+                        f"coin_parent, amount, timestamp FROM coin_record INDEXED BY sqlite_autoindex_coin_record_1 "
+                        f'WHERE spent_index=0 AND coin_name IN ({",".join(["?"] * len(batch.entries))})',
+                        batch.entries,
+                    ) as cursor:
+                        for row in await cursor.fetchall():
+                            spent.append(CoinRecord(self.row_to_coin(row), row[0], row[1], row[2], row[6]))
+        if len(spent) != len(removals):
+            raise ValueError(f"Invalid operation to set spent, total updates {len(spent)} expected {len(removals)}")
+        for record in spent:
+            overlay.records[record.name] = dataclasses.replace(record, spent_block_index=height)
+            overlay.add_delta(record.coin.puzzle_hash, height, -record.coin.amount)
+
+        overlay.blocks += 1
+        overlay.peak_height = height
+        if overlay.needs_flush():
+            await self.flush()
+
+    async def flush(self) -> None:
+        """
+        Writes the changes held in memory by write-behind to the database, in one batch
+        """
+        overlay = self.overlay
+        if overlay is None or overlay.empty():
+            return
+        start = time.monotonic()
+        # sorted by key, the B-tree pages are visited in order instead of at random
+        additions = sorted(
+            (
+                name,
+                record.confirmed_block_index,
+                record.spent_block_index,
+                int(record.coinbase),
+                record.coin.puzzle_hash,
+                record.coin.parent_coin_info,
+                uint64(record.coin.amount).stream_to_bytes(),
+                record.timestamp,
+            )
+            for name, record in overlay.records.items()
+            if name in overlay.added
+        )
+        spends = sorted(
+            (name, record.spent_block_index)
+            for name, record in overlay.records.items()
+            if name not in overlay.added
+        )
+        deltas = {
+            (puzzle_hash, height): delta
+            for puzzle_hash, heights in overlay.deltas.items()
+            for height, delta in heights.items()
+        }
+        async with self.db_wrapper.writer_maybe_transaction() as conn:
+            await conn.executemany("INSERT INTO coin_record VALUES(?, ?, ?, ?, ?, ?, ?, ?)", additions)
+            await conn.executemany(
+                "UPDATE coin_record INDEXED BY sqlite_autoindex_coin_record_1 SET spent_index=? WHERE coin_name=?",
+                [(height, name) for name, height in spends],
+            )
+            await self._add_balance_deltas(dict(sorted(deltas.items())))
+            await conn.execute("INSERT OR REPLACE INTO coin_store_checkpoint VALUES(0, ?)", (overlay.peak_height,))
+        self.checkpointed = True
+        log.info(
+            f"Height {overlay.peak_height}: flushed {overlay.blocks} blocks, {len(additions)} additions and "
+            f"{len(spends)} removals to the coin store in {time.monotonic() - start:0.2f}s"
+        )
+        overlay.clear()
+
+    def start_write_behind(self, flush_interval: int) -> None:
+        """
+        Keeps the coin changes of new blocks in memory and writes them to the database every flush_interval
+        blocks, for long syncs. Lookups by coin name, the coins added and removed at a height and the unspent
+        balance before a height include the changes held in memory, the other queries only see what has been
+        flushed. Blockchain.replay_coin_store brings the database back in line with the peak after a crash
+        """
+        if self.overlay is None:
+            self.overlay = CoinStoreOverlay(flush_interval)
+
+    async def stop_write_behind(self) -> None:
+        await self.flush()
+        self.overlay = None
+        if self.checkpointed:
+            async with self.db_wrapper.writer_maybe_transaction() as conn:
+                await conn.execute("DELETE FROM coin_store_checkpoint")
+            self.checkpointed = False
+
+    async def get_write_behind_checkpoint(self) -> Optional[uint32]:
+        async with self.db_wrapper.reader_no_transaction() as conn:
+            async with conn.execute("SELECT height FROM coin_store_checkpoint WHERE key=0") as cursor:
+                row = await cursor.fetchone()
+        return None if row is None else uint32(row[0])
+
+    def drop_overlay(self) -> None:
+        """
+        Drops the changes held in memory and the caches that may include them. The database is behind the blocks
+        until discard_write_behind is called and the blocks above its checkpoint are replayed
+        """
+        if self.overlay is not None:
+            self.overlay.clear()
+        self.coins_added_at_height_cache = LRUCache(self.coins_added_at_height_cache.capacity)
+        self.staking_height_cache = LRUCache(self.staking_height_cache.capacity)
+
+    async def discard_write_behind(self) -> Optional[uint32]:
+        """
+        Drops the changes held in memory, for when a write transaction failed after they were made. Returns the
+        height the database is written up to, if there are blocks above it that need to be replayed
+        """
+        self.drop_overlay()
+        checkpoint = await self.get_write_behind_checkpoint()
+        self.checkpointed = checkpoint is not None
+        return checkpoint
 
     async def get_unspent_coins_before_height(self, puzzle_hash: bytes32, height: uint32) -> uint128:
         staking_key = bytes48(puzzle_hash + height.to_bytes(16, "big"))
         staking: Optional[uint128] = self.staking_height_cache.get(staking_key)
         if staking is not None:
             return staking
+        # coins confirmed before height, and not spent before height
         async with self.db_wrapper.reader_no_transaction() as conn:
-            async with conn.execute(
-                "SELECT amount FROM coin_record INDEXED BY coin_puzzle_hash WHERE puzzle_hash=? "
-                "AND confirmed_index<? AND (spent_index=0 OR spent_index>=?)",
-                (puzzle_hash, height, height),
-            ) as cursor:
-                staking = uint128(0)
-                for row in await cursor.fetchall():
-                    staking += uint64.from_bytes(row[0])
-                self.staking_height_cache.put(staking_key, staking)
-                return staking
+            if self.has_balance_deltas:
+                async with conn.execute(
+                    "SELECT SUM(delta) FROM coin_balance_delta WHERE puzzle_hash=? AND height<?",
+                    (puzzle_hash, height),
+                ) as cursor:
+                    row = await cursor.fetchone()
+                    staking = uint128(0 if row is None or row[0] is None else row[0])
+            else:
+                async with conn.execute(
+                    "SELECT amount FROM coin_record INDEXED BY coin_puzzle_hash WHERE puzzle_hash=? "
+                    "AND confirmed_index<? AND (spent_index=0 OR spent_index>=?)",
+                    (puzzle_hash, height, height),
+                ) as cursor:
+                    staking = uint128(0)
+                    for row in await cursor.fetchall():
+                        staking += uint64.from_bytes(row[0])
+        if self.overlay is not None:
+            staking = uint128(staking + self.overlay.balance_delta_before(puzzle_hash, height))
+        self.staking_height_cache.put(staking_key, staking)
+        return staking
 
     async def get_coin_records_by_puzzle_hash_limit(
         self,
@@ -522,7 +933,7 @@ class CoinStore:
         start_height: uint32 = uint32(0),
         end_height: uint32 = uint32((2 ** 32) - 1),
     ) -> List[CoinRecord]:
-        coins = set()
+        coins: List[CoinRecord] = []
         async with self.db_wrapper.reader_no_transaction() as conn:
             limit_where = f" LIMIT {limit}" if limit is not None and limit > 0 else ''
             async with conn.execute(
@@ -532,7 +943,8 @@ class CoinStore:
                 f"{'' if include_spent_coins else ' AND spent_index=0'}{limit_where}",
                 (puzzle_hash, start_height, end_height),
             ) as cursor:
-                for row in await cursor.fetchall():
+                # coin_name is unique, so the rows need no deduplication
+                async for row in cursor:
                     coin = self.row_to_coin(row)
-                    coins.add(CoinRecord(coin, row[0], row[1], row[2], row[6]))
-                return list(coins)
+                    coins.append(CoinRecord(coin, row[0], row[1], row[2], row[6]))
+                return coins
@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+import dataclasses
+from typing import Dict, List, Set
+
+from greenbtc.types.blockchain_format.sized_bytes import bytes32
+from greenbtc.types.coin_record import CoinRecord
+from greenbtc.util.ints import uint32
+
+# flush once this many coin records have been buffered, regardless of the number of blocks
+COIN_STORE_OVERLAY_MAX_RECORDS = 500000
+
+
+@dataclasses.dataclass
+class CoinStoreOverlay:
+    """
+    Coin store changes that have not been written to the database yet. Used by the CoinStore while long syncing, to
+    turn the small writes of every block into one large write every flush_interval blocks.
+    """
+
+    flush_interval: int
+    max_records: int = COIN_STORE_OVERLAY_MAX_RECORDS
+    # the current state of every coin added or spent since the last flush
+    records: Dict[bytes32, CoinRecord] = dataclasses.field(default_factory=dict)
+    # the coins in records that are not in the database yet
+    added: Set[bytes32] = dataclasses.field(default_factory=set)
+    # puzzle_hash -> height -> balance delta, see CoinStore.get_unspent_coins_before_height
+    deltas: Dict[bytes32, Dict[int, int]] = dataclasses.field(default_factory=dict)
+    # number of blocks since the last flush
+    blocks: int = 0
+    # the height of the last block added
+    peak_height: int = -1
+
+    def empty(self) -> bool:
+        return self.blocks == 0
+
+    def needs_flush(self) -> bool:
+        return self.blocks >= self.flush_interval or len(self.records) >= self.max_records
+
+    def add_delta(self, puzzle_hash: bytes32, height: int, delta: int) -> None:
+        heights = self.deltas.setdefault(puzzle_hash, {})
+        heights[height] = heights.get(height, 0) + delta
+
+    def balance_delta_before(self, puzzle_hash: bytes32, height: int) -> int:
+        return sum(delta for h, delta in self.deltas.get(puzzle_hash, {}).items() if h < height)
+
+    def get_coins_added_at_height(self, height: uint32) -> List[CoinRecord]:
+        return [self.records[name] for name in self.added if self.records[name].confirmed_block_index == height]
+
+    def get_coins_removed_at_height(self, height: uint32) -> List[CoinRecord]:
+        return [record for record in self.records.values() if record.spent_block_index == height]
+
+    def clear(self) -> None:
+        self.records = {}
+        self.added = set()
+        self.deltas = {}
+        self.blocks = 0
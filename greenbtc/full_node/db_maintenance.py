@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import dataclasses
+import logging
+import sqlite3
+import time
+from typing import Any, Dict, List, Optional
+
+from greenbtc.util.db_wrapper import DBWrapper2
+
+log = logging.getLogger(__name__)
+
+# the time one step of maintenance should take at most, so it doesn't hold up
+# the next block for long
+DB_MAINTENANCE_SLICE = 0.1
+
+# the number of free pages the first incremental vacuum step releases. It's
+# adjusted to the time steps take
+VACUUM_STEP_PAGES = 256
+
+# the number of index entries ANALYZE samples, see "PRAGMA analysis_limit"
+ANALYZE_LIMIT = 1000
+
+# how often the statistics of every table are refreshed, in seconds
+ANALYZE_INTERVAL = 24 * 3600
+
+# the number of query plan changes kept for get_status()
+MAX_PLAN_CHANGES = 50
+
+# the queries whose plans are checked after ANALYZE. They're the ones of the
+# stores the node runs the most, the parameters don't matter for the plan
+PLAN_QUERIES = [
+    "SELECT * FROM coin_record WHERE coin_name=?",
+    "SELECT * FROM coin_record WHERE puzzle_hash=? AND spent_index=0",
+    "SELECT * FROM coin_record WHERE coin_parent=?",
+    "SELECT * FROM coin_record WHERE confirmed_index=?",
+    "SELECT * FROM coin_record WHERE spent_index=?",
+    "SELECT * FROM full_blocks WHERE header_hash=?",
+    "SELECT header_hash FROM full_blocks WHERE height=? AND in_main_chain=1",
+    "SELECT block FROM full_blocks WHERE height>=? AND height<=? AND in_main_chain=1",
+    "SELECT coin_id FROM hints WHERE hint=?",
+    "SELECT coin_id FROM coin_hints WHERE hint_id=?",
+    "SELECT * FROM stake_record WHERE confirmed_index>?",
+    "SELECT * FROM stake_record WHERE stake_puzzle_hash=? AND is_stake_farm=1",
+]
+
+
+@dataclasses.dataclass
+class DBMaintenance:
+    """
+    Keeps the blockchain database compact and its statistics current while the
+    node is running. The full node calls step() while it's synced and waiting
+    for the next block, each step releases some of the free pages of the
+    database, or analyzes one table.
+    """
+
+    db_wrapper: DBWrapper2
+    time_slice: float = DB_MAINTENANCE_SLICE
+    analyze_interval: float = ANALYZE_INTERVAL
+    vacuum_step_pages: int = VACUUM_STEP_PAGES
+    page_size: int = 0
+    incremental_vacuum: bool = False
+    free_pages: int = 0
+    reclaimed_pages: int = 0
+    # the tables left to analyze in this pass
+    analyze_queue: List[str] = dataclasses.field(default_factory=list)
+    last_analyze: Optional[float] = None
+    # query -> plan, as of the last pass of ANALYZE
+    query_plans: Dict[str, List[str]] = dataclasses.field(default_factory=dict)
+    plan_changes: List[Dict[str, Any]] = dataclasses.field(default_factory=list)
+    started: bool = False
+
+    async def _start(self) -> None:
+        async with self.db_wrapper.reader_no_transaction() as conn:
+            self.page_size = (await (await conn.execute("PRAGMA page_size")).fetchone())[0]
+            auto_vacuum = (await (await conn.execute("PRAGMA auto_vacuum")).fetchone())[0]
+            self.free_pages = (await (await conn.execute("PRAGMA freelist_count")).fetchone())[0]
+        # 2 is INCREMENTAL
+        self.incremental_vacuum = auto_vacuum == 2
+        if not self.incremental_vacuum and self.free_pages > 0:
+            log.info(
+                f"the blockchain database has {self.free_pages * self.page_size / 1024 / 1024:.1f} MiB of free pages "
+                "that can't be released while the node runs. To allow that, stop the node and run "
+                '"PRAGMA auto_vacuum=INCREMENTAL; VACUUM;" on the database once'
+            )
+        self.query_plans = await self._get_query_plans()
+        self.started = True
+
+    async def _get_query_plans(self) -> Dict[str, List[str]]:
+        plans: Dict[str, List[str]] = {}
+        async with self.db_wrapper.reader_no_transaction() as conn:
+            queries = list(PLAN_QUERIES)
+            if self.db_wrapper.query_stats is not None:
+                # also check the statements the node spends the most time on
+                for entry in self.db_wrapper.query_stats.to_json_list()[:10]:
+                    statement = entry["statement"].replace("?,...", "?")
+                    if statement.upper().startswith("SELECT") and statement not in queries:
+                        queries.append(statement)
+            for query in queries:
+                try:
+                    async with conn.execute(f"EXPLAIN QUERY PLAN {query}") as cursor:
+                        plans[query] = [row[3] for row in await cursor.fetchall()]
+                except sqlite3.Error:
+                    # the table may not exist in this database
+                    continue
+        return plans
+
+    async def _vacuum_step(self) -> None:
+        start = time.monotonic()
+        async with self.db_wrapper.writer() as conn:
+            # PRAGMA incremental_vacuum(N) releases one page per step of the statement, but the sqlite3 module
+            # steps statements without columns only once. Run it once per page instead
+            await conn.executemany("PRAGMA incremental_vacuum(1)", [()] * self.vacuum_step_pages)
+            free_pages = (await (await conn.execute("PRAGMA freelist_count")).fetchone())[0]
+        duration = time.monotonic() - start
+        self.reclaimed_pages += max(0, self.free_pages - free_pages)
+        self.free_pages = free_pages
+        if duration < self.time_slice / 2:
+            self.vacuum_step_pages *= 2
+        elif duration > self.time_slice and self.vacuum_step_pages > 1:
+            self.vacuum_step_pages //= 2
+        if self.free_pages == 0:
+            log.info(f"DB maintenance: reclaimed {self.reclaimed_pages * self.page_size / 1024 / 1024:.1f} MiB")
+
+    async def _analyze_step(self) -> None:
+        if len(self.analyze_queue) == 0:
+            async with self.db_wrapper.reader_no_transaction() as conn:
+                async with conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'"
+                ) as cursor:
+                    self.analyze_queue = [row[0] for row in await cursor.fetchall()]
+            if len(self.analyze_queue) == 0:
+                self.last_analyze = time.monotonic()
+                return
+
+        table = self.analyze_queue.pop()
+        start = time.monotonic()
+        async with self.db_wrapper.writer() as conn:
+            # sample the indexes instead of reading all of them
+            await conn.execute(f"PRAGMA analysis_limit={ANALYZE_LIMIT}")
+            await conn.execute(f'ANALYZE "{table}"')
+        log.debug(f"DB maintenance: analyzed {table} in {time.monotonic() - start:.2f} s")
+        if len(self.analyze_queue) > 0:
+            return
+
+        self.last_analyze = time.monotonic()
+        plans = await self._get_query_plans()
+        for query, plan in plans.items():
+            old_plan = self.query_plans.get(query)
+            if old_plan is None or old_plan == plan:
+                continue
+            log.warning(f"DB maintenance: the query plan of {query} changed from {old_plan} to {plan}")
+            self.plan_changes.append({"query": query, "old_plan": old_plan, "new_plan": plan, "time": time.time()})
+        del self.plan_changes[:-MAX_PLAN_CHANGES]
+        self.query_plans = plans
+        log.info("DB maintenance: updated the statistics of the blockchain database")
+
+    async def step(self) -> bool:
+        """
+        Runs one step of maintenance. Returns False if there's nothing left to do
+        """
+        if not self.started:
+            await self._start()
+            return True
+        if self.incremental_vacuum and self.free_pages > 0:
+            await self._vacuum_step()
+            return True
+        if (
+            len(self.analyze_queue) > 0
+            or self.last_analyze is None
+            or time.monotonic() - self.last_analyze >= self.analyze_interval
+        ):
+            await self._analyze_step()
+            return True
+        if self.incremental_vacuum:
+            # pick up the pages freed since the last check
+            async with self.db_wrapper.reader_no_transaction() as conn:
+                self.free_pages = (await (await conn.execute("PRAGMA freelist_count")).fetchone())[0]
+        return False
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            "incremental_vacuum": self.incremental_vacuum,
+            "free_bytes": self.free_pages * self.page_size,
+            "reclaimed_bytes": self.reclaimed_pages * self.page_size,
+            "seconds_since_analyze": None if self.last_analyze is None else time.monotonic() - self.last_analyze,
+            "plan_changes": self.plan_changes,
+        }
@@ -36,17 +36,26 @@ from greenbtc.cmds.init_funcs import greenbtc_full_version_str
 from greenbtc.consensus.block_body_validation import ForkInfo
 from greenbtc.consensus.block_creation import unfinished_block_to_full_block
 from greenbtc.consensus.block_record import BlockRecord
-from greenbtc.consensus.blockchain import AddBlockResult, Blockchain, BlockchainMutexPriority, StateChangeSummary
+from greenbtc.consensus.blockchain import (
+    STAKE_CACHE_SIZE,
+    AddBlockResult,
+    Blockchain,
+    BlockchainMutexPriority,
+    StateChangeSummary,
+)
 from greenbtc.consensus.blockchain_interface import BlockchainInterface
 from greenbtc.consensus.constants import ConsensusConstants
 from greenbtc.consensus.cost_calculator import NPCResult
 from greenbtc.consensus.difficulty_adjustment import get_next_sub_slot_iters_and_difficulty
+from greenbtc.consensus.full_block_to_block_record import block_to_block_record
 from greenbtc.consensus.make_sub_epoch_summary import next_sub_epoch_summary
 from greenbtc.consensus.multiprocess_validation import PreValidationResult
 from greenbtc.consensus.pot_iterations import calculate_sp_iters
+from greenbtc.full_node.block_download import BlockDownloader
 from greenbtc.full_node.block_store import BlockStore
 from greenbtc.full_node.bundle_tools import detect_potential_template_generator
 from greenbtc.full_node.coin_store import CoinStore
+from greenbtc.full_node.db_maintenance import DBMaintenance
 from greenbtc.full_node.full_node_api import FullNodeAPI
 from greenbtc.full_node.full_node_store import FullNodeStore, FullNodeStorePeakResult
 from greenbtc.full_node.hint_management import get_hints_and_subscription_coin_ids
@@ -59,7 +68,7 @@ from greenbtc.full_node.sync_store import Peak, SyncStore
 from greenbtc.full_node.tx_processing_queue import TransactionQueue
 from greenbtc.full_node.weight_proof import WeightProofHandler
 from greenbtc.protocols import farmer_protocol, full_node_protocol, timelord_protocol, wallet_protocol
-from greenbtc.protocols.full_node_protocol import RequestBlocks, RespondBlock, RespondBlocks, RespondSignagePoint
+from greenbtc.protocols.full_node_protocol import RequestBlocks, RespondBlock, RespondSignagePoint
 from greenbtc.protocols.protocol_message_types import ProtocolMessageTypes
 from greenbtc.protocols.wallet_protocol import CoinState, CoinStateUpdate
 from greenbtc.rpc.rpc_server import StateChangedProtocol
@@ -85,10 +94,12 @@ from greenbtc.types.transaction_queue_entry import TransactionQueueEntry
 from greenbtc.types.unfinished_block import UnfinishedBlock
 from greenbtc.types.weight_proof import WeightProof
 from greenbtc.util import cached_bls
+from greenbtc.util.augmented_chain import AugmentedBlockchain
 from greenbtc.util.bech32m import encode_puzzle_hash
 from greenbtc.util.check_fork_next_block import check_fork_next_block
 from greenbtc.util.condition_tools import pkm_pairs
 from greenbtc.util.config import PEER_DB_PATH_KEY_DEPRECATED, process_config_start_method
+from greenbtc.util.db_query_stats import QueryStats
 from greenbtc.util.db_synchronous import db_synchronous_on
 from greenbtc.util.db_version import lookup_db_version, set_db_version_async
 from greenbtc.util.db_wrapper import DBWrapper2, manage_connection
@@ -118,6 +129,15 @@ class WalletUpdate:
     hints: Dict[bytes32, bytes32]
 
 
+@dataclasses.dataclass(frozen=True)
+class PrevalidatedBatch:
+    peer: WSGreenBTCConnection
+    blocks: List[FullBlock]
+    first_unknown: int  # The index of the first block we don't have, the ones before it aren't pre-validated
+    pre_validation_results: List[PreValidationResult]
+    err: Optional[Err]  # The pre-validation error of the batch, if any
+
+
 @final
 @dataclasses.dataclass
 class FullNode:
@@ -143,6 +163,8 @@ class FullNode:
     full_node_peers: Optional[FullNodePeers] = None
     sync_store: SyncStore = dataclasses.field(default_factory=SyncStore)
     uncompact_task: Optional[asyncio.Task[None]] = None
+    db_maintenance: Optional[DBMaintenance] = None
+    _db_maintenance_task: Optional[asyncio.Task[None]] = None
     compact_vdf_requests: Set[bytes32] = dataclasses.field(default_factory=set)
     # TODO: Logging isn't setup yet so the log entries related to parsing the
     #       config would end up on stdout if handled here.
@@ -241,12 +263,19 @@ class FullNode:
         db_sync = db_synchronous_on(self.config.get("db_sync", "auto"))
         self.log.info(f"opening blockchain DB: synchronous={db_sync}")
 
+        query_stats: Optional[QueryStats] = None
+        slow_query_ms = self.config.get("log_slow_queries_ms", 0)
+        if self.config.get("db_query_stats", False) or slow_query_ms > 0:
+            query_stats = QueryStats(slow_query_threshold=slow_query_ms / 1000)
+            self.log.info(f"recording SQL query stats, logging queries slower than {slow_query_ms} ms")
+
         async with DBWrapper2.managed(
             self.db_path,
             db_version=db_version,
-            reader_count=4,
+            reader_count=self.config.get("db_readers", 4),
             log_path=sql_log_path,
             synchronous=db_sync,
+            query_stats=query_stats,
         ) as self._db_wrapper:
             if self.db_wrapper.db_version != 2:
                 async with self.db_wrapper.reader_no_transaction() as conn:
@@ -265,7 +294,9 @@ class FullNode:
                                 # empty except it has the database_version table
                                 pass
 
-            self._block_store = await BlockStore.create(self.db_wrapper)
+            self._block_store = await BlockStore.create(
+                self.db_wrapper, compression_level=self.config.get("block_compression_level", 3)
+            )
             self._hint_store = await HintStore.create(self.db_wrapper)
             self._coin_store = await CoinStore.create(self.db_wrapper)
             self._stake_record_store = await StakeRecordStore.create(self.db_wrapper)
@@ -284,6 +315,7 @@ class FullNode:
                 reserved_cores=reserved_cores,
                 multiprocessing_context=self.multiprocessing_context,
                 single_threaded=single_threaded,
+                stake_cache_size=self.config.get("stake_coefficient_cache_size", STAKE_CACHE_SIZE),
             )
 
             self._mempool_manager = MempoolManager(
@@ -348,6 +380,11 @@ class FullNode:
                 )
             if self.wallet_sync_task is None or self.wallet_sync_task.done():
                 self.wallet_sync_task = asyncio.create_task(self._wallets_sync_task_handler())
+            if self.config.get("db_maintenance", True):
+                self.db_maintenance = DBMaintenance(self.db_wrapper)
+                self._db_maintenance_task = asyncio.create_task(
+                    self._run_db_maintenance(self.config.get("db_maintenance_idle_seconds", 5))
+                )
 
             self.initialized = True
             if self.full_node_peers is not None:
@@ -359,10 +396,7 @@ class FullNode:
                 if self._init_weight_proof is not None:
                     self._init_weight_proof.cancel()
 
-                # blockchain is created in _start and in certain cases it may not exist here during _close
-                if self._blockchain is not None:
-                    self.blockchain.shut_down()
-                # same for mempool_manager
+                # mempool_manager is created in _start and in certain cases it may not exist here during _close
                 if self._mempool_manager is not None:
                     self.mempool_manager.shut_down()
 
@@ -374,6 +408,7 @@ class FullNode:
                     self._transaction_queue_task.cancel()
                 cancel_task_safe(task=self.wallet_sync_task, log=self.log)
                 cancel_task_safe(task=self._sync_task, log=self.log)
+                cancel_task_safe(task=self._db_maintenance_task, log=self.log)
 
                 for task_id, task in list(self.full_node_store.tx_fetch_tasks.items()):
                     cancel_task_safe(task, self.log)
@@ -382,6 +417,13 @@ class FullNode:
                 if self._sync_task is not None:
                     with contextlib.suppress(asyncio.CancelledError):
                         await self._sync_task
+                if self._coin_store is not None:
+                    # write out the coins of a sync that was interrupted by the shutdown
+                    await self.coin_store.stop_write_behind()
+                # the blockchain may not exist either. It's shut down last, as it closes the height map files the
+                # tasks awaited above may still read
+                if self._blockchain is not None:
+                    self.blockchain.shut_down()
 
     @property
     def block_store(self) -> BlockStore:
@@ -997,6 +1039,9 @@ class FullNode:
             # Ensures that the fork point does not change
             async with self.blockchain.priority_mutex.acquire(priority=BlockchainMutexPriority.high):
                 await self.blockchain.warmup(fork_point)
+                write_behind_blocks = self.config.get("coin_store_write_behind_blocks", 0)
+                if write_behind_blocks > 0:
+                    self.coin_store.start_write_behind(write_behind_blocks)
                 await self.sync_from_fork_point(fork_point, target_peak.height, target_peak.header_hash, summaries)
         except asyncio.CancelledError:
             self.log.warning("Syncing failed, CancelledError")
@@ -1070,6 +1115,7 @@ class FullNode:
         summaries: List[SubEpochSummary],
     ) -> None:
         buffer_size = 4
+        prevalidate_ahead = 2
         self.log.info(f"Start syncing from fork point at {fork_point_height} up to {target_peak_sb_height}")
         peers_with_peak: List[WSGreenBTCConnection] = self.get_peers_with_peak(peak_hash)
         fork_point_height = await check_fork_next_block(
@@ -1084,49 +1130,86 @@ class FullNode:
         async def fetch_block_batches(
             batch_queue: asyncio.Queue[Optional[Tuple[WSGreenBTCConnection, List[FullBlock]]]]
         ) -> None:
-            start_height, end_height = 0, 0
-            new_peers_with_peak: List[WSGreenBTCConnection] = peers_with_peak[:]
+            downloader = BlockDownloader(
+                fork_point_height,
+                target_peak_sb_height,
+                batch_size,
+                lambda: self.get_peers_with_peak(peak_hash),
+                self.sync_store.peers_changed,
+            )
+
+            async def output(peer: WSGreenBTCConnection, blocks: List[FullBlock]) -> None:
+                await batch_queue.put((peer, blocks))
+
             try:
-                # block request ranges are *inclusive*, this requires some
-                # gymnastics of this range (+1 to make it exclusive, like normal
-                # ranges) and then -1 when forming the request message
-                for start_height in range(fork_point_height, target_peak_sb_height + 1, batch_size):
-                    end_height = min(target_peak_sb_height, start_height + batch_size - 1)
-                    request = RequestBlocks(uint32(start_height), uint32(end_height), True)
-                    fetched = False
-                    for peer in random.sample(new_peers_with_peak, len(new_peers_with_peak)):
-                        if peer.closed:
-                            continue
-                        response = await peer.call_api(FullNodeAPI.request_blocks, request, timeout=30)
-                        if response is None:
-                            await peer.close()
-                        elif isinstance(response, RespondBlocks):
-                            await batch_queue.put((peer, response.blocks))
-                            fetched = True
-                            break
-                    if fetched is False:
-                        self.log.error(f"failed fetching {start_height} to {end_height} from peers")
-                        return
-                    if self.sync_store.peers_changed.is_set():
-                        new_peers_with_peak = self.get_peers_with_peak(peak_hash)
-                        self.sync_store.peers_changed.clear()
+                await downloader.run(output)
             except Exception as e:
-                self.log.error(f"Exception fetching {start_height} to {end_height} from peer {e}")
-            finally:
-                # finished signal with None
-                await batch_queue.put(None)
+                self.log.error(
+                    f"Exception fetching {downloader.next_output} to {target_peak_sb_height} from peers {e}"
+                )
+            except BaseException:
+                # cancelled, the other tasks are too. Waiting for room in the queue could block forever
+                with contextlib.suppress(asyncio.QueueFull):
+                    batch_queue.put_nowait(None)
+                raise
+            # finished signal with None
+            await batch_queue.put(None)
+
+        # the blocks pre-validated, but not added to the chain yet
+        augmented_chain = AugmentedBlockchain(self.blockchain)
 
         async def validate_block_batches(
-            inner_batch_queue: asyncio.Queue[Optional[Tuple[WSGreenBTCConnection, List[FullBlock]]]]
+            inner_batch_queue: asyncio.Queue[Optional[Tuple[WSGreenBTCConnection, List[FullBlock]]]],
+            prevalidated_queue: asyncio.Queue[Optional[PrevalidatedBatch]],
         ) -> None:
+            # pre-validates the batches in order, while the ones before them are
+            # added to the chain by ingest_blocks()
+            try:
+                while True:
+                    res: Optional[Tuple[WSGreenBTCConnection, List[FullBlock]]] = await inner_batch_queue.get()
+                    if res is None:
+                        self.log.debug("done fetching blocks")
+                        break
+                    peer, blocks = res
+                    first_unknown = await self.first_unknown_block(blocks)
+                    blocks_to_validate = blocks[first_unknown:]
+                    pre_validation_results: List[PreValidationResult] = []
+                    err: Optional[Err] = None
+                    if len(blocks_to_validate) > 0:
+                        pre_validation_results, err = await self.prevalidate_blocks(
+                            blocks_to_validate, peer.get_peer_logging(), summaries, augmented_chain
+                        )
+                    if err is None:
+                        # the next batches are validated on top of these blocks
+                        for block, result in zip(blocks_to_validate, pre_validation_results):
+                            assert result.required_iters is not None
+                            block_record = block_to_block_record(
+                                self.constants, augmented_chain, result.required_iters, block, None
+                            )
+                            augmented_chain.add_extra_block(block, block_record)
+                    await prevalidated_queue.put(
+                        PrevalidatedBatch(peer, blocks, first_unknown, pre_validation_results, err)
+                    )
+                    if err is not None:
+                        # the blocks after an invalid one can't be added
+                        break
+            except BaseException:
+                # failed or cancelled, and ingest_blocks is cancelled along with this task. If ingest_blocks failed,
+                # the queue may be full with nothing left to take from it, so don't wait for room
+                with contextlib.suppress(asyncio.QueueFull):
+                    prevalidated_queue.put_nowait(None)
+                raise
+            # finished signal with None
+            await prevalidated_queue.put(None)
+
+        async def ingest_blocks(prevalidated_queue: asyncio.Queue[Optional[PrevalidatedBatch]]) -> None:
             fork_info: Optional[ForkInfo] = None
 
             while True:
-                res: Optional[Tuple[WSGreenBTCConnection, List[FullBlock]]] = await inner_batch_queue.get()
-                if res is None:
-                    self.log.debug("done fetching blocks")
+                batch: Optional[PrevalidatedBatch] = await prevalidated_queue.get()
+                if batch is None:
                     return None
-                peer, blocks = res
+                peer, blocks = batch.peer, batch.blocks
                 start_height = blocks[0].height
                 end_height = blocks[-1].height
 
@@ -1152,12 +1235,19 @@ class FullNode:
                             assert fork_hash is not None
                             fork_info = ForkInfo(fork_point_height - 1, fork_point_height - 1, fork_hash)
 
-                success, state_change_summary, err = await self.add_block_batch(
-                    blocks,
-                    peer.get_peer_logging(),
-                    fork_info,
-                    summaries,
-                )
+                success: bool = False
+                state_change_summary: Optional[StateChangeSummary] = None
+                err: Optional[Err] = batch.err
+                if err is None:
+                    if fork_info is not None:
+                        await self.skip_known_blocks(blocks, batch.first_unknown, fork_info)
+                    success, state_change_summary, err = await self.add_prevalidated_blocks(
+                        blocks[batch.first_unknown :],
+                        batch.pre_validation_results,
+                        peer.get_peer_logging(),
+                        fork_info,
+                    )
+                    augmented_chain.remove_added_blocks()
                 if success is False:
                     await peer.close(600)
                     # check CHIP-0013 exception
@@ -1186,14 +1276,21 @@ class FullNode:
         batch_queue_input: asyncio.Queue[Optional[Tuple[WSGreenBTCConnection, List[FullBlock]]]] = asyncio.Queue(
             maxsize=buffer_size
         )
+        # bounds the number of batches pre-validated ahead of the one being added
+        prevalidated_queue: asyncio.Queue[Optional[PrevalidatedBatch]] = asyncio.Queue(maxsize=prevalidate_ahead)
         fetch_task = asyncio.Task(fetch_block_batches(batch_queue_input))
-        validate_task = asyncio.Task(validate_block_batches(batch_queue_input))
+        validate_task = asyncio.Task(validate_block_batches(batch_queue_input, prevalidated_queue))
+        ingest_task = asyncio.Task(ingest_blocks(prevalidated_queue))
         try:
             with log_exceptions(log=self.log, message="sync from fork point failed"):
-                await asyncio.gather(fetch_task, validate_task)
+                await asyncio.gather(fetch_task, validate_task, ingest_task)
         except Exception:
-            assert validate_task.done()
-            fetch_task.cancel()  # no need to cancel validate_task, if we end up here validate_task is already done
+            # the other tasks may still be running, waiting for the failed one
+            fetch_task.cancel()
+            validate_task.cancel()
+            ingest_task.cancel()
+            # wait for them to stop, and retrieve their exceptions
+            await asyncio.gather(fetch_task, validate_task, ingest_task, return_exceptions=True)
 
     def get_peers_with_peak(self, peak_hash: bytes32) -> List[WSGreenBTCConnection]:
         peer_ids: Set[bytes32] = self.sync_store.get_peers_that_have_peak([peak_hash])
@@ -1259,22 +1356,39 @@ class FullNode:
         # Precondition: All blocks must be contiguous blocks, index i+1 must be the parent of index i
         # Returns a bool for success, as well as a StateChangeSummary if the peak was advanced
 
+        first_unknown = await self.first_unknown_block(all_blocks)
+        if fork_info is not None:
+            await self.skip_known_blocks(all_blocks, first_unknown, fork_info)
+        blocks_to_validate = all_blocks[first_unknown:]
+        if len(blocks_to_validate) == 0:
+            return True, None, None
+
+        pre_validation_results, err = await self.prevalidate_blocks(blocks_to_validate, peer_info, wp_summaries)
+        if err is not None:
+            return False, None, err
+        return await self.add_prevalidated_blocks(blocks_to_validate, pre_validation_results, peer_info, fork_info)
+
+    async def first_unknown_block(self, all_blocks: List[FullBlock]) -> int:
+        """
+        Returns the index of the first block of all_blocks we haven't validated
+        yet, len(all_blocks) if we have all of them
+        """
+        for i, block in enumerate(all_blocks):
+            if not await self.blockchain.contains_block_from_db(block.header_hash):
+                return i
+        return len(all_blocks)
+
+    async def skip_known_blocks(self, all_blocks: List[FullBlock], first_unknown: int, fork_info: ForkInfo) -> None:
+        """
+        Updates fork_info with the blocks before first_unknown, which we have
+        validated already
+        """
         block_dict: Dict[bytes32, FullBlock] = {}
         for block in all_blocks:
             block_dict[block.header_hash] = block
 
-        blocks_to_validate: List[FullBlock] = []
-        for i, block in enumerate(all_blocks):
+        for block in all_blocks[:first_unknown]:
             header_hash = block.header_hash
-            if not await self.blockchain.contains_block_from_db(header_hash):
-                blocks_to_validate = all_blocks[i:]
-                break
-
-            if fork_info is None:
-                continue
-            # the below section updates the fork_info object, if
-            # there is one.
-
             # TODO: it seems unnecessary to request overlapping block ranges
             # when syncing
             if block.height <= fork_info.peak_height:
@@ -1297,14 +1411,27 @@ class FullNode:
                 await self.blockchain.advance_fork_info(block, fork_info, block_dict)
                 await self.blockchain.run_single_block(block, fork_info, block_dict)
 
-        if len(blocks_to_validate) == 0:
-            return True, None, None
-
+    async def prevalidate_blocks(
+        self,
+        blocks_to_validate: List[FullBlock],
+        peer_info: PeerInfo,
+        wp_summaries: Optional[List[SubEpochSummary]],
+        augmented_chain: Optional[AugmentedBlockchain] = None,
+    ) -> Tuple[List[PreValidationResult], Optional[Err]]:
+        """
+        Pre-validates blocks we don't have yet, against augmented_chain if
+        their ancestors aren't added to the blockchain yet. Returns the results
+        and the first error found
+        """
         # Validates signatures in multiprocessing since they take a while, and we don't have cached transactions
         # for these blocks (unlike during normal operation where we validate one at a time)
         pre_validate_start = time.monotonic()
         pre_validation_results: List[PreValidationResult] = await self.blockchain.pre_validate_blocks_multiprocessing(
-            blocks_to_validate, {}, wp_summaries=wp_summaries, validate_signatures=True
+            blocks_to_validate,
+            {},
+            wp_summaries=wp_summaries,
+            validate_signatures=True,
+            augmented_chain=augmented_chain,
         )
         pre_validate_end = time.monotonic()
         pre_validate_time = pre_validate_end - pre_validate_start
@@ -1317,8 +1444,17 @@ class FullNode:
         for i, block in enumerate(blocks_to_validate):
             if pre_validation_results[i].error is not None:
                 self.log.error(f"Invalid block from peer: {peer_info} {Err(pre_validation_results[i].error)}")
-                return False, None, Err(pre_validation_results[i].error)
+                return pre_validation_results, Err(pre_validation_results[i].error)
+        return pre_validation_results, None
 
+    async def add_prevalidated_blocks(
+        self,
+        blocks_to_validate: List[FullBlock],
+        pre_validation_results: List[PreValidationResult],
+        peer_info: PeerInfo,
+        fork_info: Optional[ForkInfo],
+    ) -> Tuple[bool, Optional[StateChangeSummary], Optional[Err]]:
+        add_start = time.monotonic()
         agg_state_change_summary: Optional[StateChangeSummary] = None
 
         for i, block in enumerate(blocks_to_validate):
@@ -1356,7 +1492,7 @@ class FullNode:
         if agg_state_change_summary is not None:
             self._state_changed("new_peak")
             self.log.debug(
-                f"Total time for {len(blocks_to_validate)} blocks: {time.monotonic() - pre_validate_start}, "
+                f"Total time for adding {len(blocks_to_validate)} blocks: {time.monotonic() - add_start}, "
                 f"advanced: True"
             )
         return True, agg_state_change_summary, None
@@ -1370,6 +1506,8 @@ class FullNode:
         self.sync_store.set_long_sync(False)
         self.sync_store.set_sync_mode(False)
         self._state_changed("sync_mode")
+        async with self.blockchain.priority_mutex.acquire(priority=BlockchainMutexPriority.high):
+            await self.coin_store.stop_write_behind()
         if self._server is None:
             return None
 
@@ -2638,6 +2776,40 @@ class FullNode:
 
         self.bad_peak_cache = new_cache
 
+    async def _run_db_maintenance(self, idle_seconds: float) -> None:
+        """
+        Runs steps of database maintenance while the node is synced and no new
+        block has arrived for idle_seconds, until the next block arrives
+        """
+        assert self.db_maintenance is not None
+        last_peak_height: Optional[uint32] = None
+        last_peak_change = time.monotonic()
+        # when there's nothing to do, check again after this time
+        next_check = 0.0
+        try:
+            while not self._shut_down:
+                await asyncio.sleep(1)
+                peak_height = self.blockchain.get_peak_height()
+                if peak_height != last_peak_height:
+                    last_peak_height = peak_height
+                    last_peak_change = time.monotonic()
+                    continue
+                if time.monotonic() - last_peak_change < idle_seconds or time.monotonic() < next_check:
+                    continue
+                if not await self.synced() or self.sync_store.get_long_sync():
+                    continue
+
+                while not self._shut_down and self.blockchain.get_peak_height() == last_peak_height:
+                    if not await self.db_maintenance.step():
+                        next_check = time.monotonic() + 600
+                        break
+                    # leave the database to others between steps
+                    await asyncio.sleep(self.db_maintenance.time_slice)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.log.error(f"Exception in DB maintenance: {e} {traceback.format_exc()}")
+
     async def broadcast_uncompact_blocks(
         self, uncompact_interval_scan: int, target_uncompact_proofs: int, sanitize_weight_proof_only: bool
     ) -> None:
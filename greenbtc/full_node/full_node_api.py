@@ -58,6 +58,7 @@ from greenbtc.types.spend_bundle import SpendBundle
 from greenbtc.types.transaction_queue_entry import TransactionQueueEntry
 from greenbtc.types.unfinished_block import UnfinishedBlock
 from greenbtc.util.api_decorators import api_request
+from greenbtc.util.db_wrapper import peer_reads
 from greenbtc.util.full_block_utils import header_block_from_block
 from greenbtc.util.generator_tools import get_block_header, tx_removals_and_additions
 from greenbtc.util.hash import std_hash
@@ -311,6 +312,7 @@ class FullNodeAPI:
         return None
 
     @api_request(reply_types=[ProtocolMessageTypes.respond_block, ProtocolMessageTypes.reject_block])
+    @peer_reads
     async def request_block(self, request: full_node_protocol.RequestBlock) -> Optional[Message]:
         if not self.full_node.blockchain.contains_height(request.height):
             reject = RejectBlock(request.height)
@@ -328,6 +330,7 @@ class FullNodeAPI:
         return make_msg(ProtocolMessageTypes.reject_block, RejectBlock(request.height))
 
     @api_request(reply_types=[ProtocolMessageTypes.respond_blocks, ProtocolMessageTypes.reject_blocks])
+    @peer_reads
     async def request_blocks(self, request: full_node_protocol.RequestBlocks) -> Optional[Message]:
         # note that we treat the request range as *inclusive*, but we check the
         # size before we bump end_height. So MAX_BLOCK_COUNT_PER_REQUESTS is off
@@ -364,28 +367,25 @@ class FullNodeAPI:
                 full_node_protocol.RespondBlocks(request.start_height, request.end_height, blocks),
             )
         else:
-            blocks_bytes: List[bytes] = []
-            for i in range(request.start_height, request.end_height + 1):
-                header_hash_i = self.full_node.blockchain.height_to_hash(uint32(i))
-                if header_hash_i is None:
-                    reject = RejectBlocks(request.start_height, request.end_height)
-                    return make_msg(ProtocolMessageTypes.reject_blocks, reject)
-                block_bytes: Optional[bytes] = await self.full_node.block_store.get_full_block_bytes(header_hash_i)
-                if block_bytes is None:
-                    reject = RejectBlocks(request.start_height, request.end_height)
-                    msg = make_msg(ProtocolMessageTypes.reject_blocks, reject)
-                    return msg
-
-                blocks_bytes.append(block_bytes)
-
-            respond_blocks_manually_streamed: bytes = (
-                uint32(request.start_height).stream_to_bytes()
-                + uint32(request.end_height).stream_to_bytes()
-                + uint32(len(blocks_bytes)).stream_to_bytes()
-            )
-            for block_bytes in blocks_bytes:
-                respond_blocks_manually_streamed += block_bytes
-            msg = make_msg(ProtocolMessageTypes.respond_blocks, respond_blocks_manually_streamed)
+            # the serialized blocks are appended to the RespondBlocks message as they are read, in one query, without
+            # parsing them
+            respond_blocks_manually_streamed = bytearray()
+            respond_blocks_manually_streamed += uint32(request.start_height).stream_to_bytes()
+            respond_blocks_manually_streamed += uint32(request.end_height).stream_to_bytes()
+            respond_blocks_manually_streamed += uint32(request.end_height - request.start_height + 1).stream_to_bytes()
+            num_blocks = 0
+            async for header_hash_i, block_bytes in self.full_node.block_store.stream_block_bytes_in_range(
+                request.start_height, request.end_height
+            ):
+                # the database and the blockchain may disagree on the main chain while a reorg is being applied.
+                # The stream isn't cut short, so the database connection is released when it ends
+                if header_hash_i == self.full_node.blockchain.height_to_hash(uint32(request.start_height + num_blocks)):
+                    respond_blocks_manually_streamed += block_bytes
+                    num_blocks += 1
+            if num_blocks != request.end_height - request.start_height + 1:
+                reject = RejectBlocks(request.start_height, request.end_height)
+                return make_msg(ProtocolMessageTypes.reject_blocks, reject)
+            msg = make_msg(ProtocolMessageTypes.respond_blocks, bytes(respond_blocks_manually_streamed))
 
         return msg
 
@@ -1130,6 +1130,7 @@ class FullNodeAPI:
             return msg
 
     @api_request()
+    @peer_reads
     async def request_block_header(self, request: wallet_protocol.RequestBlockHeader) -> Optional[Message]:
         header_hash = self.full_node.blockchain.height_to_hash(request.height)
         if header_hash is None:
@@ -1171,6 +1172,7 @@ class FullNodeAPI:
         return msg
 
     @api_request()
+    @peer_reads
     async def request_additions(self, request: wallet_protocol.RequestAdditions) -> Optional[Message]:
         if request.header_hash is None:
             header_hash: Optional[bytes32] = self.full_node.blockchain.height_to_hash(request.height)
@@ -1226,6 +1228,7 @@ class FullNodeAPI:
         return make_msg(ProtocolMessageTypes.respond_additions, response)
 
     @api_request()
+    @peer_reads
     async def request_removals(self, request: wallet_protocol.RequestRemovals) -> Optional[Message]:
         block: Optional[FullBlock] = await self.full_node.block_store.get_full_block(request.header_hash)
 
@@ -1332,6 +1335,7 @@ class FullNodeAPI:
         return make_msg(ProtocolMessageTypes.transaction_ack, response)
 
     @api_request()
+    @peer_reads
     async def request_puzzle_solution(self, request: wallet_protocol.RequestPuzzleSolution) -> Optional[Message]:
         coin_name = request.coin_name
         height = request.height
@@ -1369,6 +1373,7 @@ class FullNodeAPI:
         return response_msg
 
     @api_request()
+    @peer_reads
     async def request_block_headers(self, request: wallet_protocol.RequestBlockHeaders) -> Optional[Message]:
         """Returns header blocks by directly streaming bytes into Message
 
@@ -1416,6 +1421,7 @@ class FullNodeAPI:
         return make_msg(ProtocolMessageTypes.respond_block_headers, respond_header_blocks_manually_streamed)
 
     @api_request()
+    @peer_reads
     async def request_header_blocks(self, request: wallet_protocol.RequestHeaderBlocks) -> Optional[Message]:
         """DEPRECATED: please use RequestBlockHeaders"""
         if (
@@ -1520,6 +1526,7 @@ class FullNodeAPI:
         return None
 
     @api_request(peer_required=True)
+    @peer_reads
     async def register_interest_in_puzzle_hash(
         self, request: wallet_protocol.RegisterForPhUpdates, peer: WSGreenBTCConnection
     ) -> Message:
@@ -1553,12 +1560,9 @@ class FullNodeAPI:
 
         hint_coin_ids: Set[bytes32] = set()
         if max_items > 0:
-            for puzzle_hash in puzzle_hashes:
-                ph_hint_coins = await self.full_node.hint_store.get_coin_ids(puzzle_hash, max_items=max_items)
-                hint_coin_ids.update(ph_hint_coins)
-                max_items -= len(ph_hint_coins)
-                if max_items <= 0:
-                    break
+            hint_coins = await self.full_node.hint_store.get_coin_ids_for_hints(puzzle_hashes, max_items=max_items)
+            hint_coin_ids.update(hint_coins)
+            max_items -= len(hint_coins)
 
         hint_states: List[CoinState] = []
         if len(hint_coin_ids) > 0:
@@ -1592,6 +1596,7 @@ class FullNodeAPI:
         return msg
 
     @api_request(peer_required=True)
+    @peer_reads
     async def register_interest_in_coin(
         self, request: wallet_protocol.RegisterForCoinUpdates, peer: WSGreenBTCConnection
     ) -> Message:
@@ -1616,6 +1621,7 @@ class FullNodeAPI:
         return msg
 
     @api_request()
+    @peer_reads
     async def request_children(self, request: wallet_protocol.RequestChildren) -> Optional[Message]:
         coin_records: List[CoinRecord] = await self.full_node.coin_store.get_coin_records_by_parent_ids(
             True, [request.coin_name]
@@ -1686,14 +1692,15 @@ class FullNodeAPI:
     async def request_stake_coefficients(
         self, request: farmer_protocol.RequestStakeCoefficients
     ) -> Optional[Message]:
-        stake_coefficients: List[Tuple[G1Element, uint64]] = []
-        for farmer_public_key in request.farmer_public_keys:
-            coefficient = await self.full_node.blockchain.get_stake_coefficient(request.height, farmer_public_key)
-            stake_coefficients.append((farmer_public_key, coefficient))
+        coefficients = await self.full_node.blockchain.get_stake_coefficients(
+            request.height, request.farmer_public_keys
+        )
+        stake_coefficients: List[Tuple[G1Element, uint64]] = list(zip(request.farmer_public_keys, coefficients))
         response = farmer_protocol.FarmerStakeCoefficients(stake_coefficients)
         return make_msg(ProtocolMessageTypes.respond_stake_coefficients, response)
 
     @api_request()
+    @peer_reads
     async def request_stake_farm_count(
         self, request: wallet_protocol.RequestStakeFarmCount
     ) -> Optional[Message]:
@@ -1702,6 +1709,7 @@ class FullNodeAPI:
         return make_msg(ProtocolMessageTypes.respond_stake_farm_count, response)
 
     @api_request()
+    @peer_reads
     async def request_coin_records_by_puzzle_hash(
         self, request: wallet_protocol.RequestCoinRecords
     ) -> Optional[Message]:
@@ -1721,3 +1729,23 @@ class FullNodeAPI:
         )
         response = wallet_protocol.RespondCoinRecords(coinRecords)
         return make_msg(ProtocolMessageTypes.respond_coin_records_by_puzzle_hash, response)
+
+    @api_request(
+        reply_types=[ProtocolMessageTypes.respond_coin_states_page, ProtocolMessageTypes.reject_coin_states_page]
+    )
+    @peer_reads
+    async def request_coin_states_page(self, request: wallet_protocol.RequestCoinStatesPage) -> Optional[Message]:
+        max_puzzle_hashes = self.full_node.config.get("max_coin_states_page_puzzle_hashes", 1000)
+        if len(request.puzzle_hashes) > max_puzzle_hashes:
+            reject = wallet_protocol.RejectCoinStatesPage(uint32(max_puzzle_hashes))
+            return make_msg(ProtocolMessageTypes.reject_coin_states_page, reject)
+        max_items = min(request.max_items, self.full_node.config.get("max_subscribe_response_items", 100000))
+        coin_states, cursor = await self.full_node.coin_store.get_coin_states_page(
+            request.include_spent_coins,
+            request.puzzle_hashes,
+            request.min_height,
+            cursor=request.cursor,
+            max_items=max(1, max_items),
+        )
+        response = wallet_protocol.RespondCoinStatesPage(coin_states, cursor)
+        return make_msg(ProtocolMessageTypes.respond_coin_states_page, response)
@@ -2,20 +2,31 @@ from __future__ import annotations
 
 import dataclasses
 import logging
-from typing import List, Tuple
+from typing import Any, Collection, List, Tuple
 
 import typing_extensions
 
 from greenbtc.types.blockchain_format.sized_bytes import bytes32
-from greenbtc.util.db_wrapper import DBWrapper2
+from greenbtc.util.db_wrapper import SQLITE_MAX_VARIABLE_NUMBER, DBWrapper2
+from greenbtc.util.misc import to_batches
 
 log = logging.getLogger(__name__)
 
+# The compact layout stores every distinct hint once, in hint_values, and refers to it by its rowid. Since most
+# hints are 32 byte puzzle hashes shared by many coins, this is a lot smaller than the hints table, which stores the
+# hint with every coin and again in both of its indexes. Existing databases are converted with "db compact-hints"
+HINT_VALUES_TABLE = "CREATE TABLE IF NOT EXISTS hint_values(id INTEGER PRIMARY KEY, hint blob UNIQUE)"
+COIN_HINTS_TABLE = (
+    "CREATE TABLE IF NOT EXISTS coin_hints(hint_id int, coin_id blob, PRIMARY KEY(hint_id, coin_id)) WITHOUT ROWID"
+)
+
 
 @typing_extensions.final
 @dataclasses.dataclass
 class HintStore:
     db_wrapper: DBWrapper2
+    # whether the database uses the hint_values and coin_hints tables instead of hints
+    compact: bool = False
 
     @classmethod
     async def create(cls, db_wrapper: DBWrapper2) -> HintStore:
@@ -25,33 +36,85 @@ class HintStore:
         self = HintStore(db_wrapper)
 
         async with self.db_wrapper.writer_maybe_transaction() as conn:
+            async with conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name='coin_hints'"
+            ) as cursor:
+                self.compact = await cursor.fetchone() is not None
+
             log.info("DB: Creating hint store tables and indexes.")
-            await conn.execute("CREATE TABLE IF NOT EXISTS hints(coin_id blob, hint blob, UNIQUE (coin_id, hint))")
-            log.info("DB: Creating index hint_index")
-            await conn.execute("CREATE INDEX IF NOT EXISTS hint_index on hints(hint)")
+            if self.compact:
+                await conn.execute(HINT_VALUES_TABLE)
+                await conn.execute(COIN_HINTS_TABLE)
+            else:
+                await conn.execute("CREATE TABLE IF NOT EXISTS hints(coin_id blob, hint blob, UNIQUE (coin_id, hint))")
+                log.info("DB: Creating index hint_index")
+                await conn.execute("CREATE INDEX IF NOT EXISTS hint_index on hints(hint)")
         return self
 
     async def get_coin_ids(self, hint: bytes, *, max_items: int = 50000) -> List[bytes32]:
         async with self.db_wrapper.reader_no_transaction() as conn:
-            cursor = await conn.execute("SELECT coin_id from hints WHERE hint=? LIMIT ?", (hint, max_items))
+            if self.compact:
+                cursor = await conn.execute(
+                    "SELECT coin_id FROM coin_hints WHERE hint_id=(SELECT id FROM hint_values WHERE hint=?) LIMIT ?",
+                    (hint, max_items),
+                )
+            else:
+                cursor = await conn.execute("SELECT coin_id from hints WHERE hint=? LIMIT ?", (hint, max_items))
             rows = await cursor.fetchall()
             await cursor.close()
         return [bytes32(row[0]) for row in rows]
 
+    async def get_coin_ids_for_hints(self, hints: Collection[bytes], *, max_items: int = 50000) -> List[bytes32]:
+        """
+        Returns the ids of the coins with any of the hints, up to max_items in total
+        """
+        coin_ids: List[bytes32] = []
+        if len(hints) == 0 or max_items <= 0:
+            return coin_ids
+
+        async with self.db_wrapper.reader_no_transaction() as conn:
+            for batch in to_batches(hints, SQLITE_MAX_VARIABLE_NUMBER):
+                hints_db: Tuple[Any, ...] = tuple(batch.entries)
+                placeholders = "?," * (len(batch.entries) - 1) + "?"
+                if self.compact:
+                    sql = (
+                        f"SELECT coin_id FROM coin_hints WHERE hint_id IN "
+                        f"(SELECT id FROM hint_values WHERE hint IN ({placeholders})) LIMIT ?"
+                    )
+                else:
+                    sql = f"SELECT coin_id FROM hints INDEXED BY hint_index WHERE hint IN ({placeholders}) LIMIT ?"
+                async with conn.execute(sql, hints_db + (max_items - len(coin_ids),)) as cursor:
+                    coin_ids.extend(bytes32(row[0]) for row in await cursor.fetchall())
+                if len(coin_ids) >= max_items:
+                    break
+
+        return coin_ids
+
     async def add_hints(self, coin_hint_list: List[Tuple[bytes32, bytes]]) -> None:
         if len(coin_hint_list) == 0:
             return None
 
         async with self.db_wrapper.writer_maybe_transaction() as conn:
-            cursor = await conn.executemany(
-                "INSERT OR IGNORE INTO hints VALUES(?, ?)",
-                coin_hint_list,
-            )
+            if self.compact:
+                cursor = await conn.executemany(
+                    "INSERT OR IGNORE INTO hint_values(hint) VALUES(?)",
+                    [(hint,) for hint in {hint for _, hint in coin_hint_list}],
+                )
+                await cursor.close()
+                cursor = await conn.executemany(
+                    "INSERT OR IGNORE INTO coin_hints SELECT id, ? FROM hint_values WHERE hint=?",
+                    coin_hint_list,
+                )
+            else:
+                cursor = await conn.executemany(
+                    "INSERT OR IGNORE INTO hints VALUES(?, ?)",
+                    coin_hint_list,
+                )
             await cursor.close()
 
     async def count_hints(self) -> int:
         async with self.db_wrapper.reader_no_transaction() as conn:
-            async with conn.execute("select count(*) from hints") as cursor:
+            async with conn.execute(f"select count(*) from {'coin_hints' if self.compact else 'hints'}") as cursor:
                 row = await cursor.fetchone()
 
         assert row is not None
@@ -7,6 +7,7 @@ from enum import Enum
 from typing import Callable, Dict, Iterator, List, Optional, Tuple
 
 from chia_rs import AugSchemeMPL, Coin, G2Element
+from sortedcontainers import SortedList
 
 from greenbtc.consensus.default_constants import DEFAULT_CONSTANTS
 from greenbtc.full_node.fee_estimation import FeeMempoolInfo, MempoolInfo, MempoolItemInfo
@@ -43,6 +44,11 @@ class Mempool:
     # it's expensive to serialize and deserialize G2Element, so we keep those in
     # this separate dictionary
     _items: Dict[bytes32, InternalMempoolItem]
+    # the items in the order they're included in blocks, by fee rate and then
+    # seq, so making a block only visits the items it includes. The entries
+    # are (-fee_per_cost, seq, name, fee)
+    _by_feerate: SortedList
+    _feerate_entries: Dict[bytes32, Tuple[float, int, bytes32, int]]
 
     # the most recent block height and timestamp that we know of
     _block_height: uint32
@@ -54,6 +60,8 @@ class Mempool:
     def __init__(self, mempool_info: MempoolInfo, fee_estimator: FeeEstimatorInterface):
         self._db_conn = sqlite3.connect(":memory:")
         self._items = {}
+        self._by_feerate = SortedList()
+        self._feerate_entries = {}
         self._block_height = uint32(0)
         self._timestamp = uint64(0)
         self._total_fee = 0
@@ -248,6 +256,7 @@ class Mempool:
 
         for name in items:
             self._items.pop(name)
+            self._by_feerate.remove(self._feerate_entries.pop(name))
 
         for batch in to_batches(items, SQLITE_MAX_VARIABLE_NUMBER):
             args = ",".join(["?"] * len(batch.entries))
@@ -341,7 +350,7 @@ class Mempool:
 
             # TODO: In the future, for the "fee_per_cost" field, opt for
             # "GENERATED ALWAYS AS (CAST(fee AS REAL) / cost) VIRTUAL"
-            self._db_conn.execute(
+            cursor = self._db_conn.execute(
                 "INSERT INTO "
                 "tx(name,cost,fee,assert_height,assert_before_height,assert_before_seconds,fee_per_cost) "
                 "VALUES(?, ?, ?, ?, ?, ?, ?)",
@@ -362,6 +371,10 @@ class Mempool:
             self._items[item.name] = InternalMempoolItem(
                 item.spend_bundle, item.npc_result, item.height_added_to_mempool, item.bundle_coin_spends
             )
+            assert cursor.lastrowid is not None
+            entry = (-(item.fee / item.cost), cursor.lastrowid, item.name, item.fee)
+            self._by_feerate.add(entry)
+            self._feerate_entries[item.name] = entry
 
             self._total_cost += item.cost
             self._total_fee += item.fee
@@ -392,11 +405,7 @@ class Mempool:
         coin_spends: List[CoinSpend] = []
         sigs: List[G2Element] = []
         log.info(f"Starting to make block, max cost: {self.mempool_info.max_block_clvm_cost}")
-        with self._db_conn:
-            cursor = self._db_conn.execute("SELECT name, fee FROM tx ORDER BY fee_per_cost DESC, seq ASC")
-        for row in cursor:
-            name = bytes32(row[0])
-            fee = int(row[1])
+        for _, _, name, fee in self._by_feerate:
             item = self._items[name]
             if not item_inclusion_filter(name):
                 continue
@@ -405,7 +414,7 @@ class Mempool:
                     bundle_coin_spends=item.bundle_coin_spends, max_cost=item.npc_result.cost
                 )
                 item_cost = item.npc_result.cost - cost_saving
-                log.info("Cumulative cost: %d, fee per cost: %0.4f", cost_sum, fee / item_cost)
+                log.debug("Cumulative cost: %d, fee per cost: %0.4f", cost_sum, fee / item_cost)
                 if (
                     item_cost + cost_sum > self.mempool_info.max_block_clvm_cost
                     or fee + fee_sum > DEFAULT_CONSTANTS.MAX_COIN_AMOUNT
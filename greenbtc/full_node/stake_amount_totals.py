@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+from sortedcontainers import SortedDict
+
+# buckets that expired more than this many seconds before the latest queried
+# timestamp are dropped. Older timestamps have to be answered from the database
+STAKE_TOTALS_RETENTION = 86400
+
+
+@dataclass
+class StakeAmounts:
+    farm: int = 0
+    # coefficient -> farm amount, so the weighted sum doesn't drift as amounts are added and removed
+    farm_by_coefficient: Dict[float, int] = field(default_factory=dict)
+    lock: int = 0
+
+    def add(self, is_stake_farm: bool, coefficient: float, amount: int) -> None:
+        if is_stake_farm:
+            self.farm += amount
+            farm_amount = self.farm_by_coefficient.get(coefficient, 0) + amount
+            if farm_amount == 0:
+                self.farm_by_coefficient.pop(coefficient, None)
+            else:
+                self.farm_by_coefficient[coefficient] = farm_amount
+        else:
+            self.lock += amount
+
+    def merge(self, other: StakeAmounts, sign: int) -> None:
+        self.farm += sign * other.farm
+        self.lock += sign * other.lock
+        for coefficient, amount in other.farm_by_coefficient.items():
+            farm_amount = self.farm_by_coefficient.get(coefficient, 0) + sign * amount
+            if farm_amount == 0:
+                self.farm_by_coefficient.pop(coefficient, None)
+            else:
+                self.farm_by_coefficient[coefficient] = farm_amount
+
+    def farm_calc(self) -> float:
+        return float(sum(amount * coefficient for coefficient, amount in self.farm_by_coefficient.items()))
+
+
+@dataclass
+class StakeAmountTotals:
+    """
+    Running stake farm and lock totals, bucketed by expiration. The totals of everything expiring after _cursor are
+    kept up to date, so answering for a timestamp only has to move the cursor over the buckets in between.
+    """
+
+    # buckets expiring at or before _floor are not tracked
+    _floor: int
+    _cursor: int
+    _buckets: SortedDict[int, StakeAmounts] = field(default_factory=SortedDict, init=False)
+    _above_cursor: StakeAmounts = field(default_factory=StakeAmounts, init=False)
+
+    def add(self, expiration: int, is_stake_farm: bool, coefficient: float, amount: int) -> None:
+        """
+        Adds (or with a negative amount, removes) stake records
+        """
+        if expiration <= self._floor:
+            return
+        bucket = self._buckets.get(expiration)
+        if bucket is None:
+            bucket = StakeAmounts()
+            self._buckets[expiration] = bucket
+        bucket.add(is_stake_farm, coefficient, amount)
+        if expiration > self._cursor:
+            self._above_cursor.add(is_stake_farm, coefficient, amount)
+
+    def get(self, timestamp: int) -> Optional[Tuple[int, float, int]]:
+        """
+        Returns the farm amount, coefficient weighted farm amount and lock amount of the records expiring after
+        timestamp, or None if timestamp is too old
+        """
+        if timestamp < self._floor:
+            return None
+        if timestamp > self._cursor:
+            for expiration in self._buckets.irange(self._cursor, timestamp, inclusive=(False, True)):
+                self._above_cursor.merge(self._buckets[expiration], -1)
+        elif timestamp < self._cursor:
+            for expiration in self._buckets.irange(timestamp, self._cursor, inclusive=(False, True)):
+                self._above_cursor.merge(self._buckets[expiration], 1)
+        self._cursor = timestamp
+
+        floor = timestamp - STAKE_TOTALS_RETENTION
+        if floor > self._floor:
+            for expiration in list(self._buckets.irange(maximum=floor)):
+                del self._buckets[expiration]
+            self._floor = floor
+
+        return self._above_cursor.farm, self._above_cursor.farm_calc(), self._above_cursor.lock
@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+import heapq
+import logging
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+from greenbtc.full_node.stake_record_store import StakeRecordStore
+from greenbtc.types.blockchain_format.sized_bytes import bytes32
+from greenbtc.types.stake_record import StakeRecord
+from greenbtc.types.stake_value import STAKE_FARM_COUNT, stake_reward_amounts
+from greenbtc.util.ints import uint32, uint64
+
+log = logging.getLogger(__name__)
+
+# farm records that expired more than this many seconds before the peak
+# transaction block are dropped from memory. Queries for older timestamps fall
+# back to the StakeRecordStore
+STAKE_FARM_RETENTION = 86400
+
+
+@dataclass(frozen=True)
+class StakeFarmEntry:
+    confirmed_index: int
+    expiration: int
+    puzzle_hash: bytes32
+    reward_amount: int
+
+
+def sum_stake_farm_entries(entries: List[StakeFarmEntry], height: int, timestamp: int) -> int:
+    # mirrors StakeRecordStore.get_stake_farm_records_thin: only the first
+    # STAKE_FARM_COUNT distinct recipient puzzle hashes are counted
+    total = 0
+    puzzle_hashes: Set[bytes32] = set()
+    for entry in entries:
+        if entry.confirmed_index >= height or entry.expiration <= timestamp:
+            continue
+        if len(puzzle_hashes) >= STAKE_FARM_COUNT and entry.puzzle_hash not in puzzle_hashes:
+            continue
+        puzzle_hashes.add(entry.puzzle_hash)
+        total += entry.reward_amount
+    return total
+
+
+class StakeCoefficientEngine:
+    """
+    Keeps the stake farm amount of every stake puzzle hash as of the peak transaction block, so the stake part of
+    the coefficient can be answered without a database query. The sums are updated incrementally from each new
+    peak's stake additions and from the records that expire between two peaks. Reorgs trim the per-farm record
+    lists and rebuild the sums from memory.
+    """
+
+    store: StakeRecordStore
+    retention: int
+
+    # stake_puzzle_hash -> farm records, in insertion order
+    __records: Dict[bytes32, List[StakeFarmEntry]]
+    # (expiration, stake_puzzle_hash) of records still active at the peak
+    __expirations: List[Tuple[int, bytes32]]
+    # (expiration, stake_puzzle_hash) of expired records, oldest first, waiting to be pruned
+    __expired: Deque[Tuple[int, bytes32]]
+    # (confirmed_index, expiration, stake_puzzle_hash) of records not yet counted in the sums
+    __pending: List[Tuple[int, int, bytes32]]
+    # stake amounts as of (__height, __timestamp)
+    __sums: Dict[bytes32, int]
+    __height: Optional[int]
+    __timestamp: Optional[int]
+    # records that expired at or before this timestamp may have been pruned
+    __floor: int
+    __loaded: bool
+
+    def __init__(self, store: StakeRecordStore, retention: int = STAKE_FARM_RETENTION) -> None:
+        self.store = store
+        self.retention = retention
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Drops all state. The records are reloaded from the store on the next call to set_peak.
+        """
+        self.__records = {}
+        self.__expirations = []
+        self.__expired = deque()
+        self.__pending = []
+        self.__sums = {}
+        self.__height = None
+        self.__timestamp = None
+        self.__floor = 0
+        self.__loaded = False
+
+    async def __load(self, timestamp: int) -> None:
+        self.reset()
+        self.__floor = max(0, timestamp - self.retention)
+        records = await self.store.get_stake_farm_records_expiring_after(uint64(self.__floor))
+        amounts = stake_reward_amounts(
+            [record.amount for _, record in records], [record.stake_type for _, record in records], True
+        )
+        for (confirmed_index, record), amount in zip(records, amounts):
+            self.__append(
+                record.stake_puzzle_hash,
+                StakeFarmEntry(confirmed_index, record.expiration, record.puzzle_hash, amount),
+            )
+        self.__loaded = True
+        log.info(f"Loaded {sum(len(r) for r in self.__records.values())} stake farm records")
+
+    def __append(self, stake_puzzle_hash: bytes32, entry: StakeFarmEntry) -> None:
+        self.__records.setdefault(stake_puzzle_hash, []).append(entry)
+
+    def add_records(self, records: List[StakeRecord]) -> None:
+        """
+        Called with the stake additions of a block as they are written to the StakeRecordStore
+        """
+        if not self.__loaded:
+            return
+        farm_records = [record for record in records if record.is_stake_farm]
+        amounts = stake_reward_amounts(
+            [record.amount for record in farm_records], [record.stake_type for record in farm_records], True
+        )
+        for record, amount in zip(farm_records, amounts):
+            self.__append(
+                record.stake_puzzle_hash,
+                StakeFarmEntry(record.confirmed_block_index, record.expiration, record.puzzle_hash, amount),
+            )
+            self.__pending.append((record.confirmed_block_index, record.expiration, record.stake_puzzle_hash))
+
+    def rollback(self, fork_height: int) -> None:
+        """
+        Removes the records confirmed above fork_height. The sums are rebuilt on the next call to set_peak
+        """
+        if not self.__loaded:
+            return
+        for stake_puzzle_hash in list(self.__records.keys()):
+            entries = self.__records[stake_puzzle_hash]
+            while len(entries) > 0 and entries[-1].confirmed_index > fork_height:
+                entries.pop()
+            if len(entries) == 0:
+                del self.__records[stake_puzzle_hash]
+        self.__height = None
+        self.__timestamp = None
+
+    async def set_peak(self, height: uint32, timestamp: uint64) -> None:
+        """
+        Moves the sums to the transaction block at height with the given timestamp
+        """
+        if not self.__loaded or timestamp < self.__floor:
+            # after a reorg, the peak can be older than the records pruned so far
+            await self.__load(timestamp)
+        if self.__height == height and self.__timestamp == timestamp:
+            return
+        if self.__height is None or self.__timestamp is None or height < self.__height or timestamp < self.__timestamp:
+            self.__rebuild(height, timestamp)
+            return
+
+        dirty: Set[bytes32] = set()
+        pending: List[Tuple[int, int, bytes32]] = []
+        for confirmed_index, expiration, stake_puzzle_hash in self.__pending:
+            if confirmed_index < height:
+                dirty.add(stake_puzzle_hash)
+                heapq.heappush(self.__expirations, (expiration, stake_puzzle_hash))
+            else:
+                pending.append((confirmed_index, expiration, stake_puzzle_hash))
+        self.__pending = pending
+
+        while len(self.__expirations) > 0 and self.__expirations[0][0] <= timestamp:
+            expired = heapq.heappop(self.__expirations)
+            dirty.add(expired[1])
+            self.__expired.append(expired)
+
+        self.__height = height
+        self.__timestamp = timestamp
+        for stake_puzzle_hash in dirty:
+            self.__update_sum(stake_puzzle_hash)
+        self.__prune(timestamp - self.retention)
+
+    def __rebuild(self, height: int, timestamp: int) -> None:
+        self.__height = height
+        self.__timestamp = timestamp
+        self.__pending = []
+        self.__sums = {}
+        expirations: List[Tuple[int, bytes32]] = []
+        expired: List[Tuple[int, bytes32]] = []
+        for stake_puzzle_hash, entries in self.__records.items():
+            for entry in entries:
+                if entry.confirmed_index >= height:
+                    self.__pending.append((entry.confirmed_index, entry.expiration, stake_puzzle_hash))
+                elif entry.expiration > timestamp:
+                    expirations.append((entry.expiration, stake_puzzle_hash))
+                else:
+                    expired.append((entry.expiration, stake_puzzle_hash))
+            self.__update_sum(stake_puzzle_hash)
+        heapq.heapify(expirations)
+        self.__expirations = expirations
+        self.__expired = deque(sorted(expired))
+        self.__prune(timestamp - self.retention)
+
+    def __update_sum(self, stake_puzzle_hash: bytes32) -> None:
+        assert self.__height is not None and self.__timestamp is not None
+        entries = self.__records.get(stake_puzzle_hash)
+        amount = 0 if entries is None else sum_stake_farm_entries(entries, self.__height, self.__timestamp)
+        if amount == 0:
+            self.__sums.pop(stake_puzzle_hash, None)
+        else:
+            self.__sums[stake_puzzle_hash] = amount
+
+    def __prune(self, floor: int) -> None:
+        if floor <= self.__floor:
+            return
+        pruned: Set[bytes32] = set()
+        while len(self.__expired) > 0 and self.__expired[0][0] <= floor:
+            pruned.add(self.__expired.popleft()[1])
+        for stake_puzzle_hash in pruned:
+            entries = [entry for entry in self.__records.get(stake_puzzle_hash, []) if entry.expiration > floor]
+            if len(entries) == 0:
+                self.__records.pop(stake_puzzle_hash, None)
+            else:
+                self.__records[stake_puzzle_hash] = entries
+        self.__floor = floor
+
+    def get_stake_amount(self, stake_puzzle_hash: bytes32, height: uint32, timestamp: uint64) -> Optional[int]:
+        """
+        Returns the stake farm amount of stake_puzzle_hash as of the transaction block at height, or None if the
+        engine can't answer for that block and the caller needs to go to the StakeRecordStore
+        """
+        if not self.__loaded:
+            return None
+        if height == self.__height and timestamp == self.__timestamp:
+            return self.__sums.get(stake_puzzle_hash, 0)
+        if timestamp < self.__floor:
+            return None
+        entries = self.__records.get(stake_puzzle_hash)
+        if entries is None:
+            return 0
+        return sum_stake_farm_entries(entries, height, timestamp)
@@ -2,10 +2,12 @@ from __future__ import annotations
 
 import dataclasses
 import logging
-from typing import List, Optional, Tuple
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
 import typing_extensions
+from aiosqlite import Row
 
+from greenbtc.full_node.stake_amount_totals import STAKE_TOTALS_RETENTION, StakeAmountTotals
 from greenbtc.types.blockchain_format.sized_bytes import bytes32, bytes48
 from greenbtc.types.stake_record import StakeRecord, StakeRecordThin
 from greenbtc.types.stake_value import STAKE_FARM_COUNT
@@ -16,6 +18,47 @@ from greenbtc.util.misc import to_batches
 
 log = logging.getLogger(__name__)
 
+# (name, definition) of the indexes on stake_record. They are built around the queries below, most of them cover
+# every column the query reads, so SQLite never has to look up the table row. is_stake_farm is constant in the
+# partial indexes, it is only there to make them covering
+STAKE_RECORD_INDEXES: List[Tuple[str, str]] = [
+    # Useful for reorg lookups
+    ("stake_confirmed_index", "stake_record(confirmed_index)"),
+    ("stake_spent_index", "stake_record(spent_index)"),
+    # get_stake_farm_records_thin and friends, ordered by rowid to apply STAKE_FARM_COUNT in insertion order
+    (
+        "stake_farm_puzzle_hash",
+        "stake_record(stake_puzzle_hash, confirmed_index, expiration, puzzle_hash, amount, stake_type, coefficient,"
+        " is_stake_farm) WHERE is_stake_farm=1",
+    ),
+    # Stake lock rewards are paid out on the time of day the lock expires, see get_stake_lock_records_thin
+    (
+        "stake_lock_time_of_day",
+        "stake_record(expiration%86400, expiration, stake_puzzle_hash, puzzle_hash, amount, stake_type, coefficient,"
+        " is_stake_farm) WHERE is_stake_farm=0",
+    ),
+    # get_stake_amount_total, grouped in index order
+    ("stake_expiration_amount", "stake_record(expiration, is_stake_farm, coefficient, amount)"),
+]
+
+# indexes of earlier versions, replaced by the ones above
+LEGACY_STAKE_RECORD_INDEXES: List[str] = [
+    "stake_stake_type",
+    "stake_is_stake_farm",
+    "stake_expiration",
+    "stake_lock_expiration_time_of_day",
+    "stake_puzzle_hash",
+    "puzzle_hash",
+]
+
+# the legacy index the queries use instead of each of the indexes above, until they're built. Building them reads
+# the whole table, so existing databases get them from "greenbtc db upgrade-stake-indexes", not on startup
+LEGACY_QUERY_INDEXES: Dict[str, str] = {
+    "stake_farm_puzzle_hash": "stake_puzzle_hash",
+    "stake_lock_time_of_day": "stake_expiration",
+    "stake_expiration_amount": "stake_expiration",
+}
+
 
 @typing_extensions.final
 @dataclasses.dataclass
@@ -27,10 +70,19 @@ class StakeRecordStore:
     db_wrapper: DBWrapper2
     stake_farm_cache: LRUCache[bytes48, List[StakeRecordThin]]
     stake_lock_cache: LRUCache[bytes32, List[StakeRecordThin]]
+    # running totals for get_stake_amount_total, loaded on first use
+    stake_totals: Optional[StakeAmountTotals]
+    # (expiration, is_stake_farm, coefficient, amount) changes to stake_totals made by the write transaction in
+    # progress, applied by commit_totals once it has committed. None when no write is in progress
+    pending_totals: Optional[List[Tuple[int, bool, float, int]]] = None
+    # bumped whenever a write starts, commits or fails, so totals loaded next to it can be told apart
+    totals_generation: int = 0
+    # whether the database has all of STAKE_RECORD_INDEXES, otherwise the queries use LEGACY_QUERY_INDEXES
+    has_covering_indexes: bool = False
 
     @classmethod
     async def create(cls, db_wrapper: DBWrapper2) -> StakeRecordStore:
-        self = StakeRecordStore(db_wrapper, LRUCache(104), LRUCache(104))
+        self = StakeRecordStore(db_wrapper, LRUCache(104), LRUCache(104), None)
         async with self.db_wrapper.writer_maybe_transaction() as conn:
             log.info("DB: Creating coin store tables and indexes.")
             await conn.execute(
@@ -47,30 +99,32 @@ class StakeRecordStore:
                 " expiration bigint)"
             )
 
-            # Useful for reorg lookups
-            log.info("DB: Creating index stake confirmed_index")
-            await conn.execute("CREATE INDEX IF NOT EXISTS stake_confirmed_index on stake_record(confirmed_index)")
-
-            log.info("DB: Creating index stake spent_index")
-            await conn.execute("CREATE INDEX IF NOT EXISTS stake_spent_index on stake_record(spent_index)")
-
-            log.info("DB: Creating index stake stake_type")
-            await conn.execute("CREATE INDEX IF NOT EXISTS stake_stake_type on stake_record(stake_type)")
-
-            log.info("DB: Creating index stake is_stake_farm")
-            await conn.execute("CREATE INDEX IF NOT EXISTS stake_is_stake_farm on stake_record(is_stake_farm)")
-
-            log.info("DB: Creating index stake expiration")
-            await conn.execute("CREATE INDEX IF NOT EXISTS stake_expiration on stake_record(expiration)")
+            async with conn.execute("SELECT 1 FROM stake_record LIMIT 1") as cursor:
+                new_database = await cursor.fetchone() is None
 
-            log.info("DB: Creating index stake stake_puzzle_hash")
-            await conn.execute("CREATE INDEX IF NOT EXISTS stake_puzzle_hash on stake_record(stake_puzzle_hash)")
+            if new_database:
+                # the composite indexes replace the single column ones of earlier versions. Every index is another
+                # B-tree to update on each insert
+                for name in LEGACY_STAKE_RECORD_INDEXES:
+                    await conn.execute(f"DROP INDEX IF EXISTS {name}")
+                for name, definition in STAKE_RECORD_INDEXES:
+                    log.info(f"DB: Creating index {name}")
+                    await conn.execute(f"CREATE INDEX IF NOT EXISTS {name} on {definition}")
 
-            log.info("DB: Creating index stake puzzle_hash")
-            await conn.execute("CREATE INDEX IF NOT EXISTS puzzle_hash on stake_record(puzzle_hash)")
+            async with conn.execute("SELECT name FROM sqlite_master WHERE type='index'") as cursor:
+                existing = {row[0] for row in await cursor.fetchall()}
+            self.has_covering_indexes = all(name in existing for name, _ in STAKE_RECORD_INDEXES)
+            if not self.has_covering_indexes:
+                log.warning(
+                    "DB: the stake record store doesn't have the covering indexes, stake lookups will be slower. "
+                    "Stop the node and run \"greenbtc db upgrade-stake-indexes\" to build them"
+                )
 
         return self
 
+    def _index(self, name: str) -> str:
+        return name if self.has_covering_indexes else LEGACY_QUERY_INDEXES[name]
+
     # Store StakeRecord in DB
     async def _add_records(self, records: List[StakeRecord]) -> None:
         values2 = []
@@ -114,6 +168,25 @@ class StakeRecordStore:
                     batch.entries,
                 )
 
+    def _begin_totals_change(self) -> List[Tuple[int, bool, float, int]]:
+        if self.pending_totals is None:
+            self.pending_totals = []
+            self.totals_generation += 1
+        return self.pending_totals
+
+    def commit_totals(self) -> None:
+        """
+        Applies the stake total changes of new_stake and rollback_to_block. To be called once the write transaction
+        they ran in has committed, reset_caches() drops them if it failed
+        """
+        if self.pending_totals is None:
+            return
+        if self.stake_totals is not None:
+            for expiration, is_stake_farm, coefficient, amount in self.pending_totals:
+                self.stake_totals.add(expiration, is_stake_farm, coefficient, amount)
+        self.pending_totals = None
+        self.totals_generation += 1
+
     async def new_stake(
             self,
             height: uint32,
@@ -121,7 +194,12 @@ class StakeRecordStore:
             tx_removals: List[bytes32],
     ) -> None:
         if len(tx_additions) > 0:
+            pending_totals = self._begin_totals_change()
             await self._add_records(tx_additions)
+            for record in tx_additions:
+                pending_totals.append(
+                    (record.expiration, record.is_stake_farm, float(record.coefficient), record.amount)
+                )
         await self._set_spent(tx_removals, height)
 
     async def rollback_to_block(self, block_index: int):
@@ -130,7 +208,18 @@ class StakeRecordStore:
         Returns the list of coin records that have been modified
         """
         # Add coins that are confirmed in the reverted blocks to the list of updated coins.
+        pending_totals = self._begin_totals_change()
         async with self.db_wrapper.writer_maybe_transaction() as conn:
+            # totals can't be loaded while the write is pending, so without any now there's nothing to update
+            if self.stake_totals is not None:
+                async with conn.execute(
+                    "SELECT expiration,is_stake_farm,coefficient,SUM(amount) FROM stake_record "
+                    "WHERE confirmed_index>? GROUP BY expiration,is_stake_farm,coefficient",
+                    (block_index,),
+                ) as cursor:
+                    for row in await cursor.fetchall():
+                        pending_totals.append((row[0], row[1] != 0, float(row[2]), -int(row[3])))
+
             # Delete reverted blocks from storage
             await conn.execute("DELETE FROM stake_record WHERE confirmed_index>?", (block_index,))
             await conn.execute("UPDATE stake_record SET spent_index=0 WHERE spent_index>?", (block_index,))
@@ -138,10 +227,20 @@ class StakeRecordStore:
         self.stake_farm_cache = LRUCache(self.stake_farm_cache.capacity)
         self.stake_lock_cache = LRUCache(self.stake_lock_cache.capacity)
 
+    def reset_caches(self) -> None:
+        """
+        Drops all in-memory state, for when a write transaction failed after the caches were updated
+        """
+        self.stake_farm_cache = LRUCache(self.stake_farm_cache.capacity)
+        self.stake_lock_cache = LRUCache(self.stake_lock_cache.capacity)
+        self.stake_totals = None
+        self.pending_totals = None
+        self.totals_generation += 1
+
     async def get_stake_farm_count(self, stake_puzzle_hash: bytes32, timestamp: uint64) -> int:
         async with self.db_wrapper.reader_no_transaction() as conn:
             async with conn.execute(
-                "SELECT SUM(1) FROM stake_record INDEXED BY stake_puzzle_hash"
+                f"SELECT SUM(1) FROM stake_record INDEXED BY {self._index('stake_farm_puzzle_hash')}"
                 " WHERE is_stake_farm=1 AND stake_puzzle_hash=? AND expiration>? GROUP BY puzzle_hash",
                 (stake_puzzle_hash, timestamp),
             ) as cursor:
@@ -165,19 +264,30 @@ class StakeRecordStore:
     #     return int(rows[0][0]), float(rows[0][1])
 
     async def get_stake_amount_total(self, timestamp: uint64) -> Tuple[int, float, int]:
+        if self.stake_totals is not None:
+            totals = self.stake_totals.get(timestamp)
+            if totals is not None:
+                return totals
+
+        generation = self.totals_generation
+        floor = max(0, timestamp - STAKE_TOTALS_RETENTION)
+        stake_totals = StakeAmountTotals(floor, floor)
         async with self.db_wrapper.reader_no_transaction() as conn:
             async with conn.execute(
-                "SELECT is_stake_farm,SUM(amount),SUM(amount*coefficient) FROM stake_record "
-                "WHERE expiration>? GROUP BY is_stake_farm", (timestamp,),
+                "SELECT expiration,is_stake_farm,coefficient,SUM(amount) FROM stake_record "
+                f"INDEXED BY {self._index('stake_expiration_amount')} WHERE expiration>? "
+                "GROUP BY expiration,is_stake_farm,coefficient",
+                (floor,),
             ) as cursor:
-                stake_farm, stake_farm_calc, stake_lock = 0, 0.0, 0
                 for row in await cursor.fetchall():
-                    if int(row[0]) == 0:
-                        stake_lock = int(row[1])
-                    else:
-                        stake_farm = int(row[1])
-                        stake_farm_calc = float(row[2])
-        return stake_farm, stake_farm_calc, stake_lock
+                    stake_totals.add(row[0], row[1] != 0, float(row[2]), int(row[3]))
+        # the rows of a write that is pending, or committed while they were read, may or may not be included. Its
+        # changes are applied to the totals this would replace, so they're only kept if no write got in the way
+        if generation == self.totals_generation and self.pending_totals is None:
+            self.stake_totals = stake_totals
+        totals = stake_totals.get(timestamp)
+        assert totals is not None
+        return totals
 
     async def get_stake_farm_records_thin(
         self, stake_puzzle_hash: bytes32, height: uint32, timestamp: uint64
@@ -189,29 +299,145 @@ class StakeRecordStore:
         async with self.db_wrapper.reader_no_transaction() as conn:
             async with conn.execute(
                 "SELECT stake_puzzle_hash,puzzle_hash,amount,stake_type,coefficient,expiration FROM "
-                "stake_record INDEXED BY stake_puzzle_hash WHERE stake_puzzle_hash=? AND is_stake_farm=1 "
-                "AND confirmed_index<? AND expiration>?", (stake_puzzle_hash, height, timestamp,),
+                f"stake_record INDEXED BY {self._index('stake_farm_puzzle_hash')} "
+                "WHERE stake_puzzle_hash=? AND is_stake_farm=1 "
+                "AND confirmed_index<? AND expiration>? ORDER BY rowid", (stake_puzzle_hash, height, timestamp,),
             ) as cursor:
-                records: List[StakeRecordThin] = []
-                puzzle_hashes: set[bytes32] = set()
-
-                for row in await cursor.fetchall():
-                    puzzle_hash = bytes32(row[1])
-                    if len(puzzle_hashes) >= STAKE_FARM_COUNT and puzzle_hash not in puzzle_hashes:
-                        continue
-                    puzzle_hashes.add(puzzle_hash)
-                    records.append(StakeRecordThin(
-                        bytes32(row[0]),
-                        puzzle_hash,
-                        uint64(int(row[2])),
-                        row[3],
-                        True,
-                        float(row[4]),
-                        row[5],
-                    ))
+                records = self._stake_farm_records_from_rows(await cursor.fetchall()).get(stake_puzzle_hash, [])
                 self.stake_farm_cache.put(stake_key, records)
                 return records
 
+    async def get_stake_farm_records_thin_by_puzzle_hashes(
+        self, stake_puzzle_hashes: List[bytes32], height: uint32, timestamp: uint64
+    ) -> Dict[bytes32, List[StakeRecordThin]]:
+        """
+        Same as get_stake_farm_records_thin for many stake puzzle hashes, using one query per
+        SQLITE_MAX_VARIABLE_NUMBER puzzle hashes instead of one query each
+        """
+        result: Dict[bytes32, List[StakeRecordThin]] = {}
+        missing: List[bytes32] = []
+        for stake_puzzle_hash in stake_puzzle_hashes:
+            stake_list = self.stake_farm_cache.get(bytes48(stake_puzzle_hash + height.to_bytes(16, "big")))
+            if stake_list is not None:
+                result[stake_puzzle_hash] = stake_list
+            else:
+                missing.append(stake_puzzle_hash)
+        if len(missing) == 0:
+            return result
+
+        async with self.db_wrapper.reader_no_transaction() as conn:
+            for batch in to_batches(missing, SQLITE_MAX_VARIABLE_NUMBER - 2):
+                puzzle_hash_params = ",".join(["?"] * len(batch.entries))
+                async with conn.execute(
+                    "SELECT stake_puzzle_hash,puzzle_hash,amount,stake_type,coefficient,expiration FROM "
+                    f"stake_record INDEXED BY {self._index('stake_farm_puzzle_hash')} "
+                    f"WHERE stake_puzzle_hash IN ({puzzle_hash_params}) "
+                    "AND is_stake_farm=1 AND confirmed_index<? AND expiration>? ORDER BY rowid",
+                    (*batch.entries, height, timestamp),
+                ) as cursor:
+                    records = self._stake_farm_records_from_rows(await cursor.fetchall())
+                for stake_puzzle_hash in batch.entries:
+                    stake_list = records.get(stake_puzzle_hash, [])
+                    self.stake_farm_cache.put(bytes48(stake_puzzle_hash + height.to_bytes(16, "big")), stake_list)
+                    result[stake_puzzle_hash] = stake_list
+        return result
+
+    async def get_stake_farm_records_thin_by_heights(
+        self, farms: List[Tuple[bytes32, uint32]], timestamp: uint64
+    ) -> Dict[Tuple[bytes32, uint32], List[StakeRecordThin]]:
+        """
+        Same as get_stake_farm_records_thin for many (stake_puzzle_hash, height) pairs sharing one timestamp, like
+        the blocks between two transaction blocks. All pairs are resolved with a single query per
+        SQLITE_MAX_VARIABLE_NUMBER stake puzzle hashes.
+        """
+        result: Dict[Tuple[bytes32, uint32], List[StakeRecordThin]] = {}
+        missing: List[Tuple[bytes32, uint32]] = []
+        for stake_puzzle_hash, height in farms:
+            stake_list = self.stake_farm_cache.get(bytes48(stake_puzzle_hash + height.to_bytes(16, "big")))
+            if stake_list is not None:
+                result[(stake_puzzle_hash, height)] = stake_list
+            else:
+                missing.append((stake_puzzle_hash, height))
+        if len(missing) == 0:
+            return result
+
+        max_height = max(height for _, height in missing)
+        # stake_puzzle_hash -> [(confirmed_index, record)], in insertion order
+        records: Dict[bytes32, List[Tuple[int, StakeRecordThin]]] = {}
+        stake_puzzle_hashes = list({stake_puzzle_hash for stake_puzzle_hash, _ in missing})
+        async with self.db_wrapper.reader_no_transaction() as conn:
+            for batch in to_batches(stake_puzzle_hashes, SQLITE_MAX_VARIABLE_NUMBER - 2):
+                puzzle_hash_params = ",".join(["?"] * len(batch.entries))
+                async with conn.execute(
+                    "SELECT stake_puzzle_hash,puzzle_hash,amount,stake_type,coefficient,expiration,confirmed_index "
+                    f"FROM stake_record INDEXED BY {self._index('stake_farm_puzzle_hash')} "
+                    f"WHERE stake_puzzle_hash IN ({puzzle_hash_params}) "
+                    "AND is_stake_farm=1 AND confirmed_index<? AND expiration>? ORDER BY rowid",
+                    (*batch.entries, max_height, timestamp),
+                ) as cursor:
+                    for row in await cursor.fetchall():
+                        record = self._stake_farm_record_from_row(row)
+                        records.setdefault(record.stake_puzzle_hash, []).append((row[6], record))
+
+        for stake_puzzle_hash, height in missing:
+            stake_list = self._limit_stake_farm_records(
+                record for confirmed_index, record in records.get(stake_puzzle_hash, []) if confirmed_index < height
+            )
+            self.stake_farm_cache.put(bytes48(stake_puzzle_hash + height.to_bytes(16, "big")), stake_list)
+            result[(stake_puzzle_hash, height)] = stake_list
+        return result
+
+    @staticmethod
+    def _stake_farm_record_from_row(row: Row) -> StakeRecordThin:
+        return StakeRecordThin(
+            bytes32(row[0]),
+            bytes32(row[1]),
+            uint64(int(row[2])),
+            row[3],
+            True,
+            float(row[4]),
+            row[5],
+        )
+
+    @staticmethod
+    def _limit_stake_farm_records(records: Iterable[StakeRecordThin]) -> List[StakeRecordThin]:
+        # only the first STAKE_FARM_COUNT distinct puzzle hashes of a stake puzzle hash are rewarded
+        result: List[StakeRecordThin] = []
+        puzzle_hashes: Set[bytes32] = set()
+        for record in records:
+            if len(puzzle_hashes) >= STAKE_FARM_COUNT and record.puzzle_hash not in puzzle_hashes:
+                continue
+            puzzle_hashes.add(record.puzzle_hash)
+            result.append(record)
+        return result
+
+    @classmethod
+    def _stake_farm_records_from_rows(cls, rows: Iterable[Row]) -> Dict[bytes32, List[StakeRecordThin]]:
+        records: Dict[bytes32, List[StakeRecordThin]] = {}
+        for row in rows:
+            record = cls._stake_farm_record_from_row(row)
+            records.setdefault(record.stake_puzzle_hash, []).append(record)
+        return {
+            stake_puzzle_hash: cls._limit_stake_farm_records(stake_list)
+            for stake_puzzle_hash, stake_list in records.items()
+        }
+
+    async def get_stake_farm_records_expiring_after(
+        self, timestamp: uint64
+    ) -> List[Tuple[uint32, StakeRecordThin]]:
+        """
+        Returns (confirmed_index, record) for every stake farm record that expires after timestamp, in insertion
+        order. This is the order get_stake_farm_records_thin sees the rows of a single stake puzzle hash in.
+        """
+        async with self.db_wrapper.reader_no_transaction() as conn:
+            async with conn.execute(
+                "SELECT stake_puzzle_hash,puzzle_hash,amount,stake_type,coefficient,expiration,confirmed_index FROM "
+                f"stake_record INDEXED BY {self._index('stake_expiration_amount')} "
+                "WHERE is_stake_farm=1 AND expiration>? ORDER BY rowid",
+                (timestamp,),
+            ) as cursor:
+                return [(uint32(row[6]), self._stake_farm_record_from_row(row)) for row in await cursor.fetchall()]
+
     async def get_stake_lock_records_thin(
             self, start: uint64, end: uint64
     ) -> List[StakeRecordThin]:
@@ -223,7 +449,8 @@ class StakeRecordStore:
         async with self.db_wrapper.reader_no_transaction() as conn:
             async with conn.execute(
                 "SELECT stake_puzzle_hash,puzzle_hash,amount,stake_type,coefficient,expiration FROM "
-                "stake_record INDEXED BY stake_expiration WHERE is_stake_farm=0 AND expiration>? "
+                f"stake_record INDEXED BY {self._index('stake_lock_time_of_day')} "
+                "WHERE is_stake_farm=0 AND expiration>? "
                 "AND expiration%86400>=? AND expiration%86400<?",
                 (end, start % 86400 + 300, end % 86400 + 300,),
             ) as cursor:
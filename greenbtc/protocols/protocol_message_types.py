@@ -123,3 +123,6 @@ class ProtocolMessageTypes(Enum):
     respond_stake_farm_count = 213
     request_coin_records_by_puzzle_hash = 214
     respond_coin_records_by_puzzle_hash = 215
+    request_coin_states_page = 216
+    respond_coin_states_page = 217
+    reject_coin_states_page = 218
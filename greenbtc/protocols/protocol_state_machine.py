@@ -42,6 +42,7 @@ VALID_REPLY_MESSAGE_MAP = {
     pmt.request_children: [pmt.respond_children],
     pmt.request_ses_hashes: [pmt.respond_ses_hashes],
     pmt.request_block_headers: [pmt.respond_block_headers, pmt.reject_block_headers, pmt.reject_header_blocks],
+    pmt.request_coin_states_page: [pmt.respond_coin_states_page, pmt.reject_coin_states_page],
     pmt.request_peers_introducer: [pmt.respond_peers_introducer],
     pmt.request_puzzle_solution: [pmt.respond_puzzle_solution, pmt.reject_puzzle_solution],
     pmt.send_transaction: [pmt.transaction_ack],
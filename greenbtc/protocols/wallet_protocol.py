@@ -305,3 +305,38 @@ class RequestCoinRecords(Streamable):
 @dataclass(frozen=True)
 class RespondCoinRecords(Streamable):
     coinRecords: List[CoinRecord]
+
+
+@streamable
+@dataclass(frozen=True)
+class CoinStateCursor(Streamable):
+    # the position of a coin state in the (height, coin_id) order of RequestCoinStatesPage, where the height is the
+    # spent height of spent coins and the confirmed height otherwise
+    height: uint32
+    coin_id: bytes32
+
+
+@streamable
+@dataclass(frozen=True)
+class RequestCoinStatesPage(Streamable):
+    puzzle_hashes: List[bytes32]
+    min_height: uint32
+    include_spent_coins: bool
+    # the cursor of the previous response, or None for the first page
+    cursor: Optional[CoinStateCursor]
+    max_items: uint32
+
+
+@streamable
+@dataclass(frozen=True)
+class RespondCoinStatesPage(Streamable):
+    coin_states: List[CoinState]
+    # pass this in the next request to continue after the last coin state. None once there are no more
+    cursor: Optional[CoinStateCursor]
+
+
+@streamable
+@dataclass(frozen=True)
+class RejectCoinStatesPage(Streamable):
+    # the request had more puzzle hashes than this
+    max_puzzle_hashes: uint32
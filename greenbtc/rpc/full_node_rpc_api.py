@@ -27,6 +27,7 @@ from greenbtc.types.mempool_item import MempoolItem
 from greenbtc.types.spend_bundle import SpendBundle
 from greenbtc.types.unfinished_header_block import UnfinishedHeaderBlock
 from greenbtc.util.byte_types import hexstr_to_bytes
+from greenbtc.util.db_wrapper import peer_reads
 from greenbtc.util.ints import uint32, uint64, uint128
 from greenbtc.util.log_exceptions import log_exceptions
 from greenbtc.util.math import make_monotonically_decreasing
@@ -88,12 +89,16 @@ class FullNodeRpcApi:
         self.cached_blockchain_state: Optional[Dict[str, Any]] = None
 
     def get_routes(self) -> Dict[str, Endpoint]:
-        return {
+        routes: Dict[str, Endpoint] = {
             # Blockchain
             "/get_blockchain_state": self.get_blockchain_state,
             "/get_block": self.get_block,
             "/get_blocks": self.get_blocks,
             "/get_block_count_metrics": self.get_block_count_metrics,
+            "/get_stake_cache_metrics": self.get_stake_cache_metrics,
+            "/get_db_reader_metrics": self.get_db_reader_metrics,
+            "/get_db_query_stats": self.get_db_query_stats,
+            "/get_db_maintenance_status": self.get_db_maintenance_status,
             "/get_block_record_by_height": self.get_block_record_by_height,
             "/get_block_record": self.get_block_record,
             "/get_block_records": self.get_block_records,
@@ -124,6 +129,8 @@ class FullNodeRpcApi:
             # Fee estimation
             "/get_fee_estimate": self.get_fee_estimate,
         }
+        # RPC reads must not hold up block validation
+        return {route: peer_reads(endpoint) for route, endpoint in routes.items()}
 
     async def _state_changed(self, change: str, change_data: Optional[Dict[str, Any]] = None) -> List[WsRpcMessage]:
         if change_data is None:
@@ -452,6 +459,26 @@ class FullNodeRpcApi:
             }
         }
 
+    async def get_stake_cache_metrics(self, _: Dict[str, Any]) -> EndpointResult:
+        return {"metrics": self.service.blockchain.get_stake_cache_stats()}
+
+    async def get_db_reader_metrics(self, _: Dict[str, Any]) -> EndpointResult:
+        return {"metrics": self.service.db_wrapper.get_reader_stats()}
+
+    async def get_db_query_stats(self, request: Dict[str, Any]) -> EndpointResult:
+        query_stats = self.service.db_wrapper.query_stats
+        if query_stats is None:
+            raise ValueError("SQL query stats are not recorded, set full_node.db_query_stats in the config")
+        statements = query_stats.to_json_list()
+        if request.get("reset", False):
+            query_stats.reset()
+        return {"statements": statements}
+
+    async def get_db_maintenance_status(self, _: Dict[str, Any]) -> EndpointResult:
+        if self.service.db_maintenance is None:
+            raise ValueError("DB maintenance is disabled, see full_node.db_maintenance in the config")
+        return {"status": self.service.db_maintenance.get_status()}
+
     async def get_block_records(self, request: Dict[str, Any]) -> EndpointResult:
         if "start" not in request:
             raise ValueError("No start in request")
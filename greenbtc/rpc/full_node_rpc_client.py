@@ -65,6 +65,22 @@ class FullNodeRpcClient(RpcClient):
             return None
         return BlockRecord.from_json_dict(response["block_record"])
 
+    async def get_stake_cache_metrics(self) -> Dict[str, Dict[str, int]]:
+        response = await self.fetch("get_stake_cache_metrics", {})
+        return cast(Dict[str, Dict[str, int]], response["metrics"])
+
+    async def get_db_reader_metrics(self) -> Dict[str, Any]:
+        response = await self.fetch("get_db_reader_metrics", {})
+        return cast(Dict[str, Any], response["metrics"])
+
+    async def get_db_query_stats(self, reset: bool = False) -> List[Dict[str, Any]]:
+        response = await self.fetch("get_db_query_stats", {"reset": reset})
+        return cast(List[Dict[str, Any]], response["statements"])
+
+    async def get_db_maintenance_status(self) -> Dict[str, Any]:
+        response = await self.fetch("get_db_maintenance_status", {})
+        return cast(Dict[str, Any], response["status"])
+
     async def get_unfinished_block_headers(self) -> List[UnfinishedHeaderBlock]:
         response = await self.fetch("get_unfinished_block_headers", {})
         return [UnfinishedHeaderBlock.from_json_dict(r) for r in response["headers"]]
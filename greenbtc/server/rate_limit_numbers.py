@@ -157,6 +157,9 @@ rate_limits = {
             ProtocolMessageTypes.respond_stake_farm_count: RLSettings(500, 100),
             ProtocolMessageTypes.request_coin_records_by_puzzle_hash: RLSettings(500, 100),
             ProtocolMessageTypes.respond_coin_records_by_puzzle_hash: RLSettings(500, 100),
+            ProtocolMessageTypes.request_coin_states_page: RLSettings(1000, 100 * 1024 * 1024),
+            ProtocolMessageTypes.respond_coin_states_page: RLSettings(1000, 100 * 1024 * 1024),
+            ProtocolMessageTypes.reject_coin_states_page: RLSettings(1000, 100),
         },
     },
     2: {
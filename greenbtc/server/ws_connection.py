@@ -569,16 +569,15 @@ class WSGreenBTCConnection:
             await asyncio.wait_for(event.wait(), timeout=timeout)
         except asyncio.TimeoutError:
             self.log.debug(f"Request timeout: {message}")
+        finally:
+            # also when the caller is cancelled, so a late response isn't kept forever
+            self.pending_requests.pop(message.id)
+            result: Optional[Message] = self.request_results.pop(message.id, None)
 
-        self.pending_requests.pop(message.id)
-        result: Optional[Message] = None
-        if message.id in self.request_results:
-            result = self.request_results[message.id]
-            assert result is not None
+        if result is not None:
             self.log.debug(
                 f"<- {ProtocolMessageTypes(result.type).name} from: {self.peer_info.host}:{self.peer_info.port}"
             )
-            self.request_results.pop(message.id)
 
         return result
 
@@ -142,10 +142,12 @@ class FullNodeSimulator(FullNodeAPI):
                 # set coinstore
                 await self.full_node.coin_store.rollback_to_block(new_height)
                 await self.full_node.stake_record_store.rollback_to_block(new_height)
+                self.full_node.blockchain.stake_coefficient_engine.reset()
                 # set blockstore to new height
                 await self.full_node.block_store.rollback(new_height)
                 await self.full_node.block_store.set_peak(block_record.header_hash)
                 self.full_node.blockchain._peak_height = new_height
+            self.full_node.stake_record_store.commit_totals()
         # reload mempool
         await self.full_node.mempool_manager.new_peak(block_record, None)
 
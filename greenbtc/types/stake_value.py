@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
-from typing import List
+from typing import List, Sequence
 
 from greenbtc.consensus.block_rewards import MOJO_PER_GBTC
 from greenbtc.util.ints import uint16, uint64, uint32
@@ -67,3 +67,22 @@ def get_stake_value(stake_type: uint16, is_stake_farm: bool) -> StakeValue:
     if 0 <= stake_type < len(value):
         return value[stake_type]
     return StakeValue(0, "0")
+
+
+# float coefficients per stake type, parsed once. Rewards must keep the exact
+# float rounding of StakeValue.reward_amount, so these are not scaled to ints
+STAKE_FARM_COEFFICIENTS: List[float] = [float(value.coefficient) for value in STAKE_FARM_LIST]
+STAKE_LOCK_COEFFICIENTS: List[float] = [float(value.coefficient) for value in STAKE_LOCK_LIST]
+
+
+def stake_reward_amounts(amounts: Sequence[int], stake_types: Sequence[int], is_stake_farm: bool) -> List[int]:
+    """
+    Same as get_stake_value(stake_type, is_stake_farm).reward_amount(amount) for each (amount, stake_type) pair,
+    without looking up and parsing the coefficient of every record
+    """
+    coefficients = STAKE_FARM_COEFFICIENTS if is_stake_farm else STAKE_LOCK_COEFFICIENTS
+    count = len(coefficients)
+    return [
+        int(int(amount) * (coefficients[stake_type] if 0 <= stake_type < count else 0.0) * MOJO_PER_GBTC)
+        for amount, stake_type in zip(amounts, stake_types)
+    ]
@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from greenbtc.consensus.block_record import BlockRecord
+from greenbtc.consensus.blockchain_interface import BlockchainInterface
+from greenbtc.types.block_protocol import BlockInfo
+from greenbtc.types.blockchain_format.sized_bytes import bytes32
+from greenbtc.types.blockchain_format.sub_epoch_summary import SubEpochSummary
+from greenbtc.types.full_block import FullBlock
+from greenbtc.types.generator_types import BlockGenerator
+from greenbtc.util.ints import uint32
+
+if TYPE_CHECKING:
+    from greenbtc.consensus.blockchain import Blockchain
+
+
+class AugmentedBlockchain(BlockchainInterface):
+    """
+    A view of the blockchain extended with blocks that passed pre-validation,
+    but haven't been added to it yet. It lets the blocks following them be
+    pre-validated before they're added, all lookups see the extra blocks
+    first. Block records added by pre-validation go to the blockchain, as they
+    would without this view.
+    """
+
+    _underlying: Blockchain
+    # header hash -> block and its record
+    _extra_blocks: Dict[bytes32, Tuple[FullBlock, BlockRecord]]
+    # the heights of the extra blocks extending the main chain of the
+    # underlying blockchain
+    _height_to_hash: Dict[uint32, bytes32]
+
+    def __init__(self, underlying: Blockchain) -> None:
+        self._underlying = underlying
+        self._extra_blocks = {}
+        self._height_to_hash = {}
+
+    def add_extra_block(self, block: FullBlock, block_record: BlockRecord) -> None:
+        # the block is only part of the main chain of this view if its parent is
+        if block_record.height == 0 or self.height_to_hash(uint32(block_record.height - 1)) == block_record.prev_hash:
+            self._height_to_hash[block_record.height] = block_record.header_hash
+        self._extra_blocks[block_record.header_hash] = (block, block_record)
+
+    def remove_added_blocks(self) -> None:
+        """
+        Forgets the extra blocks that are now in the main chain of the
+        underlying blockchain. The other ones are kept, so the view stays
+        consistent while a fork is added to the blockchain
+        """
+        for header_hash, (_, block_record) in list(self._extra_blocks.items()):
+            if self._underlying.height_to_hash(block_record.height) != header_hash:
+                continue
+            del self._extra_blocks[header_hash]
+            if self._height_to_hash.get(block_record.height) == header_hash:
+                del self._height_to_hash[block_record.height]
+
+    def get_peak(self) -> Optional[BlockRecord]:
+        return self._underlying.get_peak()
+
+    def get_peak_height(self) -> Optional[uint32]:
+        return self._underlying.get_peak_height()
+
+    def block_record(self, header_hash: bytes32) -> BlockRecord:
+        extra = self._extra_blocks.get(header_hash)
+        if extra is not None:
+            return extra[1]
+        return self._underlying.block_record(header_hash)
+
+    def height_to_block_record(self, height: uint32) -> BlockRecord:
+        header_hash = self.height_to_hash(height)
+        if header_hash is None:
+            raise ValueError(f"Height is not in blockchain: {height}")
+        return self.block_record(header_hash)
+
+    def get_ses_heights(self) -> List[uint32]:
+        return self._underlying.get_ses_heights()
+
+    def get_ses(self, height: uint32) -> SubEpochSummary:
+        return self._underlying.get_ses(height)
+
+    def height_to_hash(self, height: uint32) -> Optional[bytes32]:
+        header_hash = self._height_to_hash.get(height)
+        if header_hash is not None:
+            return header_hash
+        return self._underlying.height_to_hash(height)
+
+    def contains_block(self, header_hash: bytes32) -> bool:
+        return header_hash in self._extra_blocks or self._underlying.contains_block(header_hash)
+
+    async def contains_block_from_db(self, header_hash: bytes32) -> bool:
+        return header_hash in self._extra_blocks or await self._underlying.contains_block_from_db(header_hash)
+
+    def remove_block_record(self, header_hash: bytes32) -> None:
+        if header_hash not in self._extra_blocks:
+            self._underlying.remove_block_record(header_hash)
+
+    def add_block_record(self, block_record: BlockRecord) -> None:
+        # the extra blocks must not be in the cache of the blockchain before
+        # they're added to it
+        if block_record.header_hash not in self._extra_blocks:
+            self._underlying.add_block_record(block_record)
+
+    def contains_height(self, height: uint32) -> bool:
+        return height in self._height_to_hash or self._underlying.contains_height(height)
+
+    async def get_block_record_from_db(self, header_hash: bytes32) -> Optional[BlockRecord]:
+        extra = self._extra_blocks.get(header_hash)
+        if extra is not None:
+            return extra[1]
+        return await self._underlying.get_block_record_from_db(header_hash)
+
+    async def get_block_generator(
+        self, block: BlockInfo, additional_blocks: Optional[Dict[bytes32, FullBlock]] = None
+    ) -> Optional[BlockGenerator]:
+        if len(block.transactions_generator_ref_list) > 0:
+            # the generators referenced may be in the extra blocks
+            blocks = {header_hash: extra[0] for header_hash, extra in self._extra_blocks.items()}
+            if additional_blocks is not None:
+                blocks.update(additional_blocks)
+            additional_blocks = blocks
+        return await self._underlying.get_block_generator(block, additional_blocks)
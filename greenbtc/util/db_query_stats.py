@@ -0,0 +1,236 @@
+from __future__ import annotations
+
+import collections
+import dataclasses
+import functools
+import logging
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Deque, Dict, List, Optional, Sequence
+
+log = logging.getLogger(__name__)
+
+# the number of most recent durations kept per statement, to estimate the p99 latency from
+QUERY_STATS_SAMPLES = 1000
+
+_whitespace = re.compile(r"\s+")
+# a list of placeholders, like the ones of "coin_name IN (?,?,?)"
+_placeholder_list = re.compile(r"\?(\s*,\s*\?)+")
+_savepoint = re.compile(r"\b(SAVEPOINT|RELEASE|ROLLBACK TO) s\d+", re.IGNORECASE)
+_number = re.compile(r"\b\d+\b")
+
+
+@functools.lru_cache(maxsize=4096)
+def statement_template(sql: str) -> str:
+    """
+    Returns sql with the parts that vary between executions of the same query
+    replaced, so they can be counted as one
+    """
+    sql = _whitespace.sub(" ", sql).strip()
+    sql = _savepoint.sub(r"\1 s?", sql)
+    sql = _placeholder_list.sub("?,...", sql)
+    return _number.sub("?", sql)
+
+
+@dataclasses.dataclass
+class StatementStats:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+    rows: int = 0
+    # the durations of the most recent executions
+    samples: Deque[float] = dataclasses.field(default_factory=lambda: collections.deque(maxlen=QUERY_STATS_SAMPLES))
+    # store method -> number of executions
+    origins: Dict[str, int] = dataclasses.field(default_factory=dict)
+
+    def p99(self) -> float:
+        if len(self.samples) == 0:
+            return 0.0
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, len(samples) * 99 // 100)]
+
+
+@dataclasses.dataclass
+class QueryStats:
+    """
+    Per statement template counts and latencies of the queries run on the
+    connections of a DBWrapper2. Queries are recorded from the threads of the
+    connections, hence the lock.
+    """
+
+    # queries taking longer than this many seconds are logged. 0 disables the log
+    slow_query_threshold: float = 0.0
+    statements: Dict[str, StatementStats] = dataclasses.field(default_factory=dict)
+    lock: threading.Lock = dataclasses.field(default_factory=threading.Lock)
+
+    def record(self, sql: str, origin: Optional[str], duration: float, rows: int) -> None:
+        template = statement_template(sql)
+        origin = "unknown" if origin is None else origin
+        with self.lock:
+            stats = self.statements.get(template)
+            if stats is None:
+                stats = StatementStats()
+                self.statements[template] = stats
+            stats.count += 1
+            stats.total += duration
+            stats.max = max(stats.max, duration)
+            stats.rows += rows
+            stats.samples.append(duration)
+            stats.origins[origin] = stats.origins.get(origin, 0) + 1
+
+        if self.slow_query_threshold > 0 and duration >= self.slow_query_threshold:
+            log.warning(f"slow query: {duration * 1000:.0f} ms, {rows} rows, from {origin}: {template}")
+
+    def reset(self) -> None:
+        with self.lock:
+            self.statements = {}
+
+    def to_json_list(self) -> List[Dict[str, Any]]:
+        """
+        Returns the stats of every statement, the ones taking the most time in total first
+        """
+        with self.lock:
+            ret = [
+                {
+                    "statement": template,
+                    "count": stats.count,
+                    "total_ms": stats.total * 1000,
+                    "mean_ms": stats.total * 1000 / stats.count,
+                    "p99_ms": stats.p99() * 1000,
+                    "max_ms": stats.max * 1000,
+                    "rows": stats.rows,
+                    "origins": dict(sorted(stats.origins.items(), key=lambda item: -item[1])),
+                }
+                for template, stats in self.statements.items()
+            ]
+        ret.sort(key=lambda entry: -entry["total_ms"])
+        return ret
+
+
+@dataclasses.dataclass
+class ConnectionOrigin:
+    # the store method currently using the connection, set by DBWrapper2 when
+    # it hands out the connection
+    name: Optional[str] = None
+
+
+class _Query:
+    __slots__ = ("sql", "origin", "duration", "rows")
+
+    def __init__(self, sql: str, origin: Optional[str], duration: float) -> None:
+        self.sql = sql
+        self.origin = origin
+        self.duration = duration
+        self.rows = 0
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    A cursor recording the time spent executing each statement and fetching
+    its rows, along with the number of rows. A query is recorded once all its
+    rows are fetched, the cursor is closed or executes the next statement.
+    """
+
+    connection: InstrumentedConnection
+    _query: Optional[_Query] = None
+
+    def _finish(self) -> None:
+        query = self._query
+        if query is not None:
+            self._query = None
+            self.connection.query_stats.record(query.sql, query.origin, query.duration, query.rows)
+
+    def execute(self, sql: str, parameters: Any = (), /) -> InstrumentedCursor:
+        self._finish()
+        start = time.monotonic()
+        super().execute(sql, parameters)
+        self._query = _Query(sql, self.connection.origin.name, time.monotonic() - start)
+        if self.description is None:
+            # not a query returning rows
+            self._finish()
+        return self
+
+    def executemany(self, sql: str, seq_of_parameters: Any, /) -> InstrumentedCursor:
+        self._finish()
+        start = time.monotonic()
+        super().executemany(sql, seq_of_parameters)
+        self._query = _Query(sql, self.connection.origin.name, time.monotonic() - start)
+        self._finish()
+        return self
+
+    def fetchone(self) -> Any:
+        start = time.monotonic()
+        row = super().fetchone()
+        query = self._query
+        if query is not None:
+            query.duration += time.monotonic() - start
+            if row is None:
+                self._finish()
+            else:
+                query.rows += 1
+        return row
+
+    def fetchmany(self, size: Optional[int] = None) -> List[Any]:
+        if size is None:
+            size = self.arraysize
+        start = time.monotonic()
+        rows = super().fetchmany(size)
+        query = self._query
+        if query is not None:
+            query.duration += time.monotonic() - start
+            query.rows += len(rows)
+            if len(rows) < size:
+                self._finish()
+        return rows
+
+    def fetchall(self) -> List[Any]:
+        start = time.monotonic()
+        rows = super().fetchall()
+        query = self._query
+        if query is not None:
+            query.duration += time.monotonic() - start
+            query.rows += len(rows)
+            self._finish()
+        return rows
+
+    def __next__(self) -> Any:
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def close(self) -> None:
+        self._finish()
+        super().close()
+
+    def __del__(self) -> None:
+        self._finish()
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """
+    A sqlite3 connection whose cursors record their queries in query_stats.
+    Pass it as the factory to sqlite3.connect(), along with the QueryStats and
+    ConnectionOrigin to use.
+    """
+
+    query_stats: QueryStats
+    origin: ConnectionOrigin
+
+    def __init__(self, *args: Any, query_stats: QueryStats, origin: ConnectionOrigin, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.query_stats = query_stats
+        self.origin = origin
+
+    def cursor(self, factory: Any = InstrumentedCursor) -> Any:
+        return super().cursor(factory)
+
+    def execute(self, sql: str, parameters: Sequence[Any] = (), /) -> InstrumentedCursor:
+        cursor: InstrumentedCursor = self.cursor()
+        return cursor.execute(sql, parameters)
+
+    def executemany(self, sql: str, seq_of_parameters: Any, /) -> InstrumentedCursor:
+        cursor: InstrumentedCursor = self.cursor()
+        return cursor.executemany(sql, seq_of_parameters)
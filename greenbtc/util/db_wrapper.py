@@ -1,19 +1,41 @@
 from __future__ import annotations
 
 import asyncio
+import bisect
+import collections
 import contextlib
+import contextvars
+import enum
 import functools
 import random
 import sqlite3
 import sys
+import time
 from dataclasses import dataclass, field
 from datetime import datetime
 from pathlib import Path
-from typing import Any, AsyncIterator, Dict, Iterable, Optional, TextIO, Type, Union
+from types import FrameType
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Coroutine,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    TextIO,
+    Type,
+    TypeVar,
+    Union,
+)
 
 import aiosqlite
 import anyio
-from typing_extensions import final
+from typing_extensions import ParamSpec, final
+
+from greenbtc.util.db_query_stats import ConnectionOrigin, InstrumentedConnection, QueryStats
 
 if aiosqlite.sqlite_version_info < (3, 32, 0):
     SQLITE_MAX_VARIABLE_NUMBER = 900
@@ -23,6 +45,115 @@ else:
 # integers in sqlite are limited by int64
 SQLITE_INT_MAX = 2**63 - 1
 
+# when both kinds of reads are waiting for a connection, a peer read is let
+# through after this many consensus reads in a row
+CONSENSUS_READS_PER_PEER_READ = 4
+
+# upper bounds, in milliseconds, of the reader latency histogram buckets. The
+# last bucket counts everything slower
+READ_LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+
+class DBReadPriority(enum.IntEnum):
+    # lower values are higher priority
+    consensus = 0
+    peer = 1
+
+
+# the priority of the reads made by the current task. Reads are consensus
+# critical unless the task says otherwise
+_read_priority: contextvars.ContextVar[DBReadPriority] = contextvars.ContextVar(
+    "_read_priority", default=DBReadPriority.consensus
+)
+
+
+@contextlib.contextmanager
+def read_priority(priority: DBReadPriority) -> Iterator[None]:
+    """
+    Makes the reader connections requested by the current task, within this
+    context, wait with the given priority.
+    """
+    token = _read_priority.set(priority)
+    try:
+        yield
+    finally:
+        _read_priority.reset(token)
+
+
+def peer_reads(
+    f: Callable[P, Coroutine[Any, Any, R]],
+) -> Callable[P, Coroutine[Any, Any, R]]:
+    """
+    Decorator for request handlers serving peers or RPC clients. Their reads
+    yield to consensus critical reads, and can't take the last free reader
+    connection.
+    """
+
+    @functools.wraps(f)
+    async def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+        with read_priority(DBReadPriority.peer):
+            return await f(*args, **kwargs)
+
+    return wrapper
+
+
+@dataclass
+class LatencyHistogram:
+    # counts[i] is the number of samples up to READ_LATENCY_BUCKETS_MS[i], the
+    # last one counts the samples slower than all buckets
+    counts: List[int] = field(default_factory=lambda: [0] * (len(READ_LATENCY_BUCKETS_MS) + 1))
+    total: float = 0.0
+    max: float = 0.0
+
+    def add(self, seconds: float) -> None:
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(READ_LATENCY_BUCKETS_MS, ms)] += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def to_json_dict(self) -> Dict[str, Any]:
+        count = sum(self.counts)
+        buckets = [str(bound) for bound in READ_LATENCY_BUCKETS_MS] + ["inf"]
+        return {
+            "count": count,
+            "mean_ms": self.total / count if count > 0 else 0.0,
+            "max_ms": self.max,
+            "buckets_ms": dict(zip(buckets, self.counts)),
+        }
+
+
+@dataclass
+class ReaderStats:
+    # time spent waiting for a reader connection
+    wait: LatencyHistogram = field(default_factory=LatencyHistogram)
+    # time a reader connection was held, i.e. the duration of the queries
+    # made through it
+    hold: LatencyHistogram = field(default_factory=LatencyHistogram)
+
+
+# frames of these files are skipped when looking for the store method using a connection
+_internal_files = {__file__, contextlib.__file__}
+
+
+def _caller_name() -> Optional[str]:
+    frame: Optional[FrameType] = sys._getframe(1)
+    while frame is not None and frame.f_code.co_filename in _internal_files:
+        frame = frame.f_back
+    if frame is None:
+        return None
+    code = frame.f_code
+    qualname: Optional[str] = getattr(code, "co_qualname", None)
+    if qualname is not None:
+        return qualname
+    # co_qualname is new in python 3.11
+    self = frame.f_locals.get("self")
+    if self is None:
+        return code.co_name
+    return f"{type(self).__name__}.{code.co_name}"
+
 
 def generate_in_memory_db_uri() -> str:
     # We need to use shared cache as our DB wrapper uses different types of connections
@@ -43,8 +174,18 @@ async def _create_connection(
     uri: bool = False,
     log_file: Optional[TextIO] = None,
     name: Optional[str] = None,
+    query_stats: Optional[QueryStats] = None,
+    origin: Optional[ConnectionOrigin] = None,
 ) -> aiosqlite.Connection:
-    connection = await aiosqlite.connect(database=database, uri=uri)
+    if query_stats is None:
+        connection = await aiosqlite.connect(database=database, uri=uri)
+    else:
+        factory = functools.partial(
+            InstrumentedConnection,
+            query_stats=query_stats,
+            origin=ConnectionOrigin() if origin is None else origin,
+        )
+        connection = await aiosqlite.connect(database=database, uri=uri, factory=factory)
 
     if log_file is not None:
         await connection.set_trace_callback(functools.partial(sql_trace_callback, file=log_file, name=name))
@@ -58,9 +199,13 @@ async def manage_connection(
     uri: bool = False,
     log_file: Optional[TextIO] = None,
     name: Optional[str] = None,
+    query_stats: Optional[QueryStats] = None,
+    origin: Optional[ConnectionOrigin] = None,
 ) -> AsyncIterator[aiosqlite.Connection]:
     connection: aiosqlite.Connection
-    connection = await _create_connection(database=database, uri=uri, log_file=log_file, name=name)
+    connection = await _create_connection(
+        database=database, uri=uri, log_file=log_file, name=name, query_stats=query_stats, origin=origin
+    )
 
     try:
         yield connection
@@ -110,8 +255,23 @@ class DBWrapper2:
     _read_connections: asyncio.Queue[aiosqlite.Connection] = field(default_factory=asyncio.Queue)
     _num_read_connections: int = 0
     _in_use: Dict[asyncio.Task[object], aiosqlite.Connection] = field(default_factory=dict)
+    # the tasks waiting for a reader connection, in order, by priority
+    _read_waiters: Dict[DBReadPriority, collections.deque[asyncio.Future[aiosqlite.Connection]]] = field(
+        default_factory=lambda: {priority: collections.deque() for priority in sorted(DBReadPriority)}
+    )
+    # the number of reader connections held by peer reads
+    _peer_readers: int = 0
+    # the number of consensus reads that were let through while peer reads were waiting
+    _consensus_reads_in_row: int = 0
+    _reader_stats: Dict[DBReadPriority, ReaderStats] = field(
+        default_factory=lambda: {priority: ReaderStats() for priority in DBReadPriority}
+    )
     _current_writer: Optional[asyncio.Task[object]] = None
     _savepoint_name: int = 0
+    # the per-statement stats of the queries, if they're recorded
+    query_stats: Optional[QueryStats] = None
+    # the store method using each connection, for the query stats
+    _origins: Dict[aiosqlite.Connection, ConnectionOrigin] = field(default_factory=dict)
 
     async def add_connection(self, c: aiosqlite.Connection) -> None:
         # this guarantees that reader connections can only be used for reading
@@ -134,6 +294,7 @@ class DBWrapper2:
         synchronous: Optional[str] = None,
         foreign_keys: bool = False,
         row_factory: Optional[Type[aiosqlite.Row]] = None,
+        query_stats: Optional[QueryStats] = None,
     ) -> AsyncIterator[DBWrapper2]:
         async with contextlib.AsyncExitStack() as async_exit_stack:
             if log_path is None:
@@ -142,8 +303,16 @@ class DBWrapper2:
                 log_path.parent.mkdir(parents=True, exist_ok=True)
                 log_file = async_exit_stack.enter_context(log_path.open("a", encoding="utf-8"))
 
+            write_origin = ConnectionOrigin()
             write_connection = await async_exit_stack.enter_async_context(
-                manage_connection(database=database, uri=uri, log_file=log_file, name="writer"),
+                manage_connection(
+                    database=database,
+                    uri=uri,
+                    log_file=log_file,
+                    name="writer",
+                    query_stats=query_stats,
+                    origin=write_origin,
+                ),
             )
             await (await write_connection.execute(f"pragma journal_mode={journal_mode}")).close()
             if synchronous is not None:
@@ -153,18 +322,28 @@ class DBWrapper2:
 
             write_connection.row_factory = row_factory
 
-            self = cls(_write_connection=write_connection, db_version=db_version, _log_file=log_file)
+            self = cls(
+                _write_connection=write_connection,
+                db_version=db_version,
+                _log_file=log_file,
+                query_stats=query_stats,
+            )
+            self._origins[write_connection] = write_origin
 
             for index in range(reader_count):
+                read_origin = ConnectionOrigin()
                 read_connection = await async_exit_stack.enter_async_context(
                     manage_connection(
                         database=database,
                         uri=uri,
                         log_file=log_file,
                         name=f"reader-{index}",
+                        query_stats=query_stats,
+                        origin=read_origin,
                     ),
                 )
                 read_connection.row_factory = row_factory
+                self._origins[read_connection] = read_origin
                 await self.add_connection(c=read_connection)
 
             try:
@@ -188,6 +367,7 @@ class DBWrapper2:
         synchronous: Optional[str] = None,
         foreign_keys: bool = False,
         row_factory: Optional[Type[aiosqlite.Row]] = None,
+        query_stats: Optional[QueryStats] = None,
     ) -> DBWrapper2:
         # WARNING: please use .managed() instead
         if log_path is None:
@@ -195,7 +375,15 @@ class DBWrapper2:
         else:
             log_path.parent.mkdir(parents=True, exist_ok=True)
             log_file = log_path.open("a", encoding="utf-8")
-        write_connection = await _create_connection(database=database, uri=uri, log_file=log_file, name="writer")
+        write_origin = ConnectionOrigin()
+        write_connection = await _create_connection(
+            database=database,
+            uri=uri,
+            log_file=log_file,
+            name="writer",
+            query_stats=query_stats,
+            origin=write_origin,
+        )
         await (await write_connection.execute(f"pragma journal_mode={journal_mode}")).close()
         if synchronous is not None:
             await (await write_connection.execute(f"pragma synchronous={synchronous}")).close()
@@ -204,16 +392,26 @@ class DBWrapper2:
 
         write_connection.row_factory = row_factory
 
-        self = cls(_write_connection=write_connection, db_version=db_version, _log_file=log_file)
+        self = cls(
+            _write_connection=write_connection,
+            db_version=db_version,
+            _log_file=log_file,
+            query_stats=query_stats,
+        )
+        self._origins[write_connection] = write_origin
 
         for index in range(reader_count):
+            read_origin = ConnectionOrigin()
             read_connection = await _create_connection(
                 database=database,
                 uri=uri,
                 log_file=log_file,
                 name=f"reader-{index}",
+                query_stats=query_stats,
+                origin=read_origin,
             )
             read_connection.row_factory = row_factory
+            self._origins[read_connection] = read_origin
             await self.add_connection(c=read_connection)
 
         return self
@@ -229,6 +427,21 @@ class DBWrapper2:
             if self._log_file is not None:
                 self._log_file.close()
 
+    @contextlib.contextmanager
+    def _query_origin(self, c: aiosqlite.Connection) -> Iterator[None]:
+        # record which store method the queries made on c, within this
+        # context, come from
+        origin = self._origins.get(c) if self.query_stats is not None else None
+        if origin is None:
+            yield
+            return
+        previous = origin.name
+        origin.name = _caller_name()
+        try:
+            yield
+        finally:
+            origin.name = previous
+
     def _next_savepoint(self) -> str:
         name = f"s{self._savepoint_name}"
         self._savepoint_name += 1
@@ -265,14 +478,16 @@ class DBWrapper2:
         if self._current_writer == task:
             # we allow nesting writers within the same task
             async with self._savepoint_ctx():
-                yield self._write_connection
+                with self._query_origin(self._write_connection):
+                    yield self._write_connection
             return
 
         async with self._lock:
             async with self._savepoint_ctx():
                 self._current_writer = task
                 try:
-                    yield self._write_connection
+                    with self._query_origin(self._write_connection):
+                        yield self._write_connection
                 finally:
                     self._current_writer = None
 
@@ -289,14 +504,16 @@ class DBWrapper2:
         assert task is not None
         if self._current_writer == task:
             # just use the existing transaction
-            yield self._write_connection
+            with self._query_origin(self._write_connection):
+                yield self._write_connection
             return
 
         async with self._lock:
             async with self._savepoint_ctx():
                 self._current_writer = task
                 try:
-                    yield self._write_connection
+                    with self._query_origin(self._write_connection):
+                        yield self._write_connection
                 finally:
                     self._current_writer = None
 
@@ -331,18 +548,99 @@ class DBWrapper2:
         if self._current_writer == task:
             # we allow nesting reading while also having a writer connection
             # open, within the same task
-            yield self._write_connection
+            with self._query_origin(self._write_connection):
+                yield self._write_connection
             return
 
         if task in self._in_use:
-            yield self._in_use[task]
+            with self._query_origin(self._in_use[task]):
+                yield self._in_use[task]
         else:
-            c = await self._read_connections.get()
+            priority = _read_priority.get()
+            stats = self._reader_stats[priority]
+            start = time.monotonic()
+            c = await self._acquire_reader(priority)
+            acquired = time.monotonic()
+            stats.wait.add(acquired - start)
             try:
                 # record our connection in this dict to allow nested calls in
                 # the same task to use the same connection
                 self._in_use[task] = c
-                yield c
+                with self._query_origin(c):
+                    yield c
             finally:
                 del self._in_use[task]
-                self._read_connections.put_nowait(c)
+                stats.hold.add(time.monotonic() - acquired)
+                self._release_reader(c, priority)
+
+    def _peer_reader_limit(self) -> int:
+        # keep one connection for consensus reads, unless there's only one
+        return max(1, self._num_read_connections - 1)
+
+    def _can_read(self, priority: DBReadPriority) -> bool:
+        return priority != DBReadPriority.peer or self._peer_readers < self._peer_reader_limit()
+
+    def _take_reader(self, priority: DBReadPriority) -> None:
+        if priority == DBReadPriority.peer:
+            self._peer_readers += 1
+            self._consensus_reads_in_row = 0
+        elif len(self._read_waiters[DBReadPriority.peer]) > 0:
+            self._consensus_reads_in_row += 1
+
+    async def _acquire_reader(self, priority: DBReadPriority) -> aiosqlite.Connection:
+        waiter: asyncio.Future[aiosqlite.Connection] = asyncio.get_running_loop().create_future()
+        self._read_waiters[priority].append(waiter)
+        self._dispatch_readers()
+        try:
+            return await waiter
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                # we were handed a connection, but were cancelled before we
+                # could use it. Pass it on
+                self._release_reader(waiter.result(), priority)
+            elif waiter in self._read_waiters[priority]:
+                self._read_waiters[priority].remove(waiter)
+            raise
+
+    def _release_reader(self, c: aiosqlite.Connection, priority: DBReadPriority) -> None:
+        if priority == DBReadPriority.peer:
+            self._peer_readers -= 1
+        self._read_connections.put_nowait(c)
+        self._dispatch_readers()
+
+    def _next_read_waiter(self) -> Optional[DBReadPriority]:
+        consensus = self._read_waiters[DBReadPriority.consensus]
+        peer = self._read_waiters[DBReadPriority.peer]
+        peer_ready = len(peer) > 0 and self._can_read(DBReadPriority.peer)
+        if peer_ready and (len(consensus) == 0 or self._consensus_reads_in_row >= CONSENSUS_READS_PER_PEER_READ):
+            return DBReadPriority.peer
+        if len(consensus) > 0:
+            return DBReadPriority.consensus
+        return None
+
+    def _dispatch_readers(self) -> None:
+        # hand the free connections to the waiters next in line
+        while not self._read_connections.empty():
+            priority = self._next_read_waiter()
+            if priority is None:
+                break
+            waiter = self._read_waiters[priority].popleft()
+            if waiter.done():
+                # cancelled while waiting
+                continue
+            self._take_reader(priority)
+            waiter.set_result(self._read_connections.get_nowait())
+
+    def get_reader_stats(self) -> Dict[str, Any]:
+        """
+        Returns the reader connection wait and hold time histograms, per read priority
+        """
+        return {
+            "reader_count": self._num_read_connections,
+            "peer_reader_limit": self._peer_reader_limit(),
+            "waiting": {priority.name: len(waiters) for priority, waiters in self._read_waiters.items()},
+            **{
+                priority.name: {"wait": stats.wait.to_json_dict(), "hold": stats.hold.to_json_dict()}
+                for priority, stats in self._reader_stats.items()
+            },
+        }
@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import Dict, Generic, Optional, Set, Tuple, TypeVar
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+class HeightCache(Generic[K, V]):
+    """
+    An LRU cache of values that are derived from the chain at a given height. Besides evicting the least recently
+    used entry once capacity is reached, entries can be dropped by height: everything above a fork point when the
+    chain reorgs, and everything below a height that is no longer interesting.
+    """
+
+    def __init__(self, capacity: int):
+        self.cache: OrderedDict[Tuple[int, K], V] = OrderedDict()
+        self.heights: Dict[int, Set[K]] = {}
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+    def get(self, height: int, key: K) -> Optional[V]:
+        value = self.cache.get((height, key))
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.cache.move_to_end((height, key))
+        return value
+
+    def put(self, height: int, key: K, value: V) -> None:
+        self.cache[(height, key)] = value
+        self.cache.move_to_end((height, key))
+        self.heights.setdefault(height, set()).add(key)
+        while len(self.cache) > self.capacity:
+            (evicted_height, evicted_key), _ = self.cache.popitem(last=False)
+            self._forget(evicted_height, evicted_key)
+            self.evictions += 1
+
+    def _forget(self, height: int, key: K) -> None:
+        keys = self.heights[height]
+        keys.discard(key)
+        if len(keys) == 0:
+            del self.heights[height]
+
+    def remove_height(self, height: int) -> None:
+        for key in self.heights.pop(height, set()):
+            del self.cache[(height, key)]
+            self.evictions += 1
+
+    def rollback(self, fork_height: int) -> None:
+        """
+        Drops all entries above fork_height, they were computed from blocks that are no longer in the main chain
+        """
+        for height in [height for height in self.heights if height > fork_height]:
+            self.remove_height(height)
+
+    def prune(self, min_height: int) -> None:
+        """
+        Drops all entries below min_height
+        """
+        for height in [height for height in self.heights if height < min_height]:
+            self.remove_height(height)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self.cache),
+            "capacity": self.capacity,
+            "heights": len(self.heights),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -24,6 +24,7 @@ from greenbtc.protocols.full_node_protocol import RequestProofOfWeight, RespondP
 from greenbtc.protocols.protocol_message_types import ProtocolMessageTypes
 from greenbtc.protocols.wallet_protocol import (
     CoinState,
+    CoinStateCursor,
     CoinStateUpdate,
     NewPeakWallet,
     RegisterForCoinUpdates,
@@ -37,6 +38,9 @@ from greenbtc.protocols.wallet_protocol import (
     RespondStakeFarmCount,
     RequestCoinRecords,
     RespondCoinRecords,
+    RequestCoinStatesPage,
+    RespondCoinStatesPage,
+    RejectCoinStatesPage,
 )
 from greenbtc.rpc.rpc_server import StateChangedProtocol, default_get_connections
 from greenbtc.server.node_discovery import WalletPeers
@@ -1749,6 +1753,37 @@ class WalletNode:
                 return response.coinRecords
         return []
 
+    async def request_coin_states_paginated(
+        self,
+        puzzle_hashes: List[bytes32],
+        min_height: uint32 = uint32(0),
+        include_spent_coins: bool = True,
+        page_size: uint32 = uint32(1000),
+    ) -> AsyncIterator[CoinState]:
+        """
+        Yields the coin states of puzzle_hashes one page at a time, ordered by (height, coin id). The cursor doesn't
+        depend on the peer, so every page is asked from the first full node peer that answers
+        """
+        cursor: Optional[CoinStateCursor] = None
+        while True:
+            request = RequestCoinStatesPage(puzzle_hashes, min_height, include_spent_coins, cursor, page_size)
+            response: Optional[Union[RespondCoinStatesPage, RejectCoinStatesPage]] = None
+            for peer in self.get_full_node_peers_in_order():
+                response = await peer.call_api(FullNodeAPI.request_coin_states_page, request)
+                if response is not None:
+                    break
+            if isinstance(response, RejectCoinStatesPage):
+                raise PeerRequestException(
+                    f"Too many puzzle hashes ({len(puzzle_hashes)}), the peer allows {response.max_puzzle_hashes}"
+                )
+            if response is None:
+                raise PeerRequestException(f"Was not able to get coin states after {cursor}")
+            for coin_state in response.coin_states:
+                yield coin_state
+            if response.cursor is None:
+                return
+            cursor = response.cursor
+
     def set_auto_withdraw_stake(self, auto_withdraw_config: AutoWithdrawStakeSettings) -> Dict[str, Any]:
         if auto_withdraw_config.batch_size < 1:
             auto_withdraw_config = dataclasses.replace(auto_withdraw_config, batch_size=uint16(50))
@@ -207,3 +207,11 @@ class WalletNodeAPI:
     @api_request()
     async def respond_coin_records_by_puzzle_hash(self, response: wallet_protocol.RespondCoinRecords):
         pass
+
+    @api_request()
+    async def respond_coin_states_page(self, response: wallet_protocol.RespondCoinStatesPage):
+        pass
+
+    @api_request()
+    async def reject_coin_states_page(self, response: wallet_protocol.RejectCoinStatesPage):
+        pass
@@ -72,6 +72,11 @@ legacy_keyring_dependencies = [
     "keyrings.cryptfile==1.3.9",
 ]
 
+# compressing blocks with a trained dictionary, see "greenbtc db compress-blocks"
+compression_dependencies = [
+    "zstandard==0.22.0",
+]
+
 kwargs = dict(
     name="greenbtc-blockchain",
     author="Mariano Sorgente",
@@ -86,6 +91,7 @@ kwargs = dict(
         dev=dev_dependencies,
         upnp=upnp_dependencies,
         legacy_keyring=legacy_keyring_dependencies,
+        compression=compression_dependencies,
     ),
     packages=find_packages(include=["build_scripts", "greenbtc", "greenbtc.*", "mozilla-ca"]),
     entry_points={
@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+from typing import Dict, List, Set, Tuple
+
+import pytest
+
+from greenbtc.full_node.coin_store import CoinStore
+from greenbtc.types.blockchain_format.coin import Coin
+from greenbtc.types.blockchain_format.sized_bytes import bytes32
+from greenbtc.types.coin_record import CoinRecord
+from greenbtc.util.db_wrapper import DBWrapper2
+from greenbtc.util.ints import uint32, uint64
+from tests.util.db_connection import DBConnection
+
+PUZZLE_HASHES = [bytes32(bytes([i]) * 32) for i in range(1, 4)]
+
+
+def make_coin(n: int, puzzle_hash: bytes32) -> Coin:
+    return Coin(bytes32(n.to_bytes(32, "big")), puzzle_hash, uint64(n))
+
+
+async def add_blocks(db_wrapper: DBWrapper2, coin_store: CoinStore) -> Dict[bytes32, CoinRecord]:
+    """
+    Adds 10 blocks, each with two reward coins and one transaction coin, and spends the transaction coin of every
+    other block in the next one. Returns the expected coin records by coin name
+    """
+    expected: Dict[bytes32, CoinRecord] = {}
+    n = 1
+    for height in range(1, 11):
+        timestamp = uint64(1000 + height)
+        rewards = [make_coin(n, PUZZLE_HASHES[0]), make_coin(n + 1, PUZZLE_HASHES[1])]
+        additions = [make_coin(n + 2, PUZZLE_HASHES[height % 3])]
+        n += 3
+        removals: List[bytes32] = []
+        if height % 2 == 0:
+            spent = expected[make_coin(n - 6 + 2, PUZZLE_HASHES[(height - 1) % 3]).name()]
+            removals.append(spent.name)
+            expected[spent.name] = CoinRecord(
+                spent.coin, spent.confirmed_block_index, uint32(height), False, spent.timestamp
+            )
+        async with db_wrapper.writer():
+            await coin_store.new_block(uint32(height), timestamp, rewards, additions, removals)
+        for coin in rewards:
+            expected[coin.name()] = CoinRecord(coin, uint32(height), uint32(0), True, timestamp)
+        for coin in additions:
+            expected[coin.name()] = CoinRecord(coin, uint32(height), uint32(0), False, timestamp)
+    return expected
+
+
+def select(
+    expected: Dict[bytes32, CoinRecord],
+    include_spent_coins: bool,
+    puzzle_hashes: Set[bytes32],
+    start_height: int = 0,
+    end_height: int = 2**32 - 1,
+) -> List[Tuple[bytes32, CoinRecord]]:
+    return sorted(
+        (name, record)
+        for name, record in expected.items()
+        if record.coin.puzzle_hash in puzzle_hashes
+        and start_height <= record.confirmed_block_index < end_height
+        and (include_spent_coins or not record.spent)
+    )
+
+
+def by_name(records: List[CoinRecord]) -> List[Tuple[bytes32, CoinRecord]]:
+    names = [record.name for record in records]
+    assert len(names) == len(set(names))
+    return sorted(zip(names, records))
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("include_spent_coins", [True, False])
+async def test_get_all_coins(include_spent_coins: bool) -> None:
+    async with DBConnection(2) as db_wrapper:
+        coin_store = await CoinStore.create(db_wrapper)
+        expected = await add_blocks(db_wrapper, coin_store)
+        records = await coin_store.get_all_coins(include_spent_coins)
+        assert by_name(records) == select(expected, include_spent_coins, set(PUZZLE_HASHES))
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("include_spent_coins", [True, False])
+async def test_get_coin_records_by_puzzle_hash(include_spent_coins: bool) -> None:
+    async with DBConnection(2) as db_wrapper:
+        coin_store = await CoinStore.create(db_wrapper)
+        expected = await add_blocks(db_wrapper, coin_store)
+        for puzzle_hash in PUZZLE_HASHES:
+            records = await coin_store.get_coin_records_by_puzzle_hash(include_spent_coins, puzzle_hash)
+            assert by_name(records) == select(expected, include_spent_coins, {puzzle_hash})
+            records = await coin_store.get_coin_records_by_puzzle_hash(
+                include_spent_coins, puzzle_hash, uint32(3), uint32(8)
+            )
+            assert by_name(records) == select(expected, include_spent_coins, {puzzle_hash}, 3, 8)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("include_spent_coins", [True, False])
+async def test_get_coin_records_by_puzzle_hashes(include_spent_coins: bool) -> None:
+    async with DBConnection(2) as db_wrapper:
+        coin_store = await CoinStore.create(db_wrapper)
+        expected = await add_blocks(db_wrapper, coin_store)
+        assert await coin_store.get_coin_records_by_puzzle_hashes(include_spent_coins, []) == []
+        puzzle_hashes = PUZZLE_HASHES[1:]
+        records = await coin_store.get_coin_records_by_puzzle_hashes(include_spent_coins, puzzle_hashes)
+        assert by_name(records) == select(expected, include_spent_coins, set(puzzle_hashes))
+        records = await coin_store.get_coin_records_by_puzzle_hashes(
+            include_spent_coins, puzzle_hashes, uint32(2), uint32(9)
+        )
+        assert by_name(records) == select(expected, include_spent_coins, set(puzzle_hashes), 2, 9)
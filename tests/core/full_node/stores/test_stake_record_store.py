@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+import asyncio
+import random
+from pathlib import Path
+from typing import Any, List, Tuple
+
+import pytest
+
+from greenbtc.cmds.db_upgrade_func import stake_indexes_upgrade_func
+from greenbtc.full_node.stake_record_store import STAKE_RECORD_INDEXES, StakeRecordStore
+from greenbtc.types.blockchain_format.sized_bytes import bytes32
+from greenbtc.types.stake_record import StakeRecord
+from greenbtc.types.stake_value import STAKE_FARM_LIST, STAKE_LOCK_LIST
+from greenbtc.util.db_wrapper import DBWrapper2
+from greenbtc.util.ints import uint16, uint32, uint64
+
+BLOCK_TIME = 19
+START_TIMESTAMP = 1631794488
+
+
+def make_stake_records(rng: random.Random, height: int, count: int = 4) -> List[StakeRecord]:
+    timestamp = START_TIMESTAMP + height * BLOCK_TIME
+    records = []
+    for _ in range(count):
+        is_stake_farm = rng.random() < 0.5
+        stake_values = STAKE_FARM_LIST if is_stake_farm else STAKE_LOCK_LIST
+        stake_type = rng.randrange(len(stake_values))
+        records.append(
+            StakeRecord(
+                bytes32.random(rng),
+                uint64(rng.randint(100, 100000)),
+                uint32(height),
+                uint32(0),
+                bytes32.random(rng),
+                bytes32.random(rng),
+                uint16(stake_type),
+                is_stake_farm,
+                stake_values[stake_type].coefficient,
+                # expire within a few blocks, so the timestamps queried see records come and go
+                uint64(timestamp + rng.randint(1, 20) * BLOCK_TIME),
+            )
+        )
+    return records
+
+
+async def expected_total(db_wrapper: DBWrapper2, timestamp: int) -> Tuple[int, float, int]:
+    async with db_wrapper.reader_no_transaction() as conn:
+        rows = await conn.execute_fetchall(
+            "SELECT is_stake_farm,amount,coefficient FROM stake_record WHERE expiration>?", (timestamp,)
+        )
+    farm = sum(int(row[1]) for row in rows if row[0])
+    farm_calc = sum(int(row[1]) * float(row[2]) for row in rows if row[0])
+    lock = sum(int(row[1]) for row in rows if not row[0])
+    return farm, farm_calc, lock
+
+
+async def check_totals(db_wrapper: DBWrapper2, store: StakeRecordStore, height: int) -> None:
+    for blocks_back in (0, 3, 10):
+        timestamp = uint64(START_TIMESTAMP + (height - blocks_back) * BLOCK_TIME)
+        farm, farm_calc, lock = await store.get_stake_amount_total(timestamp)
+        expected_farm, expected_farm_calc, expected_lock = await expected_total(db_wrapper, timestamp)
+        assert (farm, lock) == (expected_farm, expected_lock)
+        assert farm_calc == pytest.approx(expected_farm_calc)
+
+
+async def add_block(db_wrapper: DBWrapper2, store: StakeRecordStore, rng: random.Random, height: int) -> None:
+    async with db_wrapper.writer():
+        await store.new_stake(uint32(height), make_stake_records(rng, height), [])
+    store.commit_totals()
+
+
+@pytest.mark.anyio
+async def test_stake_amount_total(tmp_path: Path) -> None:
+    rng = random.Random(5)
+    async with DBWrapper2.managed(tmp_path / "db.sqlite", db_version=2) as db_wrapper:
+        store = await StakeRecordStore.create(db_wrapper)
+        for height in range(1, 41):
+            await add_block(db_wrapper, store, rng, height)
+            await check_totals(db_wrapper, store, height)
+        assert store.stake_totals is not None
+
+        # a reorg, the new blocks are different
+        async with db_wrapper.writer():
+            await store.rollback_to_block(33)
+        store.commit_totals()
+        await check_totals(db_wrapper, store, 33)
+        for height in range(34, 45):
+            await add_block(db_wrapper, store, rng, height)
+            await check_totals(db_wrapper, store, height)
+
+
+@pytest.mark.anyio
+async def test_stake_amount_total_during_write(tmp_path: Path) -> None:
+    rng = random.Random(6)
+    async with DBWrapper2.managed(tmp_path / "db.sqlite", db_version=2) as db_wrapper:
+        store = await StakeRecordStore.create(db_wrapper)
+        for height in range(1, 11):
+            await add_block(db_wrapper, store, rng, height)
+
+        # totals are first loaded while a block is being added. What's read doesn't include the block, it isn't
+        # committed yet, so the load can't be kept
+        timestamp = uint64(START_TIMESTAMP + 10 * BLOCK_TIME)
+        async with db_wrapper.writer():
+            await store.new_stake(uint32(11), make_stake_records(rng, 11), [])
+            # other tasks read what's committed, this one reads its own transaction
+            farm, farm_calc, lock = await asyncio.create_task(store.get_stake_amount_total(timestamp))
+            expected_farm, expected_farm_calc, expected_lock = await asyncio.create_task(
+                expected_total(db_wrapper, timestamp)
+            )
+            assert (farm, lock) == (expected_farm, expected_lock)
+            assert farm_calc == pytest.approx(expected_farm_calc)
+            assert store.stake_totals is None
+        store.commit_totals()
+        await check_totals(db_wrapper, store, 11)
+
+        # with totals loaded, a rollback only changes them once committed
+        before = await store.get_stake_amount_total(timestamp)
+        async with db_wrapper.writer():
+            await store.rollback_to_block(8)
+            assert await asyncio.create_task(store.get_stake_amount_total(timestamp)) == before
+        store.commit_totals()
+        await check_totals(db_wrapper, store, 8)
+
+
+@pytest.mark.anyio
+async def test_stake_amount_total_failed_write(tmp_path: Path) -> None:
+    rng = random.Random(7)
+    async with DBWrapper2.managed(tmp_path / "db.sqlite", db_version=2) as db_wrapper:
+        store = await StakeRecordStore.create(db_wrapper)
+        for height in range(1, 11):
+            await add_block(db_wrapper, store, rng, height)
+        await check_totals(db_wrapper, store, 10)
+
+        with pytest.raises(RuntimeError):
+            async with db_wrapper.writer():
+                await store.new_stake(uint32(11), make_stake_records(rng, 11), [])
+                raise RuntimeError("failed to add the block")
+        # like Blockchain.add_block does
+        store.reset_caches()
+        await check_totals(db_wrapper, store, 10)
+        await add_block(db_wrapper, store, rng, 11)
+        await check_totals(db_wrapper, store, 11)
+
+
+async def query_all(store: StakeRecordStore, records: List[StakeRecord]) -> List[Any]:
+    stake_puzzle_hashes = [record.stake_puzzle_hash for record in records if record.is_stake_farm]
+    timestamp = uint64(START_TIMESTAMP + 5 * BLOCK_TIME)
+    store.reset_caches()
+    return [
+        await store.get_stake_farm_count(stake_puzzle_hashes[0], timestamp),
+        await store.get_stake_amount_total(timestamp),
+        await store.get_stake_farm_records_thin(stake_puzzle_hashes[0], uint32(8), timestamp),
+        await store.get_stake_farm_records_thin_by_puzzle_hashes(stake_puzzle_hashes, uint32(8), timestamp),
+        await store.get_stake_farm_records_thin_by_heights(
+            [(stake_puzzle_hash, uint32(4)) for stake_puzzle_hash in stake_puzzle_hashes], timestamp
+        ),
+        await store.get_stake_farm_records_expiring_after(timestamp),
+        await store.get_stake_lock_records_thin(uint64(0), uint64(86400)),
+    ]
+
+
+@pytest.mark.anyio
+async def test_legacy_indexes(tmp_path: Path) -> None:
+    rng = random.Random(8)
+    db_path = tmp_path / "db.sqlite"
+    records: List[StakeRecord] = []
+    async with DBWrapper2.managed(db_path, db_version=2) as db_wrapper:
+        store = await StakeRecordStore.create(db_wrapper)
+        assert store.has_covering_indexes
+        for height in range(1, 11):
+            block_records = make_stake_records(rng, height)
+            records += block_records
+            async with db_wrapper.writer():
+                await store.new_stake(uint32(height), block_records, [])
+            store.commit_totals()
+        expected = await query_all(store, records)
+
+        # the indexes of a database created by an earlier version
+        async with db_wrapper.writer() as conn:
+            for name, _ in STAKE_RECORD_INDEXES:
+                await conn.execute(f"DROP INDEX {name}")
+            await conn.execute("CREATE INDEX stake_confirmed_index on stake_record(confirmed_index)")
+            await conn.execute("CREATE INDEX stake_spent_index on stake_record(spent_index)")
+            await conn.execute("CREATE INDEX stake_stake_type on stake_record(stake_type)")
+            await conn.execute("CREATE INDEX stake_is_stake_farm on stake_record(is_stake_farm)")
+            await conn.execute("CREATE INDEX stake_expiration on stake_record(expiration)")
+            await conn.execute("CREATE INDEX stake_puzzle_hash on stake_record(stake_puzzle_hash)")
+            await conn.execute("CREATE INDEX puzzle_hash on stake_record(puzzle_hash)")
+
+        # they're left alone on startup, and queried until the upgrade command replaces them
+        store = await StakeRecordStore.create(db_wrapper)
+        assert not store.has_covering_indexes
+        assert await query_all(store, records) == expected
+
+    stake_indexes_upgrade_func(tmp_path, db_path)
+    async with DBWrapper2.managed(db_path, db_version=2) as db_wrapper:
+        store = await StakeRecordStore.create(db_wrapper)
+        assert store.has_covering_indexes
+        assert await query_all(store, records) == expected
+        async with db_wrapper.reader_no_transaction() as conn:
+            rows = await conn.execute_fetchall("SELECT name FROM sqlite_master WHERE name='stake_puzzle_hash'")
+        assert len(rows) == 0
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import random
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from greenbtc.full_node.block_height_map import BlockHeightMap
+from greenbtc.full_node.block_store import BlockStore
+from greenbtc.types.blockchain_format.sized_bytes import bytes32
+from greenbtc.util.db_wrapper import DBWrapper2
+from greenbtc.util.ints import uint32
+
+# blocks without a farm are stored with an all zero farm puzzle hash
+FARMS = [bytes32.random(random.Random(i)) for i in range(3)] + [bytes32(bytes(32))]
+
+
+def count_farms(farms: List[bytes32], begin_height: int, height: int, farm_puzzle_hash: bytes32) -> int:
+    # how get_height_farm_count counted before the heights were indexed
+    return bytearray(b"".join(farms)).count(farm_puzzle_hash, begin_height * 32 + 32, height * 32 + 32)
+
+
+async def add_chain(db_wrapper: DBWrapper2, farms: List[bytes32], rng: random.Random) -> List[bytes32]:
+    hashes: List[bytes32] = []
+    prev_hash = bytes32(bytes(32))
+    async with db_wrapper.writer() as conn:
+        for height, farm in enumerate(farms):
+            header_hash = bytes32.random(rng)
+            await conn.execute(
+                "INSERT INTO full_blocks(header_hash, prev_hash, height, sub_epoch_summary, is_fully_compactified, "
+                "in_main_chain, block, farm_puzzle_hash) VALUES(?, ?, ?, NULL, 0, 1, ?, ?)",
+                (header_hash, prev_hash, height, b"", farm),
+            )
+            hashes.append(header_hash)
+            prev_hash = header_hash
+        await conn.execute("INSERT OR REPLACE INTO current_peak VALUES(?, ?)", (0, prev_hash))
+    return hashes
+
+
+def check_counts(height_map: BlockHeightMap, farms: List[bytes32]) -> None:
+    for begin_height in range(-len(farms) - 3, len(farms) + 3):
+        for height in range(-len(farms) - 3, len(farms) + 3):
+            for farm in FARMS:
+                expected = count_farms(farms, begin_height, height, farm)
+                assert height_map.get_height_farm_count(begin_height, height, farm) == expected, (
+                    begin_height,
+                    height,
+                    farm,
+                )
+
+
+@pytest.mark.anyio
+async def test_get_height_farm_count(tmp_path: Path) -> None:
+    rng = random.Random(1)
+    farms = [rng.choice(FARMS) for _ in range(40)]
+    async with DBWrapper2.managed(tmp_path / "blockchain.sqlite", db_version=2) as db_wrapper:
+        await BlockStore.create(db_wrapper)
+        await add_chain(db_wrapper, farms, rng)
+        height_map = await BlockHeightMap.create(tmp_path, db_wrapper)
+        check_counts(height_map, farms)
+
+        # a reorg, farmed by others
+        height_map.rollback(29)
+        del farms[30:]
+        check_counts(height_map, farms)
+        for height in range(30, 45):
+            farm = rng.choice(FARMS)
+            height_map.update_height(uint32(height), bytes32.random(rng), None, farm)
+            farms.append(farm)
+        check_counts(height_map, farms)
+        height_map.close()
@@ -0,0 +1,216 @@
+from __future__ import annotations
+
+import random
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+import pytest
+
+from greenbtc.consensus.blockchain import Blockchain
+from greenbtc.full_node.stake_coefficient_engine import StakeCoefficientEngine
+from greenbtc.full_node.stake_record_store import StakeRecordStore
+from greenbtc.types.blockchain_format.sized_bytes import bytes32
+from greenbtc.types.stake_record import StakeRecord, StakeRecordThin
+from greenbtc.types.stake_value import STAKE_FARM_COUNT, STAKE_FARM_LIST, get_stake_value
+from greenbtc.util.db_wrapper import DBWrapper2
+from greenbtc.util.ints import uint16, uint32, uint64
+
+BLOCK_TIME = 19
+START_TIMESTAMP = 1631794488
+# records expire 1 to 30 blocks after they're confirmed, and the engine keeps the ones expired less than 10 blocks ago
+RETENTION = 10 * BLOCK_TIME
+
+
+def block_timestamp(height: int) -> int:
+    return START_TIMESTAMP + height * BLOCK_TIME
+
+
+class StakeChain:
+    """
+    Adds blocks of stake farm records to a StakeRecordStore and a StakeCoefficientEngine the way Blockchain does, and
+    keeps the records in insertion order to tell what get_stake_farm_records_thin returned before either existed
+    """
+
+    def __init__(self, db_wrapper: DBWrapper2, store: StakeRecordStore, engine: StakeCoefficientEngine) -> None:
+        self.db_wrapper = db_wrapper
+        self.store = store
+        self.engine = engine
+        self.records: List[StakeRecord] = []
+        self.height = 0
+        self.max_height = 0
+        self.rng = random.Random(2)
+        # one stake puzzle hash with many more recipients than STAKE_FARM_COUNT, and a few small ones
+        self.big_farm = bytes32.random(self.rng)
+        self.small_farms = [bytes32.random(self.rng) for _ in range(3)]
+        self.recipients = [bytes32.random(self.rng) for _ in range(STAKE_FARM_COUNT + 60)]
+
+    def make_record(self, height: int, stake_puzzle_hash: bytes32, puzzle_hash: bytes32) -> StakeRecord:
+        # stake_type len(STAKE_FARM_LIST) has no stake value, its records are worth nothing
+        stake_type = self.rng.randrange(len(STAKE_FARM_LIST) + 1)
+        return StakeRecord(
+            bytes32.random(self.rng),
+            uint64(self.rng.randint(100, 100000)),
+            uint32(height),
+            uint32(0),
+            stake_puzzle_hash,
+            puzzle_hash,
+            uint16(stake_type),
+            True,
+            get_stake_value(uint16(stake_type), True).coefficient,
+            uint64(block_timestamp(height) + self.rng.randint(1, 30) * BLOCK_TIME),
+        )
+
+    async def add_block(self) -> None:
+        self.height += 1
+        self.max_height = max(self.max_height, self.height)
+        records = [self.make_record(self.height, self.big_farm, self.rng.choice(self.recipients)) for _ in range(12)]
+        records += [
+            self.make_record(self.height, stake_puzzle_hash, self.rng.choice(self.recipients[:4]))
+            for stake_puzzle_hash in self.small_farms
+        ]
+        async with self.db_wrapper.writer():
+            await self.store.new_stake(uint32(self.height), records, [])
+        self.store.commit_totals()
+        self.engine.add_records(records)
+        self.records += records
+        await self.engine.set_peak(uint32(self.height), uint64(block_timestamp(self.height)))
+
+    async def rollback(self, fork_height: int) -> None:
+        async with self.db_wrapper.writer():
+            await self.store.rollback_to_block(fork_height)
+        self.store.commit_totals()
+        self.engine.rollback(fork_height)
+        self.records = [record for record in self.records if record.confirmed_block_index <= fork_height]
+        self.height = fork_height
+        await self.engine.set_peak(uint32(self.height), uint64(block_timestamp(self.height)))
+
+    def expected_records(self, stake_puzzle_hash: bytes32, height: int, timestamp: int) -> List[StakeRecord]:
+        # the farm records confirmed before height and expiring after timestamp, in insertion order, from the first
+        # STAKE_FARM_COUNT distinct recipient puzzle hashes
+        result: List[StakeRecord] = []
+        puzzle_hashes = set()
+        for record in self.records:
+            if record.stake_puzzle_hash != stake_puzzle_hash:
+                continue
+            if record.confirmed_block_index >= height or record.expiration <= timestamp:
+                continue
+            if len(puzzle_hashes) >= STAKE_FARM_COUNT and record.puzzle_hash not in puzzle_hashes:
+                continue
+            puzzle_hashes.add(record.puzzle_hash)
+            result.append(record)
+        return result
+
+    def expected_rewards(self, stake_puzzle_hash: bytes32, height: int, timestamp: int) -> Dict[bytes32, int]:
+        rewards: Dict[bytes32, int] = {}
+        for record in self.expected_records(stake_puzzle_hash, height, timestamp):
+            reward = get_stake_value(record.stake_type, True).reward_amount(record.amount)
+            rewards[record.puzzle_hash] = rewards.get(record.puzzle_hash, 0) + reward
+        return rewards
+
+    @property
+    def stake_puzzle_hashes(self) -> List[bytes32]:
+        return [self.big_farm] + self.small_farms
+
+
+def thin(records: List[StakeRecord]) -> List[Tuple[bytes32, bytes32, int, int, int]]:
+    return [
+        (record.stake_puzzle_hash, record.puzzle_hash, record.amount, record.stake_type, record.expiration)
+        for record in records
+    ]
+
+
+def thin_from_store(records: List[StakeRecordThin]) -> List[Tuple[bytes32, bytes32, int, int, int]]:
+    return [
+        (record.stake_puzzle_hash, record.puzzle_hash, record.amount, record.stake_type, record.expiration)
+        for record in records
+    ]
+
+
+async def check(chain: StakeChain, height: int, timestamp: int) -> None:
+    store = chain.store
+    store.reset_caches()
+    stake_puzzle_hashes = chain.stake_puzzle_hashes
+    by_puzzle_hash = await store.get_stake_farm_records_thin_by_puzzle_hashes(
+        stake_puzzle_hashes, uint32(height), uint64(timestamp)
+    )
+    store.reset_caches()
+    heights = [h for h in (height, height - 3) if h >= 0]
+    farms = [(stake_puzzle_hash, uint32(h)) for stake_puzzle_hash in stake_puzzle_hashes for h in heights]
+    by_height = await store.get_stake_farm_records_thin_by_heights(farms, uint64(timestamp))
+    store.reset_caches()
+    batch = await Blockchain.get_stake_farm_records_batch(
+        SimpleNamespace(stake_record_store=store), farms, uint64(timestamp)  # type: ignore[arg-type]
+    )
+
+    for stake_puzzle_hash in stake_puzzle_hashes:
+        expected = chain.expected_records(stake_puzzle_hash, height, timestamp)
+        store.reset_caches()
+        records = await store.get_stake_farm_records_thin(stake_puzzle_hash, uint32(height), uint64(timestamp))
+        assert thin_from_store(records) == thin(expected)
+        assert thin_from_store(by_puzzle_hash[stake_puzzle_hash]) == thin(expected)
+        for h in heights:
+            expected_h = chain.expected_records(stake_puzzle_hash, h, timestamp)
+            assert thin_from_store(by_height[(stake_puzzle_hash, uint32(h))]) == thin(expected_h)
+            assert batch[(stake_puzzle_hash, uint32(h))] == chain.expected_rewards(stake_puzzle_hash, h, timestamp)
+
+        amount: Optional[int] = chain.engine.get_stake_amount(stake_puzzle_hash, uint32(height), uint64(timestamp))
+        if amount is None:
+            # older than the records the engine keeps, the caller goes to the store. It always answers for the peak
+            assert height != chain.height
+            assert timestamp < block_timestamp(chain.max_height) - RETENTION
+        else:
+            assert amount == sum(chain.expected_rewards(stake_puzzle_hash, height, timestamp).values())
+
+
+@pytest.mark.anyio
+async def test_stake_farm_records(tmp_path: Path) -> None:
+    async with DBWrapper2.managed(tmp_path / "db.sqlite", db_version=2) as db_wrapper:
+        store = await StakeRecordStore.create(db_wrapper)
+        chain = StakeChain(db_wrapper, store, StakeCoefficientEngine(store, retention=RETENTION))
+        for _ in range(40):
+            await chain.add_block()
+            # the peak, and earlier transaction blocks
+            for blocks_back in (0, 1, 4):
+                if blocks_back > chain.height:
+                    continue
+                await check(chain, chain.height - blocks_back, block_timestamp(chain.height - blocks_back))
+        assert len({record.puzzle_hash for record in chain.records if record.stake_puzzle_hash == chain.big_farm}) > (
+            STAKE_FARM_COUNT
+        )
+
+        # a reorg, with the recipients of the new blocks in a different order
+        await chain.rollback(33)
+        await check(chain, chain.height, block_timestamp(chain.height))
+        chain.rng.shuffle(chain.recipients)
+        for _ in range(10):
+            await chain.add_block()
+            await check(chain, chain.height, block_timestamp(chain.height))
+
+        # a reorg deeper than the records kept in memory, like after a restart
+        await chain.rollback(20)
+        await check(chain, chain.height, block_timestamp(chain.height))
+        chain.engine.reset()
+        await chain.engine.set_peak(uint32(chain.height), uint64(block_timestamp(chain.height)))
+        for _ in range(5):
+            await chain.add_block()
+            await check(chain, chain.height, block_timestamp(chain.height))
+
+
+@pytest.mark.anyio
+async def test_stake_amount_retention_boundary(tmp_path: Path) -> None:
+    async with DBWrapper2.managed(tmp_path / "db.sqlite", db_version=2) as db_wrapper:
+        store = await StakeRecordStore.create(db_wrapper)
+        chain = StakeChain(db_wrapper, store, StakeCoefficientEngine(store, retention=RETENTION))
+        for _ in range(30):
+            await chain.add_block()
+        # the records that expired at or before the floor may be gone, those after it can't be
+        floor = block_timestamp(chain.height) - RETENTION
+        assert any(record.expiration == floor for record in chain.records)
+        for stake_puzzle_hash in chain.stake_puzzle_hashes:
+            for timestamp in (floor, floor + 1, floor + BLOCK_TIME):
+                for height in (chain.height, chain.height - 5):
+                    amount = chain.engine.get_stake_amount(stake_puzzle_hash, uint32(height), uint64(timestamp))
+                    assert amount == sum(chain.expected_rewards(stake_puzzle_hash, height, timestamp).values())
+            assert chain.engine.get_stake_amount(stake_puzzle_hash, uint32(chain.height), uint64(floor - 1)) is None
+        await check(chain, chain.height - 10, floor)
@@ -0,0 +1,13 @@
+from __future__ import annotations
+
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from greenbtc.util.db_wrapper import DBWrapper2, generate_in_memory_db_uri
+
+
+@asynccontextmanager
+async def DBConnection(db_version: int) -> AsyncIterator[DBWrapper2]:
+    db_uri = generate_in_memory_db_uri()
+    async with DBWrapper2.managed(database=db_uri, uri=True, reader_count=4, db_version=db_version) as _db_wrapper:
+        yield _db_wrapper
@@ -15,10 +15,10 @@ from typing import Callable, Iterator, List, Optional, cast
 
 import aiosqlite
 import click
-import zstd
 
 from greenbtc.cmds.init_funcs import greenbtc_init
 from greenbtc.consensus.default_constants import DEFAULT_CONSTANTS
+from greenbtc.full_node.block_compression import BlockCompressor
 from greenbtc.full_node.full_node import FullNode
 from greenbtc.server.outbound_message import Message, NodeType
 from greenbtc.server.server import GreenBTCServer
@@ -43,6 +43,19 @@ class ExitOnError(logging.Handler):
         self.exit_with_failure = True
 
 
+async def block_compressor_for_aiosqlite(db: aiosqlite.Connection) -> BlockCompressor:
+    compressor = BlockCompressor()
+    async with db.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name='block_compression_dicts'"
+    ) as cursor:
+        if await cursor.fetchone() is None:
+            return compressor
+    async with db.execute("SELECT dictionary FROM block_compression_dicts ORDER BY id") as cursor:
+        async for row in cursor:
+            compressor.add_dictionary(row[0])
+    return compressor
+
+
 @contextmanager
 def enable_profiler(profile: bool, counter: int) -> Iterator[None]:
     if not profile:
@@ -160,6 +173,7 @@ async def run_sync_test(
             prev_hash = None
             async with aiosqlite.connect(file) as in_db:
                 await in_db.execute("pragma query_only")
+                compressor = await block_compressor_for_aiosqlite(in_db)
                 rows = await in_db.execute(
                     "SELECT header_hash, height, block FROM full_blocks "
                     "WHERE height >= ? AND in_main_chain=1 ORDER BY height",
@@ -176,7 +190,7 @@ async def run_sync_test(
                 async for r in rows:
                     batch_start_time = time.monotonic()
                     with enable_profiler(profile, height):
-                        block = FullBlock.from_bytes(zstd.decompress(r[2]))
+                        block = FullBlock.from_bytes(compressor.decompress(r[2]))
                         block_batch.append(block)
 
                         assert block.height == monotonic
@@ -348,6 +362,7 @@ async def run_sync_checkpoint(
         height = 0
         async with aiosqlite.connect(file) as in_db:
             await in_db.execute("pragma query_only")
+            compressor = await block_compressor_for_aiosqlite(in_db)
             rows = await in_db.execute(
                 "SELECT block FROM full_blocks WHERE in_main_chain=1 AND height < ? ORDER BY height", (max_height,)
             )
@@ -355,7 +370,7 @@ async def run_sync_checkpoint(
             block_batch = []
             peer_info = peer.get_peer_logging()
             async for r in rows:
-                block = FullBlock.from_bytes(zstd.decompress(r[0]))
+                block = FullBlock.from_bytes(compressor.decompress(r[0]))
                 block_batch.append(block)
 
                 if len(block_batch) < 32: